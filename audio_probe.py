@@ -0,0 +1,317 @@
+"""
+只读取容器头部信息获取音频时长，不解码音频数据。
+
+支持的格式：
+- MP3：Xing/Info、VBRI 头，没有时逐帧扫描帧头
+- WAV：RIFF 头中的 fmt / data 块
+- FLAC：STREAMINFO 中的总采样数
+- AAC：逐帧扫描 ADTS 帧头
+
+无法解析时返回 None，由调用方决定是否退回到解码的方式。
+"""
+
+import mmap
+import os
+import struct
+
+# MPEG 版本：帧头中的 2 位版本号 -> 版本
+MPEG_VERSIONS = {0b00: 2.5, 0b10: 2, 0b11: 1}
+
+# MPEG 层：帧头中的 2 位层号 -> 层
+MPEG_LAYERS = {0b01: 3, 0b10: 2, 0b11: 1}
+
+# 比特率表（kbps），按 (版本, 层) 索引，下标为帧头中的比特率索引
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# 采样率表（Hz），按版本索引
+MPEG_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+# ADTS 采样率索引表（Hz）
+ADTS_SAMPLE_RATES = [
+    96000,
+    88200,
+    64000,
+    48000,
+    44100,
+    32000,
+    24000,
+    22050,
+    16000,
+    12000,
+    11025,
+    8000,
+    7350,
+]
+
+# 查找第一个 MPEG 帧时最多扫描的字节数
+MAX_SYNC_SEARCH = 64 * 1024
+
+
+def probe_duration(file_path):
+    """从文件头解析音频时长（秒），无法解析时返回 None"""
+    try:
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _probe(data)
+    except (OSError, ValueError, IndexError, struct.error):
+        # 截断或损坏的文件
+        return None
+
+
+def _probe(data):
+    """按文件内容（而不是扩展名）选择解析方式"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return _probe_wav(data)
+
+    offset = _skip_id3v2(data)
+    head = data[offset : offset + 4]
+    if head == b"fLaC":
+        return _probe_flac(data, offset)
+    if len(head) == 4 and head[0] == 0xFF and head[1] & 0xF6 == 0xF0:
+        # 同步字后的层号为 00 的是 ADTS
+        return _probe_adts(data, offset)
+    return _probe_mp3(data, offset)
+
+
+def _skip_id3v2(data):
+    """跳过文件开头的 ID3v2 标签，返回音频数据的起始位置"""
+    offset = 0
+    # 有的文件开头连续写了多个 ID3 标签
+    while data[offset : offset + 3] == b"ID3" and len(data) >= offset + 10:
+        flags = data[offset + 5]
+        size_bytes = data[offset + 6 : offset + 10]
+        size = 0
+        for b in size_bytes:
+            size = (size << 7) | (b & 0x7F)
+        offset += 10 + size
+        if flags & 0x10:
+            # 带页脚
+            offset += 10
+    return offset
+
+
+# ---------------------------------------------------------------- WAV
+
+
+def _probe_wav(data):
+    """RIFF 头：data 块大小 / 每秒字节数"""
+    byte_rate = None
+    offset = 12
+    end = len(data)
+    while offset + 8 <= end:
+        chunk_id = data[offset : offset + 4]
+        (chunk_size,) = struct.unpack_from("<I", data, offset + 4)
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            (byte_rate,) = struct.unpack_from("<I", data, body + 8)
+        elif chunk_id == b"data":
+            if not byte_rate:
+                return None
+            # 写入中断的文件 data 块大小可能大于实际数据
+            data_size = min(chunk_size, end - body)
+            return data_size / byte_rate
+        # 块按 2 字节对齐
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+# --------------------------------------------------------------- FLAC
+
+
+def _probe_flac(data, offset):
+    """STREAMINFO：总采样数 / 采样率"""
+    block_header = offset + 4
+    if len(data) <= block_header:
+        return None
+    block_type = data[block_header] & 0x7F
+    if block_type != 0:
+        # 规范要求第一个元数据块必须是 STREAMINFO
+        return None
+    info = data[block_header + 4 : block_header + 4 + 34]
+    if len(info) < 18:
+        return None
+    # 第 10 字节起：20 位采样率、3 位声道数、5 位采样位数、36 位总采样数
+    (packed,) = struct.unpack(">Q", info[10:18])
+    sample_rate = packed >> 44
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate or not total_samples:
+        return None
+    return total_samples / sample_rate
+
+
+# ---------------------------------------------------------------- AAC
+
+
+def _probe_adts(data, offset):
+    """逐帧扫描 ADTS 帧头，每个原始数据块 1024 个采样"""
+    end = len(data)
+    samples = 0
+    sample_rate = None
+    while offset + 7 <= end:
+        if data[offset] != 0xFF or data[offset + 1] & 0xF6 != 0xF0:
+            break
+        sr_index = (data[offset + 2] >> 2) & 0x0F
+        if sr_index >= len(ADTS_SAMPLE_RATES):
+            break
+        frame_length = (
+            ((data[offset + 3] & 0x03) << 11)
+            | (data[offset + 4] << 3)
+            | (data[offset + 5] >> 5)
+        )
+        if frame_length < 7:
+            break
+        sample_rate = ADTS_SAMPLE_RATES[sr_index]
+        samples += ((data[offset + 6] & 0x03) + 1) * 1024
+        offset += frame_length
+    if not samples:
+        return None
+    return samples / sample_rate
+
+
+# ---------------------------------------------------------------- MP3
+
+
+def _parse_mpeg_header(data, offset):
+    """
+    解析 MPEG 音频帧头。
+    返回 (版本, 层, 比特率 bps, 采样率, 每帧采样数, 帧长度, 声道模式)，不是合法帧头时返回 None
+    """
+    if offset + 4 > len(data):
+        return None
+    b1, b2, b3, b4 = data[offset], data[offset + 1], data[offset + 2], data[offset + 3]
+    if b1 != 0xFF or b2 & 0xE0 != 0xE0:
+        return None
+    version = MPEG_VERSIONS.get((b2 >> 3) & 0x03)
+    layer = MPEG_LAYERS.get((b2 >> 1) & 0x03)
+    bitrate_index = b3 >> 4
+    sr_index = (b3 >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sr_index == 3:
+        return None
+
+    bitrate = MPEG_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][sr_index]
+    padding = (b3 >> 1) & 0x01
+    channel_mode = b4 >> 6
+
+    if layer == 1:
+        samples_per_frame = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        if layer == 3 and version != 1:
+            samples_per_frame = 576
+        else:
+            samples_per_frame = 1152
+        frame_length = samples_per_frame // 8 * bitrate // sample_rate + padding
+
+    return (
+        version,
+        layer,
+        bitrate,
+        sample_rate,
+        samples_per_frame,
+        frame_length,
+        channel_mode,
+    )
+
+
+def _find_first_frame(data, offset):
+    """查找第一个帧头，要求紧跟着的下一帧也合法，避免误把数据当成同步字"""
+    limit = min(len(data), offset + MAX_SYNC_SEARCH)
+    while offset < limit:
+        offset = data.find(b"\xff", offset, limit)
+        if offset < 0:
+            return None, None
+        header = _parse_mpeg_header(data, offset)
+        if header:
+            next_offset = offset + header[5]
+            if next_offset + 4 > len(data) or _parse_mpeg_header(data, next_offset):
+                return offset, header
+        offset += 1
+    return None, None
+
+
+def _probe_mp3(data, offset):
+    """优先读 Xing/Info、VBRI 头中的总帧数，没有时逐帧扫描"""
+    offset, header = _find_first_frame(data, offset)
+    if header is None:
+        return None
+    version, _, _, sample_rate, samples_per_frame, _, channel_mode = header
+
+    # Xing/Info 头位于边信息之后
+    mono = channel_mode == 0b11
+    if version == 1:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    xing = offset + 4 + side_info
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        (flags,) = struct.unpack_from(">I", data, xing + 4)
+        if flags & 0x01:
+            (frames,) = struct.unpack_from(">I", data, xing + 8)
+            if frames:
+                samples = frames * samples_per_frame
+                samples -= _encoder_delay_padding(data, xing, flags, samples)
+                return samples / sample_rate
+
+    # VBRI 头固定位于帧头后 32 字节
+    vbri = offset + 4 + 32
+    if data[vbri : vbri + 4] == b"VBRI":
+        (frames,) = struct.unpack_from(">I", data, vbri + 14)
+        if frames:
+            return frames * samples_per_frame / sample_rate
+
+    return _scan_mp3_frames(data, offset)
+
+
+def _encoder_delay_padding(data, xing, flags, samples):
+    """
+    LAME 扩展头（LAME / Lavc 等编码器写入）中记录的编码延迟和末尾填充采样数，
+    解码器做无缝播放时会去掉这部分，没有扩展头时返回 0
+    """
+    # 跳过 Xing 头中的可选字段：帧数、字节数、TOC、质量
+    lame = xing + 8
+    for flag, size in ((0x01, 4), (0x02, 4), (0x04, 100), (0x08, 4)):
+        if flags & flag:
+            lame += size
+    encoder = data[lame : lame + 4]
+    if len(encoder) < 4 or not encoder.isalnum():
+        return 0
+    packed = data[lame + 21 : lame + 24]
+    if len(packed) < 3:
+        return 0
+    delay = (packed[0] << 4) | (packed[1] >> 4)
+    padding = ((packed[1] & 0x0F) << 8) | packed[2]
+    if delay + padding >= samples:
+        return 0
+    return delay + padding
+
+
+def _scan_mp3_frames(data, offset):
+    """逐帧累加采样数，只读取帧头，遇到非帧数据（ID3v1/APE 标签等）时停止"""
+    end = len(data)
+    total_samples = 0
+    sample_rate = None
+    while offset + 4 <= end:
+        header = _parse_mpeg_header(data, offset)
+        if header is None:
+            break
+        sample_rate = header[3]
+        total_samples += header[4]
+        offset += header[5]
+    if not total_samples:
+        return None
+    return total_samples / sample_rate
@@ -0,0 +1,96 @@
+"""
+音频时长获取的性能对比：文件头解析（audio_probe）与 librosa。
+
+用法：python bench_audio_probe.py [目录] [--repeat N]
+默认测试 static/ 下的所有音频文件。
+"""
+
+import argparse
+import os
+import time
+
+from audio_probe import probe_duration
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".aac")
+
+
+def find_audio_files(directory):
+    """递归查找目录下的音频文件"""
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return paths
+
+
+def time_call(func, path, repeat):
+    """返回 (结果, 平均耗时毫秒)"""
+    result = None
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(path)
+    elapsed = (time.perf_counter() - start) / repeat
+    return result, elapsed * 1000
+
+
+def librosa_duration(path):
+    import librosa
+
+    return librosa.get_duration(path=path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark audio duration probing")
+    parser.add_argument("directory", nargs="?", default="static")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--skip-librosa", action="store_true", help="only time the header probe"
+    )
+    args = parser.parse_args()
+
+    paths = find_audio_files(args.directory)
+    if not paths:
+        print(f"No audio files found under {args.directory}")
+        return
+
+    # librosa 首次调用包含导入和初始化的开销，单独统计
+    if not args.skip_librosa:
+        start = time.perf_counter()
+        librosa_duration(paths[0])
+        print(
+            f"librosa import + first call: {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+
+    print(
+        f"{'file':<40} {'size':>10} {'probe s':>10} {'probe ms':>10} {'librosa s':>10} {'librosa ms':>11} {'speedup':>8}"
+    )
+    total_probe = total_librosa = 0.0
+    for path in paths:
+        name = os.path.basename(path)
+        if len(name) > 38:
+            name = name[:35] + "..."
+        size = os.path.getsize(path)
+        probe_result, probe_ms = time_call(probe_duration, path, args.repeat)
+        total_probe += probe_ms
+        probe_text = f"{probe_result:.3f}" if probe_result is not None else "failed"
+
+        if args.skip_librosa:
+            print(f"{name:<40} {size:>10} {probe_text:>10} {probe_ms:>10.3f}")
+            continue
+
+        librosa_result, librosa_ms = time_call(librosa_duration, path, args.repeat)
+        total_librosa += librosa_ms
+        speedup = librosa_ms / probe_ms if probe_ms else float("inf")
+        print(
+            f"{name:<40} {size:>10} {probe_text:>10} {probe_ms:>10.3f} "
+            f"{librosa_result:>10.3f} {librosa_ms:>11.3f} {speedup:>7.0f}x"
+        )
+
+    print(f"total probe: {total_probe:.3f} ms per pass over {len(paths)} files")
+    if not args.skip_librosa:
+        print(f"total librosa: {total_librosa:.3f} ms per pass over {len(paths)} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+音乐ID生成的性能和唯一性测试：Snowflake 风格的 IdGenerator 与原来的 时间戳 + 随机数。
+
+用法：python bench_id_generator.py [--count N] [--batch N] [--threads N] [--processes N]
+- 单线程：一个生成器逐个（next_id）或按批（next_ids，一次上传的所有文件）生成 N 个ID
+- 多线程：多个线程共用一个生成器（同一进程内）
+- 多进程：每个进程使用不同节点号的生成器（模拟多个工作进程、多台机器）
+每种情况都检查生成的ID没有重复。
+"""
+
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+
+from id_generator import IdGenerator
+
+
+def legacy_id():
+    """原来的音乐ID：当前时间戳（秒） + 1000~9999 的随机数"""
+    return int(time.time()) + random.randint(1000, 9999)
+
+
+def generate(worker_id, count, batch=1):
+    generator = IdGenerator(worker_id)
+    if batch > 1:
+        ids = []
+        while len(ids) < count:
+            ids.extend(generator.next_ids(min(batch, count - len(ids))))
+        return ids
+    next_id = generator.next_id
+    return [next_id() for _ in range(count)]
+
+
+def report(name, ids, elapsed):
+    duplicates = len(ids) - len(set(ids))
+    rate = len(ids) / elapsed if elapsed else float("inf")
+    print(
+        f"{name:<12} {len(ids):>10} ids {elapsed * 1000:>10.1f} ms "
+        f"{rate / 1e6:>8.2f} M ids/s {duplicates:>8} duplicates"
+    )
+    return duplicates
+
+
+def bench_single(count, batch):
+    start = time.perf_counter()
+    ids = generate(0, count, batch)
+    name = f"batch {batch}" if batch > 1 else "single"
+    return report(name, ids, time.perf_counter() - start)
+
+
+def bench_threads(count, threads, batch):
+    generator = IdGenerator(1)
+    per_thread = count // threads
+    results = [None] * threads
+
+    def work(i):
+        ids = []
+        while len(ids) < per_thread:
+            ids.extend(generator.next_ids(min(batch, per_thread - len(ids))))
+        results[i] = ids
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    ids = [value for chunk in results for value in chunk]
+    return report(f"{threads} threads", ids, elapsed)
+
+
+def bench_processes(count, processes, batch):
+    per_process = count // processes
+    with multiprocessing.Pool(processes) as pool:
+        # 先启动进程，不把进程创建的时间算进去
+        pool.map(abs, range(processes))
+        start = time.perf_counter()
+        results = pool.starmap(
+            generate,
+            [(worker_id, per_process, batch) for worker_id in range(processes)],
+        )
+        elapsed = time.perf_counter() - start
+    ids = [value for chunk in results for value in chunk]
+    return report(f"{processes} procs", ids, elapsed)
+
+
+def bench_legacy(count):
+    start = time.perf_counter()
+    ids = [legacy_id() for _ in range(count)]
+    return report("legacy", ids, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark music ID generation")
+    parser.add_argument("--count", type=int, default=2_000_000)
+    parser.add_argument(
+        "--batch", type=int, default=100, help="ids per next_ids() call"
+    )
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument(
+        "--legacy-count",
+        type=int,
+        default=1000,
+        help="ids for the old timestamp + random scheme (a batch upload)",
+    )
+    args = parser.parse_args()
+
+    duplicates = 0
+    duplicates += bench_single(args.count, 1)
+    duplicates += bench_single(args.count, args.batch)
+    duplicates += bench_threads(args.count, args.threads, args.batch)
+    duplicates += bench_processes(args.count, args.processes, args.batch)
+    print(f"snowflake duplicates: {duplicates}")
+
+    # 原来的方式只是参考，重复是预期的
+    bench_legacy(args.legacy_count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+大响应的序列化和压缩性能：标准库 json（Flask 默认）与 orjson，以及 gzip / br / zstd 压缩后的大小和耗时。
+
+用法：python bench_serialization.py [--songs N] [--repeat N] [--chunk N]
+- 数据为合成的歌单（/api/user/songs 的格式）和管理端音乐列表（带 created_at 日期时间）
+- 压缩分别测试一次压缩整个响应和流式响应（每 chunk 首歌一块，每块之后 flush）
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from compression import ENCODERS, DEFAULT_LEVELS, compress, compress_stream
+from serialization import OrjsonProvider, orjson
+
+NAMES = ["夜に駆ける", "晴天", "Lemon", "稻香", "Shape of You", "极私的极彩色アンサー"]
+ARTISTS = ["YOASOBI", "周杰伦", "米津玄師", "Ed Sheeran", "トゲナシトゲアリ"]
+
+
+def make_songs(count):
+    """合成的歌单，格式与 song_from_row 相同"""
+    rng = random.Random(0)
+    songs = []
+    for i in range(count):
+        music_id = 370205264063762432 + i * 4096
+        songs.append(
+            {
+                "id": str(music_id),
+                "name": f"{rng.choice(NAMES)} {i}",
+                "ar": [{"name": rng.choice(ARTISTS)}],
+                "al": {"picUrl": f"http://localhost:5001/static/images/{music_id}.jpg"},
+                "dt": rng.randint(120000, 360000),
+                "mv": 0,
+                "alia": [],
+                "self": rng.random() < 0.5,
+                "fee": 8,
+                "st": 0,
+                "file_size": rng.randint(2, 12) * 1024 * 1024,
+                "is_disabled": 0,
+            }
+        )
+    return {
+        "songsDetail": {
+            "songs": songs,
+            "privileges": [{"chargeInfoList": [{"chargeType": 0}], "st": 0}] * count,
+        }
+    }
+
+
+def make_admin_music(count):
+    """合成的管理端音乐列表，created_at 为 datetime"""
+    rng = random.Random(1)
+    start = datetime(2024, 1, 1)
+    return {
+        "music": [
+            {
+                "id": i,
+                "music_id": str(370205264063762432 + i * 4096),
+                "filename": f"{rng.choice(NAMES)} {i}.mp3",
+                "artist": rng.choice(ARTISTS),
+                "username": f"user{rng.randint(1, 500)}",
+                "file_size": rng.randint(2, 12) * 1024 * 1024,
+                "is_disabled": False,
+                "created_at": start + timedelta(seconds=rng.randint(0, 10**7)),
+            }
+            for i in range(count)
+        ],
+        "next_cursor": None,
+    }
+
+
+def best_time(func, repeat):
+    """多次执行取最短耗时（毫秒）和结果"""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def bench_serializers(name, payload, providers, repeat):
+    bodies = {}
+    for provider_name, provider in providers.items():
+        ms, body = best_time(lambda: provider.dumps(payload).encode(), repeat)
+        bodies[provider_name] = body
+        print(f"{name:<14} {provider_name:<10} {len(body):>12} bytes {ms:>10.2f} ms")
+    return bodies
+
+
+def bench_compression(body, chunks, repeat):
+    for encoding in ENCODERS:
+        level = DEFAULT_LEVELS[encoding]
+        ms, data = best_time(lambda: compress(body, encoding, level), repeat)
+        stream_ms, stream = best_time(
+            lambda: b"".join(compress_stream(iter(chunks), encoding, level)), repeat
+        )
+        print(
+            f"  {encoding:<6} level {level:<3} {len(data):>10} bytes "
+            f"({len(data) / len(body):>6.1%}) {ms:>8.2f} ms | "
+            f"stream {len(stream):>10} bytes {stream_ms:>8.2f} ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark JSON serialization and compression"
+    )
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--chunk", type=int, default=500, help="songs per chunk in streaming mode"
+    )
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    providers = {"stdlib": DefaultJSONProvider(app)}
+    if orjson is not None:
+        providers["orjson"] = OrjsonProvider(app)
+    else:
+        print("orjson is not installed, only timing the stdlib provider")
+    print(f"encodings: {', '.join(ENCODERS)}")
+
+    playlist = make_songs(args.songs)
+    bodies = bench_serializers("playlist", playlist, providers, args.repeat)
+    bench_serializers(
+        "admin music", make_admin_music(args.songs), providers, args.repeat
+    )
+
+    # 压缩使用最快的序列化结果；流式时按 chunk 首歌分块
+    provider = providers.get("orjson", providers["stdlib"])
+    body = bodies.get("orjson", bodies["stdlib"])
+    songs = playlist["songsDetail"]["songs"]
+    chunks = [
+        provider.dumps(songs[i : i + args.chunk]).encode()
+        for i in range(0, len(songs), args.chunk)
+    ]
+    print(f"compression of the {len(body)} byte playlist ({len(chunks)} chunks):")
+    bench_compression(body, chunks, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
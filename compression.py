@@ -0,0 +1,168 @@
+"""
+响应压缩：按请求的 Accept-Encoding 在 zstd / br / gzip 中选择，服务端按配置的顺序优先。
+
+- 小于 min_size 的响应不压缩（压缩后可能反而更大，也不值得花 CPU）
+- 流式响应（生成器）逐块压缩，每块之后 flush，客户端可以边收边解析，内存占用不变
+- 206、304、已经压缩过的、文件（direct_passthrough）和音频、图片等不压缩
+- 压缩后强 ETag 改成弱 ETag（同一内容不同编码的字节不同），If-None-Match 按弱比较仍然匹配
+
+gzip 使用标准库；br、zstd 分别需要 brotli、zstandard，没有安装时不提供。
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 动态内容使用中等级别，压缩率和速度兼顾
+DEFAULT_LEVELS = {"gzip": 6, "br": 5, "zstd": 3}
+
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+}
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        """输出目前为止的所有数据，流仍然可以继续"""
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+ENCODERS = {"gzip": GzipEncoder}
+if brotli is not None:
+    ENCODERS["br"] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS["zstd"] = ZstdEncoder
+
+
+def compress(data, encoding, level):
+    """一次压缩整段数据"""
+    encoder = ENCODERS[encoding](level)
+    return encoder.compress(data) + encoder.finish()
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    逐块压缩，每块之后 flush；关闭时同时关闭原来的迭代器（释放数据库连接等）。
+    :param chunks: 响应体的迭代器，元素为 str 或 bytes
+    """
+    encoder = ENCODERS[encoding](level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = encoder.compress(chunk) + encoder.flush()
+            if data:
+                yield data
+        yield encoder.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def is_compressible(mimetype):
+    return mimetype is not None and (
+        mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+    )
+
+
+class ResponseCompressor:
+    """
+    :param encodings: 支持的编码，按优先顺序，没有安装的编码被忽略
+    :param min_size: 压缩的最小响应大小（字节）
+    :param levels: {编码: 压缩级别}，没有指定的使用 DEFAULT_LEVELS
+    """
+
+    def __init__(self, encodings, min_size, levels=None):
+        self.encodings = [name for name in encodings if name in ENCODERS]
+        self.min_size = min_size
+        self.levels = {**DEFAULT_LEVELS, **(levels or {})}
+
+    def negotiate(self, accept_encodings):
+        """
+        客户端接受的编码中服务端最优先的一个，都不接受时返回 None。
+        :param accept_encodings: request.accept_encodings
+        """
+        if not self.encodings:
+            return None
+        return accept_encodings.best_match(self.encodings)
+
+    def __call__(self, request, response):
+        """after_request 钩子，在其他钩子之后执行"""
+        if (
+            request.method == "HEAD"
+            or response.status_code != 200
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or not is_compressible(response.mimetype)
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        if (
+            not response.is_streamed
+            and (response.calculate_content_length() or 0) < self.min_size
+        ):
+            return response
+        encoding = self.negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        level = self.levels[encoding]
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, level)
+            response.headers.pop("Content-Length", None)
+        else:
+            response.set_data(compress(response.get_data(), encoding, level))
+        response.headers["Content-Encoding"] = encoding
+
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,91 @@
+"""
+Snowflake 风格的 64 位ID：不需要每次生成都访问数据库，多线程、多进程、多台机器同时生成也不会重复。
+
+从高位到低位：1 位符号位（始终为 0）、41 位毫秒时间戳（相对 EPOCH_MS，约 69 年）、
+10 位工作节点号（同一时刻每个进程使用不同的节点号，最多 1024 个）、12 位序号（每毫秒 4096 个）。
+同一节点内 (时间戳, 序号) 严格递增，不同节点的节点号不同，所以ID全局唯一，并且大致按时间排序。
+
+时钟回拨时不等待也不报错：继续使用上一次的时间戳，序号用完后借用下一毫秒，
+生成的ID仍然递增；时钟追上后恢复使用当前时间。
+"""
+
+import threading
+import time
+
+# 2024-01-01 00:00:00 UTC
+EPOCH_MS = 1704067200000
+
+TIMESTAMP_BITS = 41
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+WORKER_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_BITS
+
+
+class IdGenerator:
+    """一个工作节点的ID生成器，线程安全；fork 出的子进程需要使用不同节点号的新实例"""
+
+    def __init__(self, worker_id, epoch_ms=EPOCH_MS, clock=time.time_ns):
+        """:param clock: 返回纳秒时间的函数"""
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.epoch_ms = epoch_ms
+        self._clock = clock
+        self._worker_bits = worker_id << WORKER_SHIFT
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = self._clock() // 1_000_000 - self.epoch_ms
+            if now > self._last_ms:
+                if now >> TIMESTAMP_BITS:
+                    raise OverflowError("Timestamp exceeds the ID range")
+                self._last_ms = now
+                self._sequence = 0
+            else:
+                # 同一毫秒内或时钟回拨：沿用上一次的时间戳，序号用完时借用下一毫秒
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if not self._sequence:
+                    self._last_ms += 1
+                    if self._last_ms >> TIMESTAMP_BITS:
+                        raise OverflowError("Timestamp exceeds the ID range")
+            return (
+                (self._last_ms << TIMESTAMP_SHIFT) | self._worker_bits | self._sequence
+            )
+
+    def next_ids(self, count):
+        """一次生成 count 个递增的ID，只加一次锁，用于批量写入"""
+        ids = []
+        with self._lock:
+            now = self._clock() // 1_000_000 - self.epoch_ms
+            last_ms, sequence = self._last_ms, self._sequence
+            if now > last_ms:
+                last_ms, sequence = now, -1
+            while len(ids) < count:
+                # 当前毫秒剩余的序号一次用完
+                take = min(count - len(ids), MAX_SEQUENCE - sequence)
+                base = (last_ms << TIMESTAMP_SHIFT) | self._worker_bits
+                ids.extend(range(base + sequence + 1, base + sequence + 1 + take))
+                sequence += take
+                if len(ids) < count:
+                    last_ms, sequence = last_ms + 1, -1
+            if last_ms >> TIMESTAMP_BITS:
+                raise OverflowError("Timestamp exceeds the ID range")
+            self._last_ms, self._sequence = last_ms, sequence
+        return ids
+
+
+def parse_id(value, epoch_ms=EPOCH_MS):
+    """拆分ID，返回 (毫秒时间戳, 节点号, 序号)"""
+    value = int(value)
+    return (
+        (value >> TIMESTAMP_SHIFT) + epoch_ms,
+        (value >> WORKER_SHIFT) & MAX_WORKER_ID,
+        value & MAX_SEQUENCE,
+    )
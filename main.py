@@ -1,25 +1,54 @@
-# pip install flask flask-cors mysql-connector-python pydub pymediainfo ffmpeg-python librosa
-from flask import Flask, request, jsonify, send_from_directory
+# pip install flask flask-cors mysql-connector-python librosa
+from flask import (
+    Blueprint,
+    Flask,
+    request,
+    jsonify,
+    send_from_directory,
+    g,
+    has_request_context,
+    current_app,
+    Response,
+)
 from flask_cors import CORS
 import mysql.connector
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 import os
+import sys
+import subprocess
+import argparse
 from werkzeug.utils import secure_filename
-
-# 获取音频时长
-from pydub.utils import mediainfo
-import ffmpeg
-import librosa
+from werkzeug.http import http_date, is_resource_modified
+
+# 获取音频时长（librosa 只在文件头解析失败时才按需导入）
+from audio_probe import probe_duration
+from search_index import NgramIndex
+from id_generator import IdGenerator, MAX_WORKER_ID
+from serialization import json_provider
+from compression import ResponseCompressor
 import time
 import random
 import urllib.parse
 import shutil
-
-import time
-
-app = Flask(__name__)
-CORS(app)
+import threading
+import queue
+import sqlite3
+import json
+import uuid
+import hashlib
+import socket
+import multiprocessing
+import tempfile
+import mimetypes
+import base64
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+# 所有接口注册在蓝图上，由 create_app() 创建应用
+bp = Blueprint("main", __name__)
 
 # 配置上传文件夹
 UPLOAD_FOLDER = "user_avatars"
@@ -27,12 +56,19 @@ ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 UPLOAD_AUDIO_FOLDER = "static/audio"
 ALLOWED_AUDIO_EXTENSIONS = {"mp3", "wav", "flac"}
 
-# 检查上传文件夹是否存在
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# 按内容寻址的音频存储，相同内容的文件只保存一份
+BLOB_FOLDER = "static/blobs"
+BLOB_GC_GRACE = 3600  # 引用数归零后保留的时间（秒），期间重新上传相同内容可直接复用
+BLOB_GC_INTERVAL = 3600  # 垃圾回收任务的执行间隔（秒）
+# 没有登记引用的文件（如分析失败的上传）超过该时间后删除（秒）
+BLOB_ORPHAN_AGE = 24 * 3600
 
-if not os.path.exists(UPLOAD_AUDIO_FOLDER):
-    os.makedirs(UPLOAD_AUDIO_FOLDER)
+# 音频流接口：设置后由前端代理发送文件内容，接口只返回头部
+# None / "x-accel-redirect"（nginx）/ "x-sendfile"（Apache、lighttpd）
+AUDIO_SENDFILE_MODE = None
+# nginx 中指向 static 目录的 internal location
+AUDIO_ACCEL_PREFIX = "/protected-static/"
+AUDIO_STREAM_CHUNK_SIZE = 256 * 1024  # 不能零拷贝时每次读取的字节数
 
 # 数据库配置
 DB_CONFIG = {
@@ -43,6 +79,96 @@ DB_CONFIG = {
     "port": 3306,
 }
 
+# 连接池配置（每个工作进程一个连接池）
+DB_POOL_CONFIG = {
+    "pool_size": 5,  # 常驻连接数
+    "max_overflow": 10,  # 高峰期允许额外创建的连接数
+    "pool_timeout": 10,  # 等待空闲连接的最长时间（秒）
+    "idle_timeout": 300,  # 空闲超过该时间的连接在取出时重建（秒）
+    "pre_ping": True,  # 取出连接前做健康检查
+}
+
+# 用户信息缓存（每个进程一份），其他进程修改的用户信息最多在 TTL 后可见
+USER_CACHE_SIZE = 10000  # 最多缓存的用户数，0 表示不缓存
+USER_CACHE_TTL = 60  # 缓存有效期（秒）
+# 删除用户后用户名可以立即重新注册，各进程最多每隔该时间检查一次版本号并清空缓存（秒）
+USER_CACHE_REFRESH = 1
+
+# 一条 IN (...) 查询中最多的参数个数，超过时分批查询
+SQL_IN_CHUNK_SIZE = 500
+
+# 管理端搜索使用的进程内 n-gram 索引
+SEARCH_INDEX_ENABLED = True  # 关闭时退回到 LIKE 查询
+SEARCH_SYNC_INTERVAL = 2  # 增量同步新增行的最短间隔（秒）
+SEARCH_REBUILD_INTERVAL = 600  # 后台全量重建的间隔（秒），清理其他进程删除的行
+SEARCH_LOAD_BATCH = 5000  # 加载索引时每次查询的行数
+SEARCH_RESULT_CACHE = 64  # 缓存最近的搜索结果数（翻页时不用重新排序）
+
+# 管理端统计数据的计数器（app_counters、user_stats 表）
+STATS_COUNTER_SHARDS = 16  # 每个全局计数器分成多行，并发写入时不争同一行锁
+STATS_RECONCILE_INTERVAL = 3600  # 对账任务的执行间隔（秒）
+
+# 每个用户默认的存储额度（字节），None 表示不限制；users.storage_quota 可单独设置
+USER_STORAGE_QUOTA = 1024 * 1024 * 1024
+
+# 删除用户时只在一个事务中标记删除，音频记录、文件和目录由后台任务清理
+USER_PURGE_BATCH = 500  # 每个事务删除的音频记录数
+USER_PURGE_RETRY_INTERVAL = (
+    300  # 检查失败、中断的清理的间隔（秒），第 n 次重试至少间隔 n 倍
+)
+USER_PURGE_MAX_ATTEMPTS = 5
+
+# 上传歌曲的音乐ID使用 Snowflake 风格的 64 位ID（id_generator.py），每个进程一个工作节点号
+MUSIC_ID_WORKER = (
+    None  # 固定的节点号（只有一个进程时使用）；None 时从 id_workers 表租用
+)
+MUSIC_ID_LEASE = 600  # 节点号的租期（秒），过了三分之一时续租
+
+# JSON 序列化和响应压缩
+# serialization.PROVIDERS 中的名称，orjson 没有安装时使用 default
+JSON_PROVIDER = "orjson"
+# 按优先顺序，没有安装的编码被忽略；为空时不压缩
+COMPRESSION_ENCODINGS = ("zstd", "br", "gzip")
+COMPRESSION_MIN_SIZE = 1024  # 小于这个大小（字节）的响应不压缩，流式响应总是压缩
+COMPRESSION_LEVELS = None  # {编码: 压缩级别}，覆盖 compression.DEFAULT_LEVELS
+
+# 管理端列表分页
+ADMIN_PAGE_SIZE = 10  # 默认每页条数
+ADMIN_PAGE_SIZE_MAX = 100  # page_size 参数的上限
+
+# 用户歌单（/api/user/songs）的分页和流式输出
+USER_SONGS_PAGE_SIZE = 100  # 带 cursor / page_size 参数时的默认每页条数
+USER_SONGS_PAGE_SIZE_MAX = 1000
+USER_SONGS_STREAM_BATCH = 500  # 流式输出时每次从服务端游标读取、写出的行数
+PLAYLIST_BATCH_LIMIT = 500  # 批量加入、删除歌曲时一次最多的歌曲数
+PLAYLIST_CACHE_BYTES = (
+    32 * 1024 * 1024
+)  # 按版本号缓存的歌单响应体总大小上限，0 表示不缓存
+
+# 歌单变更日志（playlist_changes 表），用于 /api/user/songs/changes 增量同步
+PLAYLIST_CHANGES_RETENTION = (
+    30 * 24 * 3600
+)  # 变更记录保留时间（秒），更早的同步令牌需要全量同步
+PLAYLIST_CHANGES_COMPACT_INTERVAL = 3600  # 压缩任务的执行间隔（秒）
+PLAYLIST_CHANGES_BATCH = 5000  # 压缩时每个事务删除的记录数
+PLAYLIST_CHANGES_LIMIT = 5000  # 一次增量同步最多读取的变更记录数，超过时要求全量同步
+
+# 被禁用音乐ID的进程内缓存
+DISABLED_MUSIC_REFRESH = 2  # 检查 cache_versions 中版本号的最短间隔（秒）
+MUSIC_ID_CACHE_SIZE = 50000  # 缓存的 音乐ID -> global_music ID 对应关系数
+MUSIC_ID_CACHE_TTL = 3600  # 对应关系的有效期（秒）
+MUSIC_ID_NEGATIVE_TTL = 60  # 找不到对应 global_music 的ID的有效期（秒）
+MUSIC_STATUS_BATCH_LIMIT = 2000  # 批量查询禁用状态时一次最多的ID数
+
+# 后台任务配置
+JOB_DB_PATH = "instance/jobs.db"  # 本地任务表（SQLite）
+JOB_WORKERS = 2  # 每个进程的任务线程数
+JOB_RETENTION = 7 * 24 * 3600  # 已结束任务的保留时间（秒）
+UPLOAD_ASYNC_PROCESSING = True  # 上传后异步分析音频，接口立即返回任务ID
+
+# 音频分析（时长）进程池大小，默认等于 CPU 核数，设为 1 时在当前线程执行
+ANALYSIS_PROCESSES = os.cpu_count() or 1
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -59,6 +185,16 @@ def allowed_audio_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in allowed_extensions
 
 
+def uploaded_file_size(file):
+    """上传文件的字节数：请求体解析后文件已在内存或临时文件中，移到末尾即可得到大小"""
+    stream = file.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
 def save_file(file, folder, filename):
     """保存上传的文件"""
     if file and allowed_file(file.filename):
@@ -82,34 +218,6 @@ def save_file(file, folder, filename):
     return None
 
 
-def save_audio_file(file, username):
-    """保存上传的音频文件"""
-    if file and allowed_audio_file(file.filename):
-        try:
-            # 如果文件名有'/'，则以'/'为分隔符，取后面的部分作为文件名
-            original_filename = file.filename.split("/")[-1]
-            user_folder = os.path.join(UPLOAD_AUDIO_FOLDER, username)
-            file_path = os.path.join(user_folder, original_filename)
-
-            # 检查目录是否存在
-            os.makedirs(user_folder, exist_ok=True)
-
-            # 如果文件已存在，则跳过保存
-            if os.path.exists(file_path):
-                logger.info(
-                    f"File {original_filename} already exists for user {username}. Skipping save."
-                )
-                return None, None
-
-            # 保存文件
-            file.save(file_path)
-            return file_path, original_filename
-        except Exception as e:
-            logger.error(f"Error saving audio file for user {username}: {e}")
-            return None, None
-    return None, None
-
-
 def delete_audio_file(file_path, username):
     """删除音频文件"""
     try:
@@ -132,9 +240,23 @@ def delete_audio_file(file_path, username):
         return False
 
 
+def remove_file_quietly(file_path):
+    """删除文件，失败时只记录警告"""
+    if file_path and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            logger.warning(f"Failed to delete file: {file_path}")
+
+
 def get_audio_duration(file_path):
-    """获取音频时长（毫秒）"""
-    duration = librosa.get_duration(filename=file_path)
+    """获取音频时长（毫秒），优先从文件头解析，解析失败时才用 librosa 解码"""
+    duration = probe_duration(file_path)
+    if duration is None:
+        logger.info(f"Header probe failed for {file_path}, falling back to librosa")
+        import librosa
+
+        duration = librosa.get_duration(path=file_path)
     duration_ms = duration * 1000  # 转换为毫秒
     return int(duration_ms)
 
@@ -165,22 +287,434 @@ def get_audio_music_url():
         return None
 
 
+class PoolTimeoutError(Exception):
+    """等待空闲连接超时"""
+
+
+class PooledConnection:
+    """连接池借出的连接，close() 时归还连接池而不是断开"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """归还连接，重复调用无副作用"""
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    """
+    线程安全的数据库连接池。
+    常驻 pool_size 个连接，高峰期最多再溢出 max_overflow 个；
+    空闲超过 idle_timeout 的连接在取出时重建，pre_ping 时对空闲较久的连接做健康检查。
+    """
+
+    # 空闲时间不超过该值的连接跳过健康检查，避免每次取连接都多一次往返
+    PING_AFTER_IDLE = 5
+
+    def __init__(
+        self,
+        db_config,
+        pool_size=5,
+        max_overflow=10,
+        pool_timeout=10,
+        idle_timeout=300,
+        pre_ping=True,
+    ):
+        self.db_config = db_config
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.idle_timeout = idle_timeout
+        self.pre_ping = pre_ping
+
+        self._idle = deque()  # (conn, 归还时间)
+        self._opened = 0  # 已创建的连接数（包括借出和空闲的）
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "checkins": 0,
+            "connects": 0,
+            "recycled": 0,
+            "invalidated": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+        }
+
+    def connect(self):
+        """借出一个连接，没有空闲连接且已达上限时等待最多 pool_timeout 秒"""
+        conn, returned_at = None, None
+        wait_start = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    # 后进先出，优先复用最近用过的连接
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._opened < self.pool_size + self.max_overflow:
+                    self._opened += 1
+                    break
+                now = time.monotonic()
+                if wait_start is None:
+                    wait_start = now
+                    self._stats["waits"] += 1
+                remaining = self.pool_timeout - (now - wait_start)
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    self._stats["wait_time"] += now - wait_start
+                    raise PoolTimeoutError(
+                        f"No database connection available within {self.pool_timeout}s"
+                    )
+                self._cond.wait(remaining)
+            if wait_start is not None:
+                self._stats["wait_time"] += time.monotonic() - wait_start
+
+        # 建立连接和健康检查都在锁外进行
+        try:
+            if conn is not None:
+                conn = self._check_idle(conn, returned_at)
+            if conn is None:
+                conn = mysql.connector.connect(**self.db_config)
+                self._count("connects")
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+        self._count("checkouts")
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """归还连接；未结束的事务会被回滚，连接异常或空闲已满时直接关闭"""
+        healthy = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            healthy = False
+
+        with self._cond:
+            self._stats["checkins"] += 1
+            keep = healthy and len(self._idle) < self.pool_size
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._opened -= 1
+                if not healthy:
+                    self._stats["invalidated"] += 1
+            self._cond.notify()
+
+        if not keep:
+            self._close_quietly(conn)
+
+    def dispose(self):
+        """关闭所有空闲连接"""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        """连接池统计信息"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["wait_time"] = round(stats["wait_time"], 6)
+            stats["opened"] = self._opened
+            stats["idle"] = len(self._idle)
+            stats["checked_out"] = self._opened - len(self._idle)
+            stats["pool_size"] = self.pool_size
+            stats["max_overflow"] = self.max_overflow
+        return stats
+
+    def _check_idle(self, conn, returned_at):
+        """检查空闲连接是否可以复用，不能复用时关闭并返回 None"""
+        idle_for = time.monotonic() - returned_at
+        if self.idle_timeout and idle_for > self.idle_timeout:
+            self._count("recycled")
+            self._close_quietly(conn)
+            return None
+        if self.pre_ping and idle_for > self.PING_AFTER_IDLE:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                self._count("invalidated")
+                self._close_quietly(conn)
+                return None
+        return conn
+
+    def _count(self, key):
+        with self._cond:
+            self._stats[key] += 1
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def sql_in_placeholders(values):
+    """生成 IN (...) 使用的占位符"""
+    return ", ".join(["%s"] * len(values))
+
+
+def audio_music_id(value):
+    """
+    audio_files.music_id 是 BIGINT，与字符串参数比较时双方按浮点数比较，
+    64 位的音乐ID会丢失精度、匹配到相邻的ID，所以查询前转换成整数；不是整数时返回 None（不匹配任何行）
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def chunked(values, size=SQL_IN_CHUNK_SIZE):
+    """按 size 分批，用于限制 IN (...) 中的参数个数"""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(values, direction):
+    """把排序键的值编码成不透明的游标"""
+    values = [
+        value.isoformat(sep=" ") if isinstance(value, datetime) else value
+        for value in values
+    ]
+    raw = json.dumps({"k": values, "d": direction}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """返回 (排序键的值, 方向)，游标无效时抛出 InvalidCursorError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        values, direction = data["k"], data["d"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursorError("Invalid cursor") from e
+    if direction not in ("next", "prev") or not isinstance(values, list):
+        raise InvalidCursorError("Invalid cursor")
+    return values, direction
+
+
+def parse_page_size(default=ADMIN_PAGE_SIZE, maximum=ADMIN_PAGE_SIZE_MAX):
+    """读取 page_size 参数，限制在 1 ~ maximum 之间"""
+    page_size = int(request.args.get("page_size", default))
+    return max(1, min(page_size, maximum))
+
+
+def keyset_page(select, conditions, params, keys, cursor, page_size):
+    """
+    键集分页：按 keys 降序排列，用上一页边界的键值代替 OFFSET，翻到多深都只扫描一页的行。
+    :param select: 不带 WHERE / ORDER BY 的查询
+    :param conditions: WHERE 条件列表，params 为对应的参数
+    :param keys: [(SQL 列, 结果行中的字段)]，最后一列需要唯一
+    :param cursor: 上一次返回的 next_cursor / prev_cursor，第一页为 None
+    :return: (rows, next_cursor, prev_cursor)
+    """
+    conditions = list(conditions)
+    params = list(params)
+    direction = "next"
+    if cursor:
+        values, direction = decode_cursor(cursor)
+        if len(values) != len(keys):
+            raise InvalidCursorError("Invalid cursor")
+        # (a, b) < (x, y) 展开成 a < x OR (a = x AND b < y)，可以使用 (a, b) 索引
+        op = "<" if direction == "next" else ">"
+        clauses = []
+        for i, (column, _) in enumerate(keys):
+            equal = [f"{keys[j][0]} = %s" for j in range(i)]
+            clauses.append("(" + " AND ".join(equal + [f"{column} {op} %s"]) + ")")
+            params.extend(values[:i] + [values[i]])
+        conditions.append("(" + " OR ".join(clauses) + ")")
+
+    order = "DESC" if direction == "next" else "ASC"
+    query = select
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY " + ", ".join(f"{column} {order}" for column, _ in keys)
+    query += " LIMIT %s"
+    params.append(page_size + 1)
+
+    rows = DatabaseManager.execute_query(query, tuple(params), fetch=True)
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == "prev":
+        rows.reverse()
+    if not rows:
+        return rows, None, None
+
+    def key_of(row):
+        return [row[field] for _, field in keys]
+
+    if direction == "next":
+        next_cursor = encode_cursor(key_of(rows[-1]), "next") if has_more else None
+        prev_cursor = encode_cursor(key_of(rows[0]), "prev") if cursor else None
+    else:
+        next_cursor = encode_cursor(key_of(rows[-1]), "next")
+        prev_cursor = encode_cursor(key_of(rows[0]), "prev") if has_more else None
+    return rows, next_cursor, prev_cursor
+
+
+def estimate_total(table, select=None, conditions=(), params=()):
+    """
+    估算行数，不做 COUNT(*)：没有条件时读 information_schema 中 InnoDB 的统计值，
+    有条件时读 EXPLAIN 中优化器估算的行数
+    """
+    if not conditions:
+        query = """
+            SELECT TABLE_ROWS FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """
+        result = DatabaseManager.execute_query(query, (table,), fetch=True)
+        return int(result[0]["TABLE_ROWS"] or 0) if result else 0
+
+    query = "EXPLAIN " + select + " WHERE " + " AND ".join(conditions)
+    result = DatabaseManager.execute_query(query, tuple(params), fetch=True)
+    if not result:
+        return 0
+    # 第一行是驱动表：扫描行数 × 条件过滤后剩下的比例
+    row = result[0]
+    return int((row.get("rows") or 0) * float(row.get("filtered") or 100) / 100)
+
+
 class DatabaseManager:
+    _db_config = DB_CONFIG
+    _pool_config = DB_POOL_CONFIG
+    _pool = None
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+
+    @staticmethod
+    def configure(db_config, pool_config):
+        """设置数据库和连接池配置，已有的连接池会被关闭并按新配置重建"""
+        with DatabaseManager._pool_lock:
+            if DatabaseManager._pool is not None:
+                DatabaseManager._pool.dispose()
+            DatabaseManager._db_config = db_config
+            DatabaseManager._pool_config = pool_config
+            DatabaseManager._pool = None
+            DatabaseManager._pool_pid = None
+
+    @staticmethod
+    def get_pool():
+        """获取当前进程的连接池，fork 出的工作进程会创建自己的连接池"""
+        pid = os.getpid()
+        if DatabaseManager._pool is None or DatabaseManager._pool_pid != pid:
+            with DatabaseManager._pool_lock:
+                if DatabaseManager._pool is None or DatabaseManager._pool_pid != pid:
+                    DatabaseManager._pool = ConnectionPool(
+                        DatabaseManager._db_config, **DatabaseManager._pool_config
+                    )
+                    DatabaseManager._pool_pid = pid
+        return DatabaseManager._pool
+
     @staticmethod
     def get_connection():
-        """获取数据库连接"""
+        """从连接池获取数据库连接，调用 close() 归还"""
         try:
-            # logger.info("Attempting to connect to database...")
-            conn = mysql.connector.connect(**DB_CONFIG)
-            # logger.info("Database connection successful")
-            return conn
+            return DatabaseManager.get_pool().connect()
         except Exception as e:
             logger.error(f"Database connection error: {e}")
             raise
 
+    @staticmethod
+    def pool_stats():
+        """当前进程连接池的统计信息"""
+        return DatabaseManager.get_pool().stats()
+
+    @staticmethod
+    def current_session():
+        """
+        当前的数据库会话。
+        请求内为绑定在 g 上的请求级会话，请求外为 transaction() 开启的会话，都没有时返回 None
+        """
+        if has_request_context():
+            if "db_session" not in g:
+                g.db_session = DatabaseSession()
+            return g.db_session
+        return getattr(_session_local, "session", None)
+
+    @staticmethod
+    @contextmanager
+    def transaction():
+        """在请求之外（后台任务、命令行）开启事务；已在会话中时直接复用当前会话"""
+        session = DatabaseManager.current_session()
+        if session is not None:
+            yield session
+            return
+
+        session = DatabaseSession()
+        _session_local.session = session
+        try:
+            yield session
+            if session.failed:
+                session.rollback()
+            else:
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            _session_local.session = None
+            session.close()
+
+    @staticmethod
+    def after_commit(callback):
+        """事务提交后执行 callback（删除文件等不可回滚的操作），不在会话中时立即执行"""
+        session = DatabaseManager.current_session()
+        if session is None:
+            callback()
+        else:
+            session.after_commit(callback)
+
+    @staticmethod
+    def after_rollback(callback):
+        """会话回滚时执行 callback（清理已写入的文件等），不在会话中时忽略"""
+        session = DatabaseManager.current_session()
+        if session is not None:
+            session.after_rollback(callback)
+
+    @staticmethod
+    def execute_many(query, seq_params):
+        """批量执行同一条语句，INSERT 会被合并成一条多行插入"""
+        seq_params = list(seq_params)
+        if not seq_params:
+            return 0
+        with DatabaseManager.transaction() as session:
+            return session.execute_many(query, seq_params)
+
     @staticmethod
     def execute_query(query, params=None, fetch=False):
-        """执行数据库查询"""
+        """执行数据库查询，在会话中时使用会话的连接和事务"""
+        session = DatabaseManager.current_session()
+        if session is not None:
+            return session.execute(query, params, fetch)
+
         conn = None
         cursor = None
         try:
@@ -210,6 +744,309 @@ class DatabaseManager:
                 conn.close()
 
 
+# transaction() 开启的会话，按线程隔离
+_session_local = threading.local()
+
+
+class DatabaseSession:
+    """
+    工作单元：会话内的所有语句共用一个连接和一个事务。
+    第一次执行语句时才从连接池借出连接，由 commit()/rollback() 统一结束事务。
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.statement_count = 0
+        self.failed = False
+        self._after_commit = []
+        self._after_rollback = []
+
+    def execute(self, query, params=None, fetch=False):
+        """执行一条语句，失败时标记会话，结束时整体回滚"""
+        if self.conn is None:
+            self.conn = DatabaseManager.get_connection()
+        cursor = self.conn.cursor(dictionary=True)
+        self.statement_count += 1
+        try:
+            cursor.execute(query, params or ())
+            if fetch:
+                return cursor.fetchall()
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Query execution error: {e}")
+            self.failed = True
+            raise
+        finally:
+            cursor.close()
+
+    def execute_many(self, query, seq_params):
+        """批量执行同一条语句，返回影响的行数"""
+        if self.conn is None:
+            self.conn = DatabaseManager.get_connection()
+        cursor = self.conn.cursor()
+        self.statement_count += 1
+        try:
+            cursor.executemany(query, seq_params)
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Batch execution error: {e}")
+            self.failed = True
+            raise
+        finally:
+            cursor.close()
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    def after_rollback(self, callback):
+        self._after_rollback.append(callback)
+
+    def commit(self):
+        """提交事务并执行提交后回调"""
+        if self.conn is not None:
+            self.conn.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        self._after_rollback = []
+        self._run_callbacks(callbacks)
+
+    def rollback(self):
+        """回滚事务并执行回滚回调，丢弃提交后回调"""
+        self._after_commit = []
+        if self.conn is not None:
+            try:
+                self.conn.rollback()
+            except Exception as e:
+                logger.error(f"Rollback error: {e}")
+        callbacks, self._after_rollback = self._after_rollback, []
+        self._run_callbacks(callbacks)
+
+    @staticmethod
+    def _run_callbacks(callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Transaction callback error: {e}")
+
+    def close(self):
+        """归还连接，未提交的事务由连接池回滚"""
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            conn.close()
+
+
+@bp.after_app_request
+def finish_db_session(response):
+    """请求结束时统一提交或回滚（在响应发出之前）"""
+    session = g.get("db_session")
+    if session is None:
+        return response
+
+    if session.failed or response.status_code >= 500:
+        session.rollback()
+    else:
+        try:
+            session.commit()
+        except Exception as e:
+            logger.error(f"Commit error: {e}")
+            session.rollback()
+            response = jsonify({"error": "Failed to commit transaction"})
+            response.status_code = 500
+
+    response.headers["X-DB-Statements"] = str(session.statement_count)
+    return response
+
+
+@bp.teardown_app_request
+def close_db_session(exc):
+    """归还请求占用的连接，未处理的异常不会经过 after_request，这里负责回滚"""
+    session = g.pop("db_session", None)
+    if session is not None:
+        if exc is not None:
+            session.rollback()
+        session.close()
+
+
+class UserCache:
+    """
+    users 表行的进程内缓存（LRU + TTL），可按用户名或用户ID查找。
+    修改用户的地方需要调用 UserService.invalidate_user。
+
+    删除用户后用户名可以立即重新注册，其他进程缓存的旧行不能等到 TTL 过期：
+    删除时 cache_versions 中的版本号在同一事务中加一，各进程最多每 refresh_interval 秒检查一次，
+    变化时重新加载最近删除的用户ID（user_purges 中 2 * TTL 内登记的），
+    缓存中这些用户的行被清除，之后也不再放入（请求的快照可能早于删除）。
+    """
+
+    NAME = "users"
+
+    def __init__(self):
+        self.max_size = USER_CACHE_SIZE
+        self.ttl = USER_CACHE_TTL
+        self.refresh_interval = USER_CACHE_REFRESH
+        self._rows = OrderedDict()  # 用户名 -> (过期时间, 行)
+        self._ids = {}  # 用户ID -> 用户名
+        self._version = None
+        self._deleted_ids = frozenset()
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "version_checks": 0,
+        }
+
+    def configure(self, max_size, ttl, refresh_interval):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self.refresh_interval = refresh_interval
+            self._rows.clear()
+            self._ids.clear()
+            self._version = None
+            self._deleted_ids = frozenset()
+            self._checked_at = 0.0
+
+    def get(self, username):
+        self._refresh()
+        with self._lock:
+            return self._get(username)
+
+    def get_by_id(self, user_id):
+        self._refresh()
+        with self._lock:
+            username = self._ids.get(user_id)
+            if username is None:
+                self._stats["misses"] += 1
+                return None
+            return self._get(username)
+
+    def put(self, row):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if self._version is None or row["id"] in self._deleted_ids:
+                return
+            self._remove(row["username"])
+            self._rows[row["username"]] = (time.monotonic() + self.ttl, dict(row))
+            self._ids[row["id"]] = row["username"]
+            while len(self._rows) > self.max_size:
+                oldest = next(iter(self._rows))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, username=None, user_id=None):
+        with self._lock:
+            if user_id is not None and username is None:
+                username = self._ids.get(user_id)
+            if username is not None and self._remove(username):
+                self._stats["invalidations"] += 1
+
+    def bump(self):
+        """删除用户时调用，需要和 user_purges 的登记在同一个事务中"""
+        query = """
+            INSERT INTO cache_versions (name, version) VALUES (%s, 1)
+            ON DUPLICATE KEY UPDATE version = version + 1
+        """
+        DatabaseManager.execute_query(query, (self.NAME,))
+        DatabaseManager.after_commit(self._expire)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": (
+                    round(self._stats["hits"] / lookups, 4) if lookups else None
+                ),
+                "size": len(self._rows),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "refresh_interval": self.refresh_interval,
+                "deleted_ids": len(self._deleted_ids),
+            }
+
+    def _expire(self):
+        """下次访问时立即检查版本号"""
+        self._checked_at = 0.0
+
+    def _refresh(self):
+        """
+        版本号变化时重新加载最近删除的用户ID。
+        查询失败时清空缓存并停止缓存（_version 为 None），下次访问时重试
+        """
+        if (
+            self.max_size <= 0
+            or time.monotonic() - self._checked_at < self.refresh_interval
+        ):
+            return
+        # 其他线程正在检查时直接使用缓存，只有第一次加载需要等待
+        if not self._refresh_lock.acquire(blocking=self._version is None):
+            return
+        try:
+            if time.monotonic() - self._checked_at < self.refresh_interval:
+                return
+            self._stats["version_checks"] += 1
+            try:
+                query = "SELECT version FROM cache_versions WHERE name = %s"
+                result = DatabaseManager.execute_query(query, (self.NAME,), fetch=True)
+                version = result[0]["version"] if result else 0
+                deleted_ids = self._deleted_ids
+                if version != self._version:
+                    # 先读版本号再读用户ID，用户ID至少和版本号一样新
+                    query = """
+                        SELECT user_id FROM user_purges
+                        WHERE created_at >= NOW() - INTERVAL %s SECOND
+                    """
+                    rows = DatabaseManager.execute_query(
+                        query, (2 * self.ttl,), fetch=True
+                    )
+                    deleted_ids = frozenset(row["user_id"] for row in rows)
+            except Exception as e:
+                logger.error(f"Error refreshing user cache: {e}")
+                with self._lock:
+                    self._rows.clear()
+                    self._ids.clear()
+                    self._version = None
+                self._checked_at = 0.0
+                return
+            with self._lock:
+                for user_id in deleted_ids & self._ids.keys():
+                    self._remove(self._ids[user_id])
+                    self._stats["invalidations"] += 1
+                self._version = version
+                self._deleted_ids = deleted_ids
+            self._checked_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def _get(self, username):
+        entry = self._rows.get(username)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(username)
+            self._stats["misses"] += 1
+            return None
+        self._rows.move_to_end(username)
+        self._stats["hits"] += 1
+        # 返回副本，调用方修改不影响缓存
+        return dict(entry[1])
+
+    def _remove(self, username):
+        entry = self._rows.pop(username, None)
+        if entry is None:
+            return False
+        if self._ids.get(entry[1]["id"]) == username:
+            del self._ids[entry[1]["id"]]
+        return True
+
+
+user_cache = UserCache()
+
+
 class UserService:
     @staticmethod
     def create_user(username, password, security_question, security_answer):
@@ -226,23 +1063,70 @@ class UserService:
                 VALUES (%s, %s, %s, %s)
             """
             params = (username, password, security_question, security_answer)
-            return DatabaseManager.execute_query(query, params)
+            result = DatabaseManager.execute_query(query, params)
+            counters.add(users=1)
+            user_search.changed()
+            return result
         except Exception as e:
             logger.error(f"Error creating user: {e}")
             return None
 
     @staticmethod
-    def get_user_by_username(username):
-        """通过用户名获取用户信息"""
+    def storage_quota(user):
+        """用户的存储额度（字节），没有单独设置时使用 USER_STORAGE_QUOTA，None 表示不限制"""
+        if user.get("storage_quota") is not None:
+            return int(user["storage_quota"])
+        return current_app.config["USER_STORAGE_QUOTA"]
+
+    @staticmethod
+    def get_user_by_username(username, use_cache=True):
+        """
+        通过用户名获取用户信息。
+        校验密码、安全问题时 use_cache=False，不使用其他进程可能还没过期的旧数据
+        """
+        if use_cache:
+            user = user_cache.get(username)
+            if user is not None:
+                return user
         try:
-            query = "SELECT * FROM users WHERE username = %s"
-            params = (username,)
-            result = DatabaseManager.execute_query(query, params, fetch=True)
-            return result[0] if result else None
+            result = DatabaseManager.execute_query(
+                USER_BY_USERNAME_QUERY, (username,), fetch=True
+            )
+            if not result:
+                return None
+            user_cache.put(result[0])
+            return result[0]
         except Exception as e:
             logger.error(f"Error getting user: {e}")
             return None
 
+    @staticmethod
+    def get_user_by_id(user_id):
+        """通过用户ID获取用户信息"""
+        user = user_cache.get_by_id(user_id)
+        if user is not None:
+            return user
+        try:
+            query = "SELECT * FROM users WHERE id = %s AND deleted_at IS NULL"
+            result = DatabaseManager.execute_query(query, (user_id,), fetch=True)
+            if not result:
+                return None
+            user_cache.put(result[0])
+            return result[0]
+        except Exception as e:
+            logger.error(f"Error getting user {user_id}: {e}")
+            return None
+
+    @staticmethod
+    def invalidate_user(username=None, user_id=None):
+        """
+        修改用户后清除缓存。事务结束时再清除一次：
+        提交前其他请求可能把旧数据放回缓存，回滚时缓存中可能是未提交的数据
+        """
+        user_cache.invalidate(username, user_id)
+        DatabaseManager.after_commit(lambda: user_cache.invalidate(username, user_id))
+        DatabaseManager.after_rollback(lambda: user_cache.invalidate(username, user_id))
+
     @staticmethod
     def update_user_profile(username, nickname=None, intro=None):
         """更新用户资料"""
@@ -264,7 +1148,9 @@ class UserService:
             query = f"UPDATE users SET {', '.join(updates)} WHERE username = %s"
             params.append(username)
 
-            return DatabaseManager.execute_query(query, params)
+            result = DatabaseManager.execute_query(query, params)
+            UserService.invalidate_user(username)
+            return result
         except Exception as e:
             logger.error(f"Error updating profile: {e}")
             return None
@@ -279,7 +1165,9 @@ class UserService:
         :return: 更新结果
         """
         try:
-            user = UserService.get_user_by_username(username)
+            user = UserService.get_user_by_username(
+                username, use_cache=old_password is None
+            )
             if not user:
                 return None
 
@@ -290,7 +1178,9 @@ class UserService:
             # 更新密码
             query = "UPDATE users SET password = %s WHERE username = %s"
             params = (new_password, username)
-            return DatabaseManager.execute_query(query, params)
+            result = DatabaseManager.execute_query(query, params)
+            UserService.invalidate_user(username)
+            return result
         except Exception as e:
             logger.error(f"Error updating password: {e}")
             return None
@@ -301,14 +1191,16 @@ class UserService:
         try:
             query = "UPDATE users SET avatar_url = %s WHERE username = %s"
             params = (avatar_url, username)
-            return DatabaseManager.execute_query(query, params)
+            result = DatabaseManager.execute_query(query, params)
+            UserService.invalidate_user(username)
+            return result
         except Exception as e:
             logger.error(f"Error updating avatar: {e}")
             return None
 
     @staticmethod
     def delete_user_from_db(username):
-        """删除用户"""
+        """删除用户（标记删除，音频记录和文件由 user_purge 任务清理）"""
         try:
             # 检查用户是否存在
             user = UserService.get_user_by_username(username)
@@ -316,11 +1208,8 @@ class UserService:
                 logger.error(f"User {username} not found")
                 return False
 
-            # 删除用户
-            query = "DELETE FROM users WHERE username = %s"
-            params = (username,)
-            result = DatabaseManager.execute_query(query, params)
-            if result:
+            # 标记删除，数据由后台任务清理
+            if user_purges.tombstone(user):
                 logger.info(f"User {username} deleted successfully")
                 return True
             else:
@@ -339,29 +1228,2203 @@ class UserService:
             if not user:
                 return False
 
-            user_id = user["id"]
+            user_id = user["id"]
+
+            # 删除用户头像
+            folder_path = "./user_avatars/test_api"
+            if os.path.exists(folder_path):
+                shutil.rmtree(folder_path)
+
+            # 删除用户数据，并释放文件引用
+            query = "SELECT id, user_id, file_path, file_size, content_hash FROM audio_files WHERE user_id = %s"
+            params = (user_id,)
+            rows = DatabaseManager.execute_query(query, params, fetch=True)
+            PlaylistService.touch_tracks((row["id"] for row in rows), "remove")
+            query = "DELETE FROM audio_files WHERE user_id = %s"
+            result = DatabaseManager.execute_query(query, params)
+            BlobStore.release(rows, remove_legacy=False)
+            counters.remove_files(rows)
+            if result:
+                logger.info(f"User data for {user_id} deleted successfully")
+                return True
+            else:
+                logger.error(f"Failed to delete user data for {user_id}")
+                return False
+        except Exception as e:
+            logger.error(f"Error deleting user data for {user_id}: {e}")
+            return False
+
+
+# 热点查询的 SQL，处理函数和 check_query_plans（HOT_QUERIES）共用同一份；
+# {...} 为 IN 列表的占位符，使用时按参数个数填入 sql_in_placeholders()
+USER_BY_USERNAME_QUERY = (
+    "SELECT * FROM users WHERE username = %s AND deleted_at IS NULL"
+)
+PLAYLIST_VERSION_QUERY = (
+    "SELECT version FROM playlist_versions WHERE user_id = %s AND playlist_type = %s"
+)
+PLAYLIST_LISTED_QUERY = """
+    SELECT track_id FROM playlist_entries
+    WHERE user_id = %s AND playlist_type = %s AND track_id IN ({track_ids})
+    FOR UPDATE
+"""
+PLAYLIST_END_QUERY = """
+    SELECT COALESCE(MAX(position), 0) AS position FROM playlist_entries
+    WHERE user_id = %s AND playlist_type = %s FOR UPDATE
+"""
+STILL_LISTED_QUERY = (
+    "SELECT DISTINCT track_id FROM playlist_entries WHERE track_id IN ({track_ids})"
+)
+PLAYLIST_CHANGES_QUERY = """
+    SELECT track_id, op, music_id FROM playlist_changes
+    WHERE user_id = %s AND playlist_type = %s AND version > %s AND version <= %s
+    ORDER BY version, id LIMIT %s
+"""
+TRACKS_BY_HASH_QUERY = """
+    SELECT af.id, af.music_id, af.duration, af.file_size, af.content_hash,
+           pe.track_id IS NOT NULL AS in_playlist
+    FROM audio_files af
+    LEFT JOIN playlist_entries pe
+      ON pe.user_id = af.user_id AND pe.playlist_type = %s AND pe.track_id = af.id
+    WHERE af.user_id = %s AND af.content_hash IN ({hashes})
+"""
+API_TRACK_QUERY = """
+    SELECT id FROM audio_files
+    WHERE user_id = %s AND music_id = %s AND is_api_music = TRUE LIMIT 1
+"""
+PLAYLIST_TRACK_BY_FILENAME_QUERY = """
+    SELECT af.id FROM playlist_entries pe
+    JOIN audio_files af ON af.id = pe.track_id
+    WHERE pe.user_id = %s AND pe.playlist_type = %s AND af.user_id = %s AND af.filename = %s
+"""
+PLAYLIST_TRACKS_BY_MUSIC_QUERY = """
+    SELECT af.* FROM playlist_entries pe
+    JOIN audio_files af ON af.id = pe.track_id
+    WHERE pe.user_id = %s AND pe.playlist_type = %s AND af.user_id = %s AND af.music_id = %s
+"""
+TRACKS_BY_NAME_QUERY = (
+    "SELECT * FROM audio_files WHERE user_id = %s AND filename LIKE %s"
+)
+# 批量加入时每首歌一个，用 UNION ALL 合并
+TRACK_BY_NAME_PROBE = "(SELECT %s AS idx, id FROM audio_files WHERE user_id = %s AND filename LIKE %s LIMIT 1)"
+AUDIO_PATH_QUERY = (
+    "SELECT file_path, content_hash FROM audio_files WHERE music_id = %s LIMIT 1"
+)
+GLOBAL_MUSIC_IDS_QUERY = (
+    "SELECT music_id FROM global_music WHERE music_id IN ({music_ids})"
+)
+# 单个ID的最后一步模糊匹配（沿用原接口的行为），要扫描整个 music_id 索引，
+# 在 PLAN_CHECK_ALLOWED_SCANS 中登记
+MUSIC_ID_SUBSTRING_QUERY = (
+    "SELECT music_id FROM global_music WHERE music_id LIKE %s LIMIT 1"
+)
+USER_GLOBAL_MUSIC_QUERY = (
+    "SELECT * FROM global_music WHERE music_id = %s AND user_id = %s"
+)
+# 连接时把整数转换成字符串，才能使用 global_music.music_id 的唯一索引
+# （字符串列与整数比较时按数字比较，每一行都要扫描 global_music）
+REFERENCE_LOOKUP_QUERY = """
+    SELECT pe.reference_id AS requested_id, gm.music_id
+    FROM playlist_entries pe
+    JOIN audio_files af ON af.id = pe.track_id
+    JOIN global_music gm ON gm.music_id = CAST(af.music_id AS CHAR)
+    WHERE pe.reference_id IN ({reference_ids})
+"""
+AUDIO_MUSIC_LOOKUP_QUERY = """
+    SELECT af.music_id AS requested_id, gm.music_id
+    FROM audio_files af
+    JOIN global_music gm ON gm.music_id = CAST(af.music_id AS CHAR)
+    WHERE af.music_id IN ({music_ids})
+"""
+DISABLED_MUSIC_QUERY = "SELECT music_id FROM global_music WHERE is_disabled = TRUE"
+UPLOADED_MUSIC_TOTALS_QUERY = """
+    SELECT COUNT(*) AS count, COALESCE(SUM(file_size), 0) AS total
+    FROM global_music WHERE user_id = %s AND is_api_music = FALSE
+"""
+
+
+class PlaylistService:
+    """
+    歌单成员关系：audio_files 每首歌曲只有一行，playlist_entries 记录歌曲在哪些歌单中以及顺序。
+    同一首歌加入多个歌单时只增加一行 playlist_entries，不再复制整行歌曲信息。
+    删除 audio_files 的行时成员关系随外键一起删除。
+    修改歌单成员之前先锁住歌单的 playlist_versions 行，同一歌单的修改依次进行。
+    """
+
+    @staticmethod
+    def lock(user_id, playlist_type):
+        """
+        锁住歌单的 playlist_versions 行（不存在时创建），需要在事务中调用。
+        空歌单没有 playlist_entries 的行可以锁，只能加间隙锁，并发的第一次追加会互相死锁
+        """
+        query = """
+            INSERT INTO playlist_versions (user_id, playlist_type, version) VALUES (%s, %s, 0)
+            ON DUPLICATE KEY UPDATE version = version
+        """
+        DatabaseManager.execute_query(query, (user_id, playlist_type))
+        DatabaseManager.execute_query(
+            PLAYLIST_VERSION_QUERY + " FOR UPDATE", (user_id, playlist_type), fetch=True
+        )
+
+    @staticmethod
+    def listed(user_id, playlist_type, track_ids):
+        """歌曲中已在歌单中的歌曲ID，加锁读取最新提交的数据；需要先调用 lock()"""
+        listed = set()
+        for chunk in chunked(list(track_ids)):
+            query = PLAYLIST_LISTED_QUERY.format(track_ids=sql_in_placeholders(chunk))
+            rows = DatabaseManager.execute_query(
+                query, (user_id, playlist_type, *chunk), fetch=True
+            )
+            listed.update(row["track_id"] for row in rows)
+        return listed
+
+    @staticmethod
+    def add(user_id, playlist_type, entries):
+        """
+        把歌曲按顺序追加到歌单末尾，已在歌单中的歌曲跳过，返回追加的歌曲数。
+        只为实际追加的歌曲记录变化。
+        :param entries: 歌曲ID列表，或 (歌曲ID, 引用ID) 列表
+        """
+        if not entries:
+            return 0
+        entries = [
+            entry if isinstance(entry, tuple) else (entry, None) for entry in entries
+        ]
+        PlaylistService.lock(user_id, playlist_type)
+        listed = PlaylistService.listed(
+            user_id, playlist_type, {track_id for track_id, _ in entries}
+        )
+        result = DatabaseManager.execute_query(
+            PLAYLIST_END_QUERY, (user_id, playlist_type), fetch=True
+        )
+        position = result[0]["position"] if result else 0
+        rows = []
+        for track_id, reference_id in entries:
+            # 同一批中重复的歌曲只追加第一个
+            if track_id in listed:
+                continue
+            listed.add(track_id)
+            position += 1
+            rows.append((user_id, playlist_type, track_id, position, reference_id))
+        if not rows:
+            return 0
+        query = """
+            INSERT INTO playlist_entries (user_id, playlist_type, track_id, position, reference_id)
+            VALUES (%s, %s, %s, %s, %s)
+        """
+        DatabaseManager.execute_many(query, rows)
+        PlaylistService.changed(
+            [(user_id, playlist_type, "add", row[2], None) for row in rows]
+        )
+        return len(rows)
+
+    @staticmethod
+    def remove(user_id, playlist_type, tracks):
+        """
+        从歌单中移除歌曲，返回不再属于任何歌单的歌曲（调用方删除歌曲行、释放文件）。
+        已经不在歌单中的歌曲（如被同时进行的请求移除）跳过，不记录变化，也不返回。
+        :param tracks: audio_files 的行，需要包含 id
+        """
+        if not tracks:
+            return []
+        PlaylistService.lock(user_id, playlist_type)
+        listed = PlaylistService.listed(
+            user_id, playlist_type, {track["id"] for track in tracks}
+        )
+        tracks = list(
+            {track["id"]: track for track in tracks if track["id"] in listed}.values()
+        )
+        if not tracks:
+            return []
+        track_ids = [track["id"] for track in tracks]
+        query = f"""
+            DELETE FROM playlist_entries
+            WHERE user_id = %s AND playlist_type = %s AND track_id IN ({sql_in_placeholders(track_ids)})
+        """
+        DatabaseManager.execute_query(query, (user_id, playlist_type, *track_ids))
+        PlaylistService.changed(
+            [
+                (user_id, playlist_type, "remove", track["id"], track.get("music_id"))
+                for track in tracks
+            ]
+        )
+        query = STILL_LISTED_QUERY.format(track_ids=sql_in_placeholders(track_ids))
+        rows = DatabaseManager.execute_query(query, track_ids, fetch=True)
+        still_listed = {row["track_id"] for row in rows}
+        return [track for track in tracks if track["id"] not in still_listed]
+
+    @staticmethod
+    def version(user_id, playlist_type):
+        """歌单的版本号，没有修改过的歌单为 0"""
+        result = DatabaseManager.execute_query(
+            PLAYLIST_VERSION_QUERY, (user_id, playlist_type), fetch=True
+        )
+        return result[0]["version"] if result else 0
+
+    @staticmethod
+    def changed(changes):
+        """
+        记录歌单的变化：歌单版本号加一，并在 playlist_changes 中追加变更记录，需要和修改在同一个事务中。
+        同一事务中的变更使用同一个版本号；版本号的行锁到提交时才释放，所以版本号的顺序就是提交的顺序。
+        :param changes: (用户ID, 歌单类型, 操作, 歌曲ID, 音乐ID) 列表，操作为 add / remove / update，
+                        add 的音乐ID可以为 None（同步时从歌曲行读取）
+        """
+        changes = [
+            (int(user_id), int(pt), op, track_id, music_id)
+            for user_id, pt, op, track_id, music_id in changes
+        ]
+        if not changes:
+            return
+        # 按主键顺序加锁，避免并发修改多个歌单时死锁
+        playlists = sorted({change[:2] for change in changes})
+        query = """
+            INSERT INTO playlist_versions (user_id, playlist_type, version) VALUES (%s, %s, 1)
+            ON DUPLICATE KEY UPDATE version = version + 1
+        """
+        DatabaseManager.execute_many(query, playlists)
+
+        versions = {}
+        for chunk in chunked(playlists):
+            conditions = " OR ".join(
+                ["(user_id = %s AND playlist_type = %s)"] * len(chunk)
+            )
+            query = f"SELECT user_id, playlist_type, version FROM playlist_versions WHERE {conditions}"
+            params = [value for playlist in chunk for value in playlist]
+            rows = DatabaseManager.execute_query(query, params, fetch=True)
+            versions.update(
+                ((row["user_id"], row["playlist_type"]), row["version"]) for row in rows
+            )
+        query = """
+            INSERT INTO playlist_changes (user_id, playlist_type, version, op, track_id, music_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        DatabaseManager.execute_many(
+            query,
+            [
+                (user_id, pt, versions[(user_id, pt)], op, track_id, music_id)
+                for user_id, pt, op, track_id, music_id in changes
+            ],
+        )
+
+    @staticmethod
+    def touch_tracks(track_ids, op="update"):
+        """
+        歌曲行被修改（update）或删除（remove，在删除之前调用）时，记录包含这些歌曲的歌单的变化
+        """
+        changes = []
+        for chunk in chunked(list(track_ids)):
+            query = f"""
+                SELECT pe.user_id, pe.playlist_type, pe.track_id, af.music_id
+                FROM playlist_entries pe
+                JOIN audio_files af ON af.id = pe.track_id
+                WHERE pe.track_id IN ({sql_in_placeholders(chunk)})
+            """
+            rows = DatabaseManager.execute_query(query, chunk, fetch=True)
+            changes += [
+                (
+                    row["user_id"],
+                    row["playlist_type"],
+                    op,
+                    row["track_id"],
+                    row["music_id"],
+                )
+                for row in rows
+            ]
+        PlaylistService.changed(changes)
+
+    @staticmethod
+    def tracks_by_hash(user_id, playlist_type, hashes):
+        """
+        用户已有的相同内容的歌曲，返回 {SHA-256: 行}，行中的 in_playlist 表示是否已在该歌单中
+        """
+        tracks = {}
+        for chunk in chunked(set(hashes)):
+            query = TRACKS_BY_HASH_QUERY.format(hashes=sql_in_placeholders(chunk))
+            rows = DatabaseManager.execute_query(
+                query, (playlist_type, user_id, *chunk), fetch=True
+            )
+            for row in rows:
+                # 旧数据中同一内容可能有多行，优先使用已在歌单中的
+                if row["content_hash"] not in tracks or row["in_playlist"]:
+                    tracks[row["content_hash"]] = row
+        return tracks
+
+    @staticmethod
+    def api_track(user_id, music_id):
+        """用户已添加过的API音乐的歌曲ID，没有时返回 None"""
+        result = DatabaseManager.execute_query(
+            API_TRACK_QUERY, (user_id, audio_music_id(music_id)), fetch=True
+        )
+        return result[0]["id"] if result else None
+
+
+class PlaylistCache:
+    """
+    /api/user/songs 完整响应体的进程内缓存（LRU，按总字节数限制）。
+    以 (用户ID, 歌单类型, 主机地址) 为键，保存生成时的版本号；
+    读取时版本号与 playlist_versions 中的不一致就丢弃，所以不需要在修改时通知各个进程。
+    """
+
+    def __init__(self):
+        self.max_bytes = PLAYLIST_CACHE_BYTES
+        self._bodies = OrderedDict()  # 键 -> (版本号, 响应体)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def configure(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._bodies.clear()
+            self._bytes = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._bodies.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self._remove(key)
+                self._stats["misses"] += 1
+                return None
+            self._bodies.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, version, body):
+        # 单个响应超过上限的四分之一时不缓存，避免一个大歌单挤掉所有缓存
+        if len(body) * 4 > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._bodies[key] = (version, body)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._bodies)))
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": (
+                    round(self._stats["hits"] / lookups, 4) if lookups else None
+                ),
+                "size": len(self._bodies),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key):
+        entry = self._bodies.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+
+playlist_cache = PlaylistCache()
+
+
+class PlaylistChanges:
+    """
+    歌单变更日志的读取和压缩。变更由 PlaylistService.changed 写入，每条记录带有当时的歌单版本号，
+    同步令牌就是版本号（/api/user/songs 响应头 X-Playlist-Version）。
+    超过保留时间的记录被删除，删除到的最大版本号记在 playlist_versions.compacted_version，
+    更早的令牌无法增量同步，需要全量同步。
+    """
+
+    def __init__(self):
+        self.retention = PLAYLIST_CHANGES_RETENTION
+        self.batch_size = PLAYLIST_CHANGES_BATCH
+        self.limit = PLAYLIST_CHANGES_LIMIT
+
+    def configure(self, retention, batch_size, limit):
+        self.retention = retention
+        self.batch_size = batch_size
+        self.limit = limit
+
+    def since(self, user_id, playlist_type, since):
+        """
+        返回 (当前版本号, 变更记录)；令牌早于压缩位置、晚于当前版本或变更过多时变更记录为 None（需要全量同步）。
+        同一首歌的多条记录只保留最后一条，变更记录为 [(歌曲ID, 操作, 音乐ID)]，按最后一次变化的顺序排列
+        """
+        query = """
+            SELECT version, compacted_version FROM playlist_versions
+            WHERE user_id = %s AND playlist_type = %s
+        """
+        result = DatabaseManager.execute_query(
+            query, (user_id, playlist_type), fetch=True
+        )
+        version, floor = (
+            (result[0]["version"], result[0]["compacted_version"]) if result else (0, 0)
+        )
+        if since < floor or since > version:
+            return version, None
+        if since == version:
+            return version, []
+
+        # 只读到当前版本号为止，与版本号在同一个快照中
+        rows = DatabaseManager.execute_query(
+            PLAYLIST_CHANGES_QUERY,
+            (user_id, playlist_type, since, version, self.limit + 1),
+            fetch=True,
+        )
+        if len(rows) > self.limit:
+            return version, None
+        latest = {}
+        for row in rows:
+            previous = latest.pop(row["track_id"], None)
+            music_id = row["music_id"]
+            if music_id is None and previous is not None:
+                music_id = previous[2]
+            latest[row["track_id"]] = (row["track_id"], row["op"], music_id)
+        return version, list(latest.values())
+
+    def compact(self):
+        """删除超过保留时间的变更记录，只在请求之外调用，返回删除的行数"""
+        removed = 0
+        while True:
+            with DatabaseManager.transaction():
+                query = """
+                    SELECT id, user_id, playlist_type, version FROM playlist_changes
+                    WHERE created_at < NOW() - INTERVAL %s SECOND
+                    ORDER BY id LIMIT %s FOR UPDATE
+                """
+                rows = DatabaseManager.execute_query(
+                    query, (self.retention, self.batch_size), fetch=True
+                )
+                if not rows:
+                    break
+                floors = {}
+                for row in rows:
+                    key = (row["user_id"], row["playlist_type"])
+                    floors[key] = max(floors.get(key, 0), row["version"])
+                query = """
+                    UPDATE playlist_versions SET compacted_version = GREATEST(compacted_version, %s)
+                    WHERE user_id = %s AND playlist_type = %s
+                """
+                DatabaseManager.execute_many(
+                    query,
+                    [
+                        (floor, user_id, pt)
+                        for (user_id, pt), floor in sorted(floors.items())
+                    ],
+                )
+                query = f"DELETE FROM playlist_changes WHERE id IN ({sql_in_placeholders(rows)})"
+                DatabaseManager.execute_query(query, [row["id"] for row in rows])
+            removed += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        if removed:
+            logger.info(f"Compacted {removed} playlist changes")
+        return removed
+
+
+playlist_changes = PlaylistChanges()
+
+
+class DisabledMusicRegistry:
+    """
+    被禁用音乐ID（global_music.is_disabled）的进程内集合。
+    版本号保存在 cache_versions 表中，禁用状态变化时在同一事务中加一；
+    各进程最多每 refresh_interval 秒查询一次版本号，变化时才重新加载集合。
+    """
+
+    NAME = "disabled_music"
+
+    def __init__(self):
+        self.refresh_interval = DISABLED_MUSIC_REFRESH
+        self.id_cache_size = MUSIC_ID_CACHE_SIZE
+        self.id_ttl = MUSIC_ID_CACHE_TTL
+        self.negative_ttl = MUSIC_ID_NEGATIVE_TTL
+        self._state = None  # (版本号, 被禁用的ID集合)
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._resolved = (
+            OrderedDict()
+        )  # 请求的ID -> (过期时间, global_music ID 或 None)
+        self._resolve_lock = threading.Lock()
+        self._stats = {"version_checks": 0, "reloads": 0, "id_hits": 0, "id_misses": 0}
+
+    def configure(self, refresh_interval, id_cache_size, id_ttl, negative_ttl):
+        self.refresh_interval = refresh_interval
+        self.id_cache_size = id_cache_size
+        self.id_ttl = id_ttl
+        self.negative_ttl = negative_ttl
+        self._state = None
+        with self._resolve_lock:
+            self._resolved.clear()
+
+    def snapshot(self):
+        """返回 (版本号, 被禁用的ID集合)"""
+        state = self._state
+        if (
+            state is None
+            or time.monotonic() - self._checked_at >= self.refresh_interval
+        ):
+            state = self._refresh()
+        return state
+
+    def is_disabled(self, music_id):
+        version, disabled_ids = self.snapshot()
+        resolved = self.resolve(music_id)
+        return version, resolved is not None and resolved in disabled_ids
+
+    def bump(self):
+        """禁用状态变化时调用，需要和修改在同一个事务中"""
+        query = """
+            INSERT INTO cache_versions (name, version) VALUES (%s, 1)
+            ON DUPLICATE KEY UPDATE version = version + 1
+        """
+        DatabaseManager.execute_query(query, (self.NAME,))
+        DatabaseManager.after_commit(self.invalidate)
+
+    def invalidate(self):
+        """下次访问时立即检查版本号"""
+        self._checked_at = 0.0
+
+    def resolve(self, music_id):
+        """
+        请求中的音乐ID对应的 global_music ID：先直接匹配，再通过 audio_files 的引用，最后模糊匹配
+        """
+        hit, resolved = self._cached(music_id)
+        if hit:
+            return resolved
+
+        # 直接匹配和引用匹配与批量解析相同，各自使用索引（reference_id OR music_id 用不上索引）
+        resolved = self._lookup([music_id]).get(music_id)
+        if resolved is None:
+            # 模糊匹配要扫描整个索引，只在前两步都没有结果时执行，结果同样会被缓存
+            result = DatabaseManager.execute_query(
+                MUSIC_ID_SUBSTRING_QUERY, (f"%{music_id}%",), fetch=True
+            )
+            resolved = result[0]["music_id"] if result else None
+        self._remember({music_id: resolved})
+        return resolved
+
+    def resolve_many(self, music_ids):
+        """
+        批量解析，返回 {请求的ID: global_music ID 或 None}。
+        每批ID只用两条集合查询（直接匹配、audio_files 引用），不做模糊匹配
+        """
+        resolved = {}
+        missing = []
+        for music_id in dict.fromkeys(music_ids):
+            hit, value = self._cached(music_id)
+            if hit:
+                resolved[music_id] = value
+            else:
+                missing.append(music_id)
+
+        found = self._lookup(missing)
+        fetched = {music_id: found.get(music_id) for music_id in missing}
+        self._remember(fetched)
+        resolved.update(fetched)
+        return resolved
+
+    @staticmethod
+    def _lookup(music_ids):
+        """直接匹配和歌单引用ID匹配，返回 {请求的ID: global_music ID}，找不到的不在结果中"""
+        found = {}
+        for chunk in chunked(music_ids):
+            query = GLOBAL_MUSIC_IDS_QUERY.format(music_ids=sql_in_placeholders(chunk))
+            rows = DatabaseManager.execute_query(query, chunk, fetch=True)
+            found.update((row["music_id"], row["music_id"]) for row in rows)
+
+            remaining = [music_id for music_id in chunk if music_id not in found]
+            if not remaining:
+                continue
+            # 两个 IN 分开查询再合并，各自可以使用索引；
+            # audio_files.music_id 是整数列，非数字的ID会被转换成 0，不参与匹配
+            numeric = [music_id for music_id in remaining if music_id.isdigit()]
+            query = REFERENCE_LOOKUP_QUERY.format(
+                reference_ids=sql_in_placeholders(remaining)
+            )
+            params = list(remaining)
+            if numeric:
+                query += " UNION " + AUDIO_MUSIC_LOOKUP_QUERY.format(
+                    music_ids=sql_in_placeholders(numeric)
+                )
+                params += [audio_music_id(music_id) for music_id in numeric]
+            rows = DatabaseManager.execute_query(query, params, fetch=True)
+            for row in rows:
+                found.setdefault(str(row["requested_id"]), row["music_id"])
+        return found
+
+    def statuses(self, music_ids):
+        """返回 (版本号, {ID: 是否被禁用})"""
+        version, disabled_ids = self.snapshot()
+        resolved = self.resolve_many(music_ids)
+        return version, {
+            music_id: value is not None and value in disabled_ids
+            for music_id, value in resolved.items()
+        }
+
+    def _cached(self, music_id):
+        """返回 (是否命中, global_music ID)"""
+        with self._resolve_lock:
+            entry = self._resolved.get(music_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._resolved.move_to_end(music_id)
+                self._stats["id_hits"] += 1
+                return True, entry[1]
+            self._stats["id_misses"] += 1
+            return False, None
+
+    def _remember(self, resolved):
+        now = time.monotonic()
+        with self._resolve_lock:
+            for music_id, value in resolved.items():
+                ttl = self.id_ttl if value is not None else self.negative_ttl
+                self._resolved[music_id] = (now + ttl, value)
+                self._resolved.move_to_end(music_id)
+            while len(self._resolved) > self.id_cache_size:
+                self._resolved.popitem(last=False)
+
+    def stats(self):
+        state = self._state
+        return {
+            **self._stats,
+            "version": state[0] if state else None,
+            "disabled": len(state[1]) if state else None,
+            "resolved_ids": len(self._resolved),
+        }
+
+    def _refresh(self):
+        # 其他线程正在刷新时先使用旧数据，只有第一次加载需要等待
+        if not self._lock.acquire(blocking=self._state is None):
+            return self._state
+        try:
+            if (
+                self._state is not None
+                and time.monotonic() - self._checked_at < self.refresh_interval
+            ):
+                return self._state
+            self._stats["version_checks"] += 1
+            query = "SELECT version FROM cache_versions WHERE name = %s"
+            result = DatabaseManager.execute_query(query, (self.NAME,), fetch=True)
+            version = result[0]["version"] if result else 0
+            if self._state is None or self._state[0] != version:
+                # 先读版本号再读集合，集合至少和版本号一样新
+                rows = DatabaseManager.execute_query(DISABLED_MUSIC_QUERY, fetch=True)
+                self._state = (version, frozenset(row["music_id"] for row in rows))
+                self._stats["reloads"] += 1
+            self._checked_at = time.monotonic()
+            return self._state
+        finally:
+            self._lock.release()
+
+
+disabled_music = DisabledMusicRegistry()
+
+
+def not_modified(etag):
+    """请求的 If-None-Match 与 etag 匹配时返回 304 响应，否则返回 None"""
+    if request.if_none_match.contains_weak(etag):
+        return Response(
+            status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+        )
+    return None
+
+
+def with_etag(response, etag):
+    """设置 ETag，并要求客户端每次使用缓存前重新验证"""
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+class TableSearchIndex:
+    """
+    把一张表的文本列加载到 NgramIndex 中的进程内搜索索引。
+    新增的行按 id 增量同步：最多每 sync_interval 秒一次，本进程写入提交后立即同步；
+    本进程的删除提交后立即从索引去掉。其他进程删除的行在回表查询时自然被过滤，
+    并由每 rebuild_interval 秒一次的后台全量重建清理。
+    """
+
+    def __init__(self, table, fields, attrs=(), condition=None):
+        """:param condition: 只加载满足条件的行，如未标记删除的用户"""
+        self.table = table
+        self.fields = tuple(fields)
+        self.attrs = tuple(attrs)
+        self.condition = condition
+        self.sync_interval = SEARCH_SYNC_INTERVAL
+        self.rebuild_interval = SEARCH_REBUILD_INTERVAL
+        self.batch_size = SEARCH_LOAD_BATCH
+        self.result_cache_size = SEARCH_RESULT_CACHE
+        self._index = None
+        self._built_at = 0.0
+        self._synced_at = 0.0
+        self._rebuilding = False
+        self._lock = threading.Lock()  # 保护结果缓存和统计
+        self._sync_lock = threading.Lock()
+        self._results = OrderedDict()  # (查询, 过滤条件) -> (索引, generation, ID列表)
+        self._stats = {
+            "searches": 0,
+            "result_hits": 0,
+            "fallbacks": 0,
+            "syncs": 0,
+            "rebuilds": 0,
+            "build_ms": None,
+        }
+
+    def configure(self, sync_interval, rebuild_interval, batch_size, result_cache_size):
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.batch_size = batch_size
+        with self._lock:
+            self.result_cache_size = result_cache_size
+            self._index = None
+            self._results.clear()
+
+    def search(self, query, predicate=None, predicate_key=None):
+        """
+        返回按相关度排序的行ID；索引还在第一次构建时返回 None，调用方退回到 SQL 查询。
+        :param predicate_key: 过滤条件的标识，相同查询、相同标识的结果会被缓存
+        """
+        index = self._current()
+        if index is None:
+            self._count("fallbacks")
+            return None
+        self._count("searches")
+        if predicate is not None and predicate_key is None:
+            return index.search(query, predicate)
+
+        key = (query, predicate_key)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and cached[0] is index and cached[1] == index.generation:
+                self._results.move_to_end(key)
+                self._stats["result_hits"] += 1
+                return cached[2]
+        # 搜索本身不持有锁，同一查询并发未命中时各自计算一次
+        generation = index.generation
+        ids = index.search(query, predicate)
+        with self._lock:
+            self._results[key] = (index, generation, ids)
+            self._results.move_to_end(key)
+            while len(self._results) > self.result_cache_size:
+                self._results.popitem(last=False)
+        return ids
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def changed(self):
+        """表中新增了行，提交后立即同步"""
+        DatabaseManager.after_commit(self.invalidate)
+
+    def removed(self, doc_ids):
+        """删除了这些行，提交后从索引中去掉"""
+
+        def remove():
+            index = self._index
+            if index is not None:
+                for doc_id in doc_ids:
+                    index.remove(doc_id)
+
+        DatabaseManager.after_commit(remove)
+
+    def removed_where(self, predicate):
+        """删除了属性满足 predicate 的行，提交后从索引中去掉"""
+
+        def remove():
+            index = self._index
+            if index is not None:
+                index.remove_where(predicate)
+
+        DatabaseManager.after_commit(remove)
+
+    def invalidate(self):
+        self._synced_at = 0.0
+
+    def stats(self):
+        index = self._index
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "docs": len(index) if index is not None else None,
+            "grams": index.gram_count() if index is not None else None,
+            "age": round(time.monotonic() - self._built_at) if index else None,
+        }
+
+    def _current(self):
+        now = time.monotonic()
+        if self._index is None:
+            # 第一次使用时在后台构建，构建完成前返回 None
+            if not self._rebuilding:
+                self._rebuilding = True
+                threading.Thread(
+                    target=self._rebuild,
+                    name=f"search-build-{self.table}",
+                    daemon=True,
+                ).start()
+            return None
+
+        if now - self._built_at >= self.rebuild_interval and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(
+                target=self._rebuild, name=f"search-rebuild-{self.table}", daemon=True
+            ).start()
+        if now - self._synced_at >= self.sync_interval and self._sync_lock.acquire(
+            blocking=False
+        ):
+            try:
+                self._load(self._index, self._index.max_id)
+                self._synced_at = time.monotonic()
+                self._count("syncs")
+            finally:
+                self._sync_lock.release()
+        return self._index
+
+    def _build(self):
+        start = time.perf_counter()
+        index = NgramIndex(self.fields)
+        self._load(index, 0)
+        build_ms = round((time.perf_counter() - start) * 1000, 1)
+        with self._lock:
+            self._stats["build_ms"] = build_ms
+            self._stats["rebuilds"] += 1
+        logger.info(
+            f"Built search index for {self.table}: {len(index)} rows in {build_ms} ms"
+        )
+        return index
+
+    def _rebuild(self):
+        try:
+            index = self._build()
+            with self._sync_lock:
+                # 重建期间新增的行
+                self._load(index, index.max_id)
+                self._index = index
+                self._built_at = self._synced_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Failed to rebuild search index for {self.table}: {e}")
+            self._built_at = time.monotonic()
+        finally:
+            self._rebuilding = False
+
+    def _load(self, index, after_id):
+        """按 id 分批加载 id > after_id 的行"""
+        columns = ", ".join(("id",) + self.fields + self.attrs)
+        condition = f" AND {self.condition}" if self.condition else ""
+        query = f"SELECT {columns} FROM {self.table} WHERE id > %s{condition} ORDER BY id LIMIT %s"
+        while True:
+            rows = DatabaseManager.execute_query(
+                query, (after_id, self.batch_size), fetch=True
+            )
+            for row in rows:
+                index.add(
+                    row["id"],
+                    {field: row[field] for field in self.fields},
+                    {attr: row[attr] for attr in self.attrs},
+                )
+            if len(rows) < self.batch_size:
+                return
+            after_id = rows[-1]["id"]
+
+
+music_search = TableSearchIndex(
+    "global_music", ("name", "artist"), ("user_id", "is_api_music")
+)
+user_search = TableSearchIndex("users", ("username",), condition="deleted_at IS NULL")
+
+
+def ranked_page(ids, cursor, page_size, offset=0):
+    """
+    按相关度排好序的搜索结果分页，游标中记录的是偏移量
+    :return: (本页的ID, next_cursor, prev_cursor)
+    """
+    if cursor:
+        values, _ = decode_cursor(cursor)
+        if len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+            raise InvalidCursorError("Invalid cursor")
+        offset = values[0]
+    end = offset + page_size
+    next_cursor = encode_cursor([end], "next") if end < len(ids) else None
+    prev_cursor = (
+        encode_cursor([max(0, offset - page_size)], "prev") if offset else None
+    )
+    return ids[offset:end], next_cursor, prev_cursor
+
+
+def fetch_rows_in_order(select, id_column, ids, condition=None):
+    """按 ids 的顺序取回行，已被删除（或不满足 condition）的行跳过"""
+    if not ids:
+        return []
+    query = f"{select} WHERE {id_column} IN ({sql_in_placeholders(ids)})"
+    if condition:
+        query += f" AND {condition}"
+    rows = DatabaseManager.execute_query(query, tuple(ids), fetch=True)
+    by_id = {row["id"]: row for row in rows}
+    return [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+
+
+class JobQueue:
+    """
+    进程内的后台任务队列。
+    任务记录保存在本地 SQLite 任务表中，由每个进程自己的工作线程执行；
+    进程退出时未完成的任务会在下次启动时重新执行，所以任务处理函数需要可以重复执行。
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self):
+        self.db_path = JOB_DB_PATH
+        self.workers = JOB_WORKERS
+        self._handlers = {}
+        self._schedules = {}
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, db_path, workers):
+        """设置任务表位置和线程数，并创建任务表"""
+        self.db_path = db_path
+        self.workers = workers
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._db()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+
+    def handler(self, kind):
+        """注册任务处理函数的装饰器，处理函数接收 payload，返回值作为任务结果"""
+
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+
+        return decorator
+
+    def schedule(self, kind, interval, payload=None):
+        """定期提交任务：每隔 interval 秒提交一次，上一次的同类任务还没结束时跳过"""
+        self._schedules[kind] = (interval, payload or {})
+
+    def submit(self, kind, payload, job_id=None):
+        """提交任务，返回任务ID；需要在提交前知道任务ID时由调用方生成后传入"""
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        self._db().execute(
+            "INSERT INTO jobs (id, kind, payload, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), self.PENDING, now, now),
+        )
+        self.ensure_started()
+        self._queue.put(job_id)
+        return job_id
+
+    def get(self, job_id):
+        """查询任务状态，不存在时返回 None"""
+        row = (
+            self._db()
+            .execute(
+                "SELECT id, kind, status, result, error, attempts, created_at, updated_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def ensure_started(self):
+        """启动当前进程的工作线程（fork 出的子进程需要重新启动），并恢复未完成的任务"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # SQLite 连接不能跨 fork 使用
+            self._local = threading.local()
+            self._queue = queue.Queue()
+            for _ in range(self.workers):
+                threading.Thread(
+                    target=self._work, name="job-worker", daemon=True
+                ).start()
+            if self._schedules:
+                threading.Thread(
+                    target=self._schedule_loop, name="job-scheduler", daemon=True
+                ).start()
+            self._pid = pid
+            self._recover()
+
+    def _recover(self):
+        """清理过期的已结束任务，把没有进程在执行的任务重新放回队列"""
+        conn = self._db()
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (self.DONE, self.FAILED, time.time() - JOB_RETENTION),
+        )
+        rows = conn.execute(
+            "SELECT id, status, owner FROM jobs WHERE status IN (?, ?)",
+            (self.PENDING, self.RUNNING),
+        ).fetchall()
+        for row in rows:
+            if row["status"] == self.RUNNING:
+                if self._owner_alive(row["owner"]):
+                    continue
+                conn.execute(
+                    "UPDATE jobs SET status = ?, owner = NULL WHERE id = ? AND status = ? AND owner = ?",
+                    (self.PENDING, row["id"], self.RUNNING, row["owner"]),
+                )
+            # 领取任务是原子的，多个进程同时恢复同一个任务也只会执行一次
+            self._queue.put(row["id"])
+        if rows:
+            logger.info(f"Recovered {len(rows)} unfinished jobs")
+
+    @staticmethod
+    def _owner_alive(owner):
+        """任务表是本机文件，owner 为 主机名:进程号"""
+        if not owner:
+            return False
+        host, _, pid = owner.rpartition(":")
+        if host != socket.gethostname():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, ValueError):
+            return True
+        return True
+
+    def _schedule_loop(self):
+        next_run = {}
+        while True:
+            now = time.monotonic()
+            for kind, (interval, payload) in list(self._schedules.items()):
+                due = next_run.setdefault(kind, now + interval)
+                if now < due:
+                    continue
+                next_run[kind] = now + interval
+                try:
+                    if not self._has_unfinished(kind):
+                        self.submit(kind, payload)
+                except Exception as e:
+                    logger.error(f"Failed to schedule job {kind}: {e}")
+            wait_time = min(next_run.values(), default=now + 60) - time.monotonic()
+            time.sleep(min(max(wait_time, 1), 60))
+
+    def _has_unfinished(self, kind):
+        row = (
+            self._db()
+            .execute(
+                "SELECT 1 FROM jobs WHERE kind = ? AND status IN (?, ?) LIMIT 1",
+                (kind, self.PENDING, self.RUNNING),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                logger.error(f"Job {job_id} crashed: {e}")
+
+    def _run(self, job_id):
+        conn = self._db()
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        claimed = conn.execute(
+            "UPDATE jobs SET status = ?, owner = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE id = ? AND status = ?",
+            (self.RUNNING, owner, time.time(), job_id, self.PENDING),
+        ).rowcount
+        if not claimed:
+            return
+
+        row = conn.execute(
+            "SELECT kind, payload FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        handler = self._handlers.get(row["kind"])
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for job kind {row['kind']}")
+            result = handler(json.loads(row["payload"]))
+        except Exception as e:
+            logger.error(f"Job {job_id} ({row['kind']}) failed: {e}")
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (self.FAILED, str(e), time.time(), job_id),
+            )
+            return
+
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = NULL, updated_at = ? WHERE id = ?",
+            (self.DONE, json.dumps(result), time.time(), job_id),
+        )
+
+    def _db(self):
+        """每个线程一个 SQLite 连接，自动提交"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+
+jobs = JobQueue()
+
+
+@bp.before_app_request
+def start_job_workers():
+    jobs.ensure_started()
+
+
+class BlobStore:
+    """
+    按内容寻址的音频存储。
+    上传时边写入边计算 SHA-256，文件保存为 <root>/ab/cd/<sha256>.<后缀>，相同内容只保存一份；
+    audio_files 的行通过 content_hash 引用文件，audio_blobs.ref_count 记录引用数，
+    引用数归零超过宽限期后由定期的 blob_gc 任务删除文件。
+
+    保存、增加引用和垃圾回收都先锁住文件对应的 audio_blobs 行，持有锁时才检查或删除文件：
+    保存时行不存在则创建（ref_count 为 0），引用数为 0 时 released_at 更新为当前时间，
+    宽限期内不会被回收，入库任务在此期间增加引用。
+    """
+
+    def __init__(self):
+        self.root = BLOB_FOLDER
+        self.gc_grace = BLOB_GC_GRACE
+        self.orphan_age = BLOB_ORPHAN_AGE
+
+    def configure(self, root, gc_grace, orphan_age):
+        self.root = root
+        self.gc_grace = gc_grace
+        self.orphan_age = orphan_age
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def save(self, file, chunk_size=1024 * 1024):
+        """保存上传的文件，返回 (SHA-256, 文件路径, 字节数)"""
+        ext = os.path.splitext(file.filename)[1].lower()
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix=ext)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in iter(lambda: file.stream.read(chunk_size), b""):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            content_hash = digest.hexdigest()
+            blob_path = self._store(content_hash, ext, tmp_path, size)
+        except BaseException:
+            remove_file_quietly(tmp_path)
+            raise
+        return content_hash, blob_path, size
+
+    def _store(self, content_hash, ext, tmp_path, size):
+        """
+        锁住 audio_blobs 行后把临时文件移到内容地址，内容已存在时丢弃临时文件，返回文件路径。
+        使用独立的短事务，不在请求的事务中长时间持有锁
+        """
+        blob_dir = os.path.join(self.root, content_hash[:2], content_hash[2:4])
+        session = DatabaseSession()
+        try:
+            query = """
+                INSERT INTO audio_blobs (sha256, file_path, file_size, ref_count, released_at)
+                VALUES (%s, %s, %s, 0, NOW())
+                ON DUPLICATE KEY UPDATE released_at = IF(ref_count = 0, NOW(), released_at)
+            """
+            session.execute(
+                query, (content_hash, os.path.join(blob_dir, content_hash + ext), size)
+            )
+            query = "SELECT file_path FROM audio_blobs WHERE sha256 = %s FOR UPDATE"
+            blob_path = session.execute(query, (content_hash,), fetch=True)[0][
+                "file_path"
+            ]
+            if os.path.exists(blob_path):
+                # 内容已存在：丢弃临时文件，更新修改时间避免被孤儿文件回收
+                os.utime(blob_path)
+                os.remove(tmp_path)
+            else:
+                # 新内容，或文件已被回收（行是刚重新创建的）
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return blob_path
+
+    @staticmethod
+    def add_refs(blobs):
+        """
+        新写入的 audio_files 行增加引用，需要在同一个事务中调用。
+        :param blobs: (SHA-256, 文件路径, 字节数) 列表，同一内容可以出现多次
+        """
+        refs = {}
+        for content_hash, file_path, file_size in blobs:
+            count = refs[content_hash][2] if content_hash in refs else 0
+            refs[content_hash] = (file_path, file_size, count + 1)
+        # 按主键顺序加锁，与其他事务的加锁顺序一致
+        query = """
+            INSERT INTO audio_blobs (sha256, file_path, file_size, ref_count)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE ref_count = ref_count + VALUES(ref_count), released_at = NULL
+        """
+        DatabaseManager.execute_many(
+            query, [(h, path, size, n) for h, (path, size, n) in sorted(refs.items())]
+        )
+        # 持有行锁时确认文件仍然存在（超过宽限期才入库时文件可能已被回收），否则整个事务回滚
+        missing = [path for path, _, _ in refs.values() if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"Blob files were collected: {', '.join(missing)}")
+
+    @staticmethod
+    def release(rows, remove_legacy=True):
+        """
+        audio_files 的行删除后释放引用，需要在同一个事务中调用。
+        没有 content_hash 的旧数据文件不共享，remove_legacy 时在提交后直接删除。
+        """
+        counts = Counter(row["content_hash"] for row in rows if row.get("content_hash"))
+        if counts:
+            # 单表 UPDATE 按顺序赋值，released_at 判断的是减少后的引用数
+            query = """
+                UPDATE audio_blobs
+                SET ref_count = GREATEST(ref_count - %s, 0),
+                    released_at = IF(ref_count = 0, NOW(), released_at)
+                WHERE sha256 = %s
+            """
+            DatabaseManager.execute_many(
+                query, [(count, h) for h, count in counts.items()]
+            )
+
+        legacy_paths = [
+            row["file_path"]
+            for row in rows
+            if row.get("file_path") and not row.get("content_hash")
+        ]
+        if remove_legacy and legacy_paths:
+
+            def remove_legacy_files():
+                for file_path in legacy_paths:
+                    remove_file_quietly(file_path)
+
+            DatabaseManager.after_commit(remove_legacy_files)
+
+    def collect_garbage(self):
+        """删除引用数归零超过宽限期的文件，以及从未登记引用的孤儿文件"""
+        cutoff = time.time() - self.gc_grace
+        with DatabaseManager.transaction():
+            query = """
+                SELECT sha256, file_path FROM audio_blobs
+                WHERE ref_count = 0 AND released_at < NOW() - INTERVAL %s SECOND
+                FOR UPDATE
+            """
+            rows = DatabaseManager.execute_query(query, (self.gc_grace,), fetch=True)
+            # 宽限期内有相同内容的上传（会更新修改时间）的文件不删除
+            expired = [row for row in rows if self._mtime(row["file_path"]) < cutoff]
+            if expired:
+                hashes = [row["sha256"] for row in expired]
+                query = f"DELETE FROM audio_blobs WHERE ref_count = 0 AND sha256 IN ({sql_in_placeholders(hashes)})"
+                DatabaseManager.execute_query(query, hashes)
+                # 持有行锁时删除文件：并发的上传在 _store 中等待锁释放，
+                # 之后发现行已删除，重新创建行并写入文件
+                for row in expired:
+                    remove_file_quietly(row["file_path"])
+
+        orphans = self._collect_orphans()
+        logger.info(
+            f"Blob GC removed {len(expired)} released and {orphans} orphaned files"
+        )
+        return {"released": len(expired), "orphans": orphans}
+
+    def _collect_orphans(self):
+        """删除超过 orphan_age 仍没有登记的文件（中断的上传、中断的临时文件）"""
+        cutoff = time.time() - self.orphan_age
+        tmp_dir = os.path.join(self.root, "tmp")
+        candidates = {}
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if self._mtime(path) >= cutoff:
+                    continue
+                name = os.path.splitext(filename)[0]
+                if dirpath == tmp_dir:
+                    remove_file_quietly(path)
+                    removed += 1
+                elif len(name) == 64:
+                    candidates.setdefault(name, []).append(path)
+
+        for chunk in chunked(list(candidates)):
+            # 锁住（不存在时锁住间隙），同时进行的 _store 在删除完成后才能登记；
+            # 持有锁时再检查一次修改时间，_store 复用文件时会更新修改时间
+            with DatabaseManager.transaction():
+                query = f"SELECT sha256 FROM audio_blobs WHERE sha256 IN ({sql_in_placeholders(chunk)}) FOR UPDATE"
+                rows = DatabaseManager.execute_query(query, chunk, fetch=True)
+                known = {row["sha256"] for row in rows}
+                for name in chunk:
+                    if name in known:
+                        continue
+                    for path in candidates[name]:
+                        if self._mtime(path) < cutoff:
+                            remove_file_quietly(path)
+                            removed += 1
+        return removed
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+
+blob_store = BlobStore()
+
+
+@jobs.handler("blob_gc")
+def collect_blob_garbage(payload):
+    return blob_store.collect_garbage()
+
+
+def file_size_of(value):
+    """file_size 可能为空，或是前端传来的字符串"""
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class StatsCounters:
+    """
+    管理端统计数据的计数器，在修改数据的同一个事务中增减，读取时不扫描数据表。
+    - app_counters：全局计数（用户数、global_music 的歌曲数和总大小），每个计数器分成多行，写入时随机选一行
+    - user_stats：每个用户 audio_files 的歌曲数和总大小
+    遗漏的写入路径、手工改库等造成的偏差由定期的对账任务修正。
+    """
+
+    USERS = "users"
+    SONGS = "songs"
+    STORAGE = "storage"
+    NAMES = (USERS, SONGS, STORAGE)
+    LOCK_NAME = "stats_reconcile"
+
+    def __init__(self):
+        self.shards = STATS_COUNTER_SHARDS
+
+    def configure(self, shards):
+        self.shards = shards
+
+    def add(self, **deltas):
+        """增减全局计数，如 add(songs=1, storage=1024)"""
+        rows = [
+            (name, random.randrange(self.shards), delta)
+            for name, delta in deltas.items()
+            if delta
+        ]
+        query = """
+            INSERT INTO app_counters (name, slot, value) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE value = value + VALUES(value)
+        """
+        DatabaseManager.execute_many(query, rows)
+
+    def add_user_files(self, user_id, count, size):
+        """用户新增 audio_files 行"""
+        self._add_user_rows([(user_id, count, size)])
+
+    def remove_files(self, rows):
+        """audio_files 的行删除后减少所属用户的计数，rows 需要包含 user_id 和 file_size"""
+        per_user = {}
+        for row in rows:
+            count, size = per_user.get(row["user_id"], (0, 0))
+            per_user[row["user_id"]] = (
+                count + 1,
+                size + file_size_of(row.get("file_size")),
+            )
+        self._add_user_rows(
+            [(user_id, -count, -size) for user_id, (count, size) in per_user.items()]
+        )
+
+    def charge_storage(self, user_id, size, quota=None):
+        """
+        在额度内增加用户的已用空间，超出 quota 时不修改并返回 False。
+        检查和增加是一条 UPDATE，并发上传不会一起超出额度。
+        """
+        DatabaseManager.execute_query(
+            "INSERT IGNORE INTO user_stats (user_id) VALUES (%s)", (user_id,)
+        )
+        if quota is None:
+            query = "UPDATE user_stats SET storage_used = storage_used + %s WHERE user_id = %s"
+            DatabaseManager.execute_query(query, (size, user_id))
+            return True
+        query = """
+            UPDATE user_stats SET storage_used = storage_used + %s
+            WHERE user_id = %s AND storage_used + %s <= %s
+        """
+        return DatabaseManager.execute_query(query, (size, user_id, size, quota)) > 0
+
+    @staticmethod
+    def record_charge(user_id, size):
+        """
+        登记上传时预先计入的已用空间，返回登记ID，需要和 charge_storage 在同一个事务中。
+        入库任务用 settle_charge 按实际写入的歌曲修正，任务重复执行时只修正一次
+        """
+        charge_id = uuid.uuid4().hex
+        query = "INSERT INTO upload_charges (id, user_id, amount) VALUES (%s, %s, %s)"
+        DatabaseManager.execute_query(query, (charge_id, user_id, size))
+        return charge_id
+
+    @staticmethod
+    def settle_charge(charge_id):
+        """删除登记并返回预先计入的大小，已经修正过（登记不存在）时返回 0"""
+        if charge_id is None:
+            return 0
+        query = "SELECT amount FROM upload_charges WHERE id = %s FOR UPDATE"
+        rows = DatabaseManager.execute_query(query, (charge_id,), fetch=True)
+        if not rows:
+            return 0
+        query = "DELETE FROM upload_charges WHERE id = %s"
+        DatabaseManager.execute_query(query, (charge_id,))
+        return rows[0]["amount"]
+
+    def reconcile_user_storage(self, user_id):
+        """
+        按磁盘上的实际文件修正用户 audio_files 的 file_size，再按 file_size 重新计算已用空间。
+        file_size 可能来自客户端上报或旧数据；文件不存在的行保持不变，在结果中列出。
+        """
+        DatabaseManager.execute_query(
+            "INSERT IGNORE INTO user_stats (user_id) VALUES (%s)", (user_id,)
+        )
+        # 先锁住统计行，同一用户的上传在对账提交后才能修改已用空间
+        query = "SELECT storage_used FROM user_stats WHERE user_id = %s FOR UPDATE"
+        before = DatabaseManager.execute_query(query, (user_id,), fetch=True)[0]
+        # 加锁读取，读到最新提交的行而不是事务开始时的快照
+        query = """
+            SELECT id, file_path, file_size FROM audio_files
+            WHERE user_id = %s LOCK IN SHARE MODE
+        """
+        rows = DatabaseManager.execute_query(query, (user_id,), fetch=True)
+
+        corrections = []
+        missing = []
+        total = 0
+        for row in rows:
+            size = file_size_of(row["file_size"])
+            if row["file_path"]:
+                try:
+                    actual = os.path.getsize(row["file_path"])
+                except OSError:
+                    missing.append(row["file_path"])
+                else:
+                    if actual != size:
+                        corrections.append((actual, row["id"]))
+                        size = actual
+            total += size
+
+        query = "UPDATE audio_files SET file_size = %s WHERE id = %s"
+        DatabaseManager.execute_many(query, corrections)
+        PlaylistService.touch_tracks(track_id for _, track_id in corrections)
+        query = "UPDATE user_stats SET song_count = %s, storage_used = %s WHERE user_id = %s"
+        DatabaseManager.execute_query(query, (len(rows), total, user_id))
+        if corrections or int(before["storage_used"]) != total:
+            logger.warning(
+                f"Storage of user {user_id} reconciled: {before['storage_used']} -> {total}, "
+                f"{len(corrections)} file sizes corrected"
+            )
+        return {
+            "before": int(before["storage_used"]),
+            "after": total,
+            "corrected": len(corrections),
+            "missing": missing,
+        }
+
+    def drop_user(self, user_id):
+        """用户被删除"""
+        query = "DELETE FROM user_stats WHERE user_id = %s"
+        DatabaseManager.execute_query(query, (user_id,))
+
+    def totals(self):
+        """全局计数，还没有初始化时提交一次对账任务"""
+        query = "SELECT name, SUM(value) AS value FROM app_counters GROUP BY name"
+        rows = DatabaseManager.execute_query(query, fetch=True)
+        totals = {row["name"]: int(row["value"]) for row in rows}
+        if any(name not in totals for name in self.NAMES):
+            jobs.submit("stats_reconcile", {})
+        return {name: max(totals.get(name, 0), 0) for name in self.NAMES}
+
+    def user_stats(self, user_id):
+        query = "SELECT song_count, storage_used FROM user_stats WHERE user_id = %s"
+        rows = DatabaseManager.execute_query(query, (user_id,), fetch=True)
+        if not rows:
+            return {"song_count": 0, "storage_used": 0}
+        return {
+            "song_count": max(int(rows[0]["song_count"]), 0),
+            "storage_used": max(int(rows[0]["storage_used"]), 0),
+        }
+
+    def reconcile(self):
+        """
+        用表中的实际数据修正计数，只在请求之外调用。
+        多个进程同时执行时用 GET_LOCK 保证只有一个进程对账，没拿到锁时返回 None。
+        """
+        conn = DatabaseManager.get_connection()
+        cursor = conn.cursor()
+        try:
+            # 锁在单独的连接上，对账的事务提交之后才释放
+            cursor.execute("SELECT GET_LOCK(%s, 0)", (self.LOCK_NAME,))
+            (locked,) = cursor.fetchone()
+            if not locked:
+                logger.info("Stats reconciliation is running in another process")
+                return None
+            try:
+                with DatabaseManager.transaction():
+                    return self._reconcile()
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (self.LOCK_NAME,))
+                cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _reconcile(self):
+        """
+        在同一个一致性快照中读取实际数据和当前计数，把差值加到计数上。
+        对账期间其他事务的提交同时修改了数据和计数，不在快照中，也不会被差值抵消。
+        """
+        execute = DatabaseManager.execute_query
+        execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+
+        actual = {
+            self.USERS: execute(
+                "SELECT COUNT(*) AS count FROM users WHERE deleted_at IS NULL",
+                fetch=True,
+            )[0]["count"]
+        }
+        query = "SELECT COUNT(*) AS count, COALESCE(SUM(file_size), 0) AS total FROM global_music"
+        row = execute(query, fetch=True)[0]
+        actual[self.SONGS] = row["count"]
+        actual[self.STORAGE] = row["total"]
+        query = "SELECT name, SUM(value) AS value FROM app_counters GROUP BY name"
+        current = {row["name"]: row["value"] for row in execute(query, fetch=True)}
+        drift = {
+            name: int(actual[name]) - int(current.get(name) or 0) for name in self.NAMES
+        }
+
+        query = """
+            SELECT user_id, COUNT(*) AS song_count, COALESCE(SUM(file_size), 0) AS storage_used
+            FROM audio_files GROUP BY user_id
+        """
+        actual_users = {
+            row["user_id"]: (int(row["song_count"]), int(row["storage_used"]))
+            for row in execute(query, fetch=True)
+        }
+        query = "SELECT user_id, song_count, storage_used FROM user_stats"
+        current_users = {
+            row["user_id"]: (int(row["song_count"]), int(row["storage_used"]))
+            for row in execute(query, fetch=True)
+        }
+        user_drift = []
+        for user_id in actual_users.keys() | current_users.keys():
+            count, size = actual_users.get(user_id, (0, 0))
+            current_count, current_size = current_users.get(user_id, (0, 0))
+            if (count, size) != (current_count, current_size):
+                user_drift.append((user_id, count - current_count, size - current_size))
+
+        # 差值写到 0 号分片
+        query = """
+            INSERT INTO app_counters (name, slot, value) VALUES (%s, 0, %s)
+            ON DUPLICATE KEY UPDATE value = value + VALUES(value)
+        """
+        DatabaseManager.execute_many(
+            query, [(name, delta) for name, delta in drift.items() if delta]
+        )
+        self._add_user_rows(user_drift)
+
+        if any(drift.values()) or user_drift:
+            logger.warning(
+                f"Stats counters drifted: {drift}, {len(user_drift)} users corrected"
+            )
+        return {"drift": drift, "users_corrected": len(user_drift)}
+
+    @staticmethod
+    def _add_user_rows(rows):
+        """(用户ID, 歌曲数增量, 大小增量) 列表"""
+        query = """
+            INSERT INTO user_stats (user_id, song_count, storage_used) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                song_count = song_count + VALUES(song_count),
+                storage_used = storage_used + VALUES(storage_used)
+        """
+        DatabaseManager.execute_many(query, [row for row in rows if row[1] or row[2]])
+
+
+counters = StatsCounters()
+
+
+@jobs.handler("stats_reconcile")
+def reconcile_stats(payload):
+    return counters.reconcile()
+
+
+class UserPurges:
+    """
+    删除用户分两步：
+    1. 请求中的一个事务：用户标记为已删除（deleted_at），用户名改为 deleted#<id> 以便重新注册，
+       头像、音频目录同样改名为 deleted#<id>（旧数据的 file_path 一起修改），
+       在 user_purges 表中登记清理进度，提交后提交 user_purge 任务；
+    2. 后台任务：按批删除音频记录并释放文件引用，删除上传的音乐、用户目录，最后删除用户。
+    后台任务只按用户ID查找目录和文件，不会删除重新注册同名用户的文件。
+    每一步都可以重复执行，任务中断或失败后由定期的 user_purge_retry 任务重新提交。
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self):
+        self.batch_size = USER_PURGE_BATCH
+        self.retry_interval = USER_PURGE_RETRY_INTERVAL
+        self.max_attempts = USER_PURGE_MAX_ATTEMPTS
+
+    def configure(self, batch_size, retry_interval, max_attempts):
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+
+    def tombstone(self, user):
+        """标记删除用户，需要在请求的会话或 transaction() 中调用；用户已被删除时返回 False"""
+        user_id, username = user["id"], user["username"]
+        query = """
+            UPDATE users SET username = CONCAT('deleted#', id), deleted_at = NOW()
+            WHERE id = %s AND deleted_at IS NULL
+        """
+        if not DatabaseManager.execute_query(query, (user_id,)):
+            return False
+        query = "SELECT COUNT(*) AS count FROM audio_files WHERE user_id = %s"
+        files_total = DatabaseManager.execute_query(query, (user_id,), fetch=True)[0][
+            "count"
+        ]
+        query = """
+            INSERT INTO user_purges (user_id, username, files_total) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE username = VALUES(username), files_total = VALUES(files_total),
+                status = 'pending', files_purged = 0, attempts = 0, last_error = NULL
+        """
+        DatabaseManager.execute_query(query, (user_id, username, files_total))
+        counters.add(users=-1)
+        self._move_folders(user_id, username)
+
+        UserService.invalidate_user(username, user_id)
+        user_cache.bump()
+        user_search.removed([user_id])
+        music_search.removed_where(
+            lambda attrs: attrs["user_id"] == user_id and not attrs["is_api_music"]
+        )
+        DatabaseManager.after_commit(
+            lambda: jobs.submit("user_purge", {"user_id": user_id})
+        )
+        return True
+
+    @staticmethod
+    def folder_name(user_id):
+        """已删除用户的目录名，与改名后的用户名相同"""
+        return f"deleted#{user_id}"
+
+    def _move_folders(self, user_id, username):
+        """
+        用户目录改名为 deleted#<id>，旧数据（没有 content_hash）的 file_path 指向新目录。
+        在事务中改名，回滚时改回原来的名字
+        """
+        moved = []
+
+        def restore():
+            for source, target in reversed(moved):
+                try:
+                    os.rename(target, source)
+                except OSError:
+                    logger.warning(f"Failed to restore folder {source}")
+
+        DatabaseManager.after_rollback(restore)
+        for folder in (UPLOAD_FOLDER, UPLOAD_AUDIO_FOLDER):
+            source = os.path.join(folder, username)
+            target = os.path.join(folder, self.folder_name(user_id))
+            if os.path.isdir(source):
+                os.rename(source, target)
+                moved.append((source, target))
+
+        prefix = os.path.join(UPLOAD_AUDIO_FOLDER, username) + os.sep
+        new_prefix = (
+            os.path.join(UPLOAD_AUDIO_FOLDER, self.folder_name(user_id)) + os.sep
+        )
+        query = """
+            UPDATE audio_files
+            SET file_path = CONCAT(%s, SUBSTRING(file_path, %s))
+            WHERE user_id = %s AND content_hash IS NULL AND LEFT(file_path, %s) = %s
+        """
+        DatabaseManager.execute_query(
+            query, (new_prefix, len(prefix) + 1, user_id, len(prefix), prefix)
+        )
+
+    def progress(self, user_id):
+        """清理进度，没有删除过该用户时返回 None"""
+        query = """
+            SELECT user_id, username, status, files_total, files_purged, attempts, last_error,
+                   created_at, updated_at
+            FROM user_purges WHERE user_id = %s
+        """
+        rows = DatabaseManager.execute_query(query, (user_id,), fetch=True)
+        return rows[0] if rows else None
+
+    def purge(self, user_id):
+        """清理已标记删除的用户，只在请求之外调用"""
+        query = """
+            UPDATE user_purges SET status = 'running', attempts = attempts + 1, last_error = NULL
+            WHERE user_id = %s AND status <> 'done'
+        """
+        if not DatabaseManager.execute_query(query, (user_id,)):
+            return {"user_id": user_id, "status": self.DONE, "files_purged": 0}
+        username = self.progress(user_id)["username"]
+
+        try:
+            purged = 0
+            while True:
+                removed = self._purge_batch(user_id)
+                if not removed:
+                    break
+                purged += removed
+
+            with DatabaseManager.transaction():
+                delete_uploaded_global_music(user_id)
+
+            for folder in (UPLOAD_FOLDER, UPLOAD_AUDIO_FOLDER):
+                path = os.path.join(folder, self.folder_name(user_id))
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+
+            with DatabaseManager.transaction():
+                query = "DELETE FROM users WHERE id = %s AND deleted_at IS NOT NULL"
+                DatabaseManager.execute_query(query, (user_id,))
+                for table in (
+                    "playlist_changes",
+                    "playlist_versions",
+                    "upload_charges",
+                ):
+                    query = f"DELETE FROM {table} WHERE user_id = %s"
+                    DatabaseManager.execute_query(query, (user_id,))
+                counters.drop_user(user_id)
+                query = "UPDATE user_purges SET status = 'done' WHERE user_id = %s"
+                DatabaseManager.execute_query(query, (user_id,))
+        except Exception as e:
+            query = "UPDATE user_purges SET status = 'failed', last_error = %s WHERE user_id = %s"
+            DatabaseManager.execute_query(query, (str(e)[:1000], user_id))
+            raise
+
+        logger.info(f"Purged user {user_id} ({username}): {purged} audio files")
+        return {"user_id": user_id, "status": self.DONE, "files_purged": purged}
+
+    def _purge_batch(self, user_id):
+        """删除一批音频记录并释放文件引用，返回删除的行数"""
+        with DatabaseManager.transaction():
+            query = """
+                SELECT id, user_id, file_path, file_size, content_hash FROM audio_files
+                WHERE user_id = %s ORDER BY id LIMIT %s FOR UPDATE
+            """
+            rows = DatabaseManager.execute_query(
+                query, (user_id, self.batch_size), fetch=True
+            )
+            if not rows:
+                return 0
+            query = f"DELETE FROM audio_files WHERE id IN ({sql_in_placeholders(rows)})"
+            DatabaseManager.execute_query(query, [row["id"] for row in rows])
+            # 用户目录下的旧数据文件提交后删除，共享的文件由 blob_gc 回收
+            BlobStore.release(rows)
+            counters.remove_files(rows)
+            query = "UPDATE user_purges SET files_purged = files_purged + %s WHERE user_id = %s"
+            DatabaseManager.execute_query(query, (len(rows), user_id))
+        return len(rows)
+
+    def retry(self):
+        """重新提交失败或中断的清理，返回提交的用户ID"""
+        query = """
+            SELECT user_id FROM user_purges
+            WHERE status <> 'done' AND attempts < %s
+              AND updated_at < NOW() - INTERVAL (%s * GREATEST(attempts, 1)) SECOND
+        """
+        rows = DatabaseManager.execute_query(
+            query, (self.max_attempts, self.retry_interval), fetch=True
+        )
+        for row in rows:
+            jobs.submit("user_purge", {"user_id": row["user_id"]})
+        if rows:
+            logger.info(f"Resubmitted {len(rows)} user purges")
+        return [row["user_id"] for row in rows]
+
+
+user_purges = UserPurges()
+
+
+@jobs.handler("user_purge")
+def purge_user(payload):
+    return user_purges.purge(payload["user_id"])
+
+
+@jobs.handler("user_purge_retry")
+def retry_user_purges(payload):
+    return {"resubmitted": user_purges.retry()}
+
+
+@jobs.handler("playlist_changes_compact")
+def compact_playlist_changes(payload):
+    return {"removed": playlist_changes.compact()}
+
+
+class MusicIds:
+    """
+    上传歌曲的音乐ID。生成ID不访问数据库，只有每个进程第一次生成和续租时访问 id_workers 表：
+    节点号以租约的形式分配给进程，同一时刻不会有两个进程使用同一个节点号；
+    续租失败且租约到期后停止生成，重新租用节点号。
+    """
+
+    def __init__(self):
+        self.worker_id = MUSIC_ID_WORKER
+        self.lease = MUSIC_ID_LEASE
+        self._generator = None
+        self._pid = None
+        self._owner = None
+        self._renew_at = 0.0
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, worker_id, lease):
+        with self._lock:
+            self.worker_id = worker_id
+            self.lease = lease
+            self._generator = None
+
+    def next_id(self):
+        generator = self._generator
+        if (
+            generator is None
+            or self._pid != os.getpid()
+            or time.monotonic() >= self._renew_at
+        ):
+            generator = self._refresh()
+        return generator.next_id()
+
+    def _refresh(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._generator is not None and self._pid == os.getpid():
+                if now < self._renew_at:
+                    return self._generator
+                try:
+                    if self._renew():
+                        return self._generator
+                    logger.warning(
+                        f"Lost music ID worker {self._generator.worker_id}, acquiring a new one"
+                    )
+                except Exception as e:
+                    # 租约到期前仍然可以使用当前节点号，之后每次生成都会重试续租
+                    if now < self._expires_at:
+                        logger.error(f"Failed to renew music ID worker: {e}")
+                        return self._generator
+                    raise
+            # fork 出的子进程不能沿用父进程的节点号
+            self._generator = IdGenerator(self._acquire())
+            self._pid = os.getpid()
+            return self._generator
+
+    def _acquire(self):
+        if self.worker_id is not None:
+            self._renew_at = self._expires_at = float("inf")
+            return self.worker_id
+
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # 没有人持有或租约已过期时占用；按顺序赋值，leased_until 判断的是更新后的 owner
+        query = """
+            INSERT INTO id_workers (worker_id, owner, leased_until)
+            VALUES (%s, %s, NOW() + INTERVAL %s SECOND)
+            ON DUPLICATE KEY UPDATE
+                owner = IF(leased_until < NOW(), VALUES(owner), owner),
+                leased_until = IF(owner = VALUES(owner), VALUES(leased_until), leased_until)
+        """
+        start = random.randrange(MAX_WORKER_ID + 1)
+        for offset in range(MAX_WORKER_ID + 1):
+            worker_id = (start + offset) % (MAX_WORKER_ID + 1)
+            started = time.monotonic()
+            self._execute(query, (worker_id, self._owner, self.lease))
+            rows = self._execute(
+                "SELECT owner FROM id_workers WHERE worker_id = %s",
+                (worker_id,),
+                fetch=True,
+            )
+            if rows and rows[0][0] == self._owner:
+                self._leased(started)
+                logger.info(f"Acquired music ID worker {worker_id}")
+                return worker_id
+        raise RuntimeError("No free music ID worker")
+
+    def _renew(self):
+        """续租，租约已被其他进程占用时返回 False"""
+        started = time.monotonic()
+        query = """
+            UPDATE id_workers SET leased_until = NOW() + INTERVAL %s SECOND
+            WHERE worker_id = %s AND owner = %s
+        """
+        if not self._execute(
+            query, (self.lease, self._generator.worker_id, self._owner)
+        ):
+            return False
+        self._leased(started)
+        return True
+
+    def _leased(self, started):
+        self._renew_at = started + self.lease / 3
+        # 留出时钟误差，比数据库中的租约早一点到期
+        self._expires_at = started + self.lease * 0.9
+
+    @staticmethod
+    def _execute(query, params, fetch=False):
+        """使用单独的连接并立即提交，不加入当前请求的事务"""
+        conn = DatabaseManager.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, params)
+            if fetch:
+                return cursor.fetchall()
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+            conn.close()
+
+
+music_ids = MusicIds()
+
+
+class AnalysisPool:
+    """
+    CPU 密集的音频分析使用的进程池，每个工作进程一个。
+    同时有多个批次在分析时按批次数平分进程，一次大批量上传不会占满进程池、饿死其他请求。
+    """
+
+    def __init__(self):
+        self.processes = ANALYSIS_PROCESSES
+        self._executor = None
+        self._pid = None
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def configure(self, processes):
+        with self._lock:
+            self._shutdown()
+            self.processes = processes
+
+    def map(self, func, items):
+        """对每个元素执行 func，按输入顺序返回 (结果, 异常) 列表"""
+        items = list(items)
+        if self.processes <= 1 or len(items) <= 1:
+            return [self._call(func, item) for item in items]
+
+        executor = self._get_executor()
+        outcomes = [None] * len(items)
+        pending = {}
+        next_index = 0
+        with self._lock:
+            self._active += 1
+        try:
+            while next_index < len(items) or pending:
+                # 准入限制：本批次最多占用 进程数 / 当前批次数 个进程
+                limit = max(1, self.processes // self._active)
+                while next_index < len(items) and len(pending) < limit:
+                    future = executor.submit(func, items[next_index])
+                    pending[future] = next_index
+                    next_index += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    try:
+                        outcomes[index] = (future.result(), None)
+                    except BrokenProcessPool as e:
+                        # 子进程异常退出，进程池不可再用，下次调用时重建
+                        with self._lock:
+                            if self._executor is executor:
+                                self._executor = None
+                        outcomes[index] = (None, e)
+                    except Exception as e:
+                        outcomes[index] = (None, e)
+        finally:
+            with self._lock:
+                self._active -= 1
+        return outcomes
+
+    @staticmethod
+    def _call(func, item):
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    def _get_executor(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._executor is None or self._pid != pid:
+                # 工作进程里有多个线程，用 spawn 而不是 fork 创建子进程
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self._pid = pid
+            return self._executor
+
+    def _shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._pid = None
 
-            # 删除用户头像
-            folder_path = "./user_avatars/test_api"
-            if os.path.exists(folder_path):
-                shutil.rmtree(folder_path)
 
-            # 删除用户数据
-            query = "DELETE FROM audio_files WHERE user_id = %s"
-            params = (user_id,)
-            result = DatabaseManager.execute_query(query, params)
-            if result:
-                logger.info(f"User data for {user_id} deleted successfully")
-                return True
+analysis_pool = AnalysisPool()
+
+
+def analyse_audio_file(file_path):
+    """分析单个音频文件（在进程池中执行）"""
+    return {"duration": get_audio_duration(file_path)}
+
+
+@jobs.handler("upload_analysis")
+def process_uploaded_audio(payload):
+    """
+    分析已保存的上传音频（时长），批量写入 audio_files、加入歌单并登记文件引用。
+    可以重复执行：写入前会再次检查歌单中内容相同的歌曲。
+    """
+    user_id = payload["user_id"]
+    playlist_type = payload["playlist_type"]
+
+    # 时长在进程池中并行计算，结果汇总后一次写入
+    outcomes = analysis_pool.map(
+        analyse_audio_file, [entry["file_path"] for entry in payload["files"]]
+    )
+
+    results = []
+    analysed = []
+    for entry, (analysis, error) in zip(payload["files"], outcomes):
+        file_path = entry["file_path"]
+        result = {"filename": entry["filename"], "name": entry["name"]}
+        results.append(result)
+        if error is not None:
+            # 文件可能被其他歌曲共用，不直接删除，没有引用的文件由 blob_gc 回收
+            logger.error(f"Error analysing {file_path}: {error}")
+            result["status"] = "invalid_audio"
+            continue
+        analysed.append((entry, analysis["duration"], result))
+
+    with DatabaseManager.transaction():
+        # 用户已有相同内容的歌曲（如在其他歌单中）时只加入歌单，不再写入新的歌曲；
+        # 任务被重新执行时，之前已加入歌单的歌曲不再重复加入
+        existing = PlaylistService.tracks_by_hash(
+            user_id, playlist_type, [entry["content_hash"] for entry, _, _ in analysed]
+        )
+        rows = []
+        listed = []
+        for entry, duration, result in analysed:
+            content_hash = entry["content_hash"]
+            track = existing.get(content_hash)
+            if track is not None and track["in_playlist"]:
+                result.update({"status": "exists", "sha256": content_hash})
+                continue
+            listed.append(content_hash)
+            if track is not None:
+                music_id, duration = track["music_id"], track["duration"]
             else:
-                logger.error(f"Failed to delete user data for {user_id}")
-                return False
-        except Exception as e:
-            logger.error(f"Error deleting user data for {user_id}: {e}")
-            return False
+                music_id = music_ids.next_id()
+                rows.append(
+                    (
+                        user_id,
+                        entry["name"],
+                        duration,
+                        entry["file_path"],
+                        payload["artist"],
+                        payload["pic_url"],
+                        payload["is_self"],
+                        music_id,
+                        entry["file_size"],
+                        content_hash,
+                    )
+                )
+            result.update(
+                {
+                    "status": "saved",
+                    # 64 位ID超出 JavaScript 的安全整数范围，统一以字符串返回
+                    "music_id": str(music_id),
+                    "duration": duration,
+                    "file_size": entry["file_size"],
+                    "sha256": content_hash,
+                }
+            )
 
+        # 一条多行 INSERT 写入所有新歌曲，同一事务中增加文件引用数
+        query = """
+            INSERT INTO audio_files (user_id, filename, duration, file_path, artist, pic_url, is_self, music_id, file_size, content_hash)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        DatabaseManager.execute_many(query, rows)
+        BlobStore.add_refs([(row[9], row[3], row[8]) for row in rows])
+
+        # 按上传顺序加入歌单
+        if rows:
+            existing.update(
+                PlaylistService.tracks_by_hash(
+                    user_id, playlist_type, [row[9] for row in rows]
+                )
+            )
+        PlaylistService.add(
+            user_id,
+            playlist_type,
+            [existing[content_hash]["id"] for content_hash in listed],
+        )
+
+        # 上传时已按新内容计入已用空间，这里按实际写入的歌曲修正；
+        # 预先计入的部分只在登记还在时扣除一次，重复执行的任务只计入本次写入的歌曲
+        if "charge_id" in payload:
+            charged = counters.settle_charge(payload["charge_id"])
+        else:
+            # 没有登记ID的旧任务
+            charged = payload.get(
+                "charged", sum(entry["file_size"] for entry in payload["files"])
+            )
+        counters.add_user_files(
+            user_id, len(rows), sum(row[8] for row in rows) - charged
+        )
+
+    return {"saved": len(listed), "results": results}
 
-@app.route("/user_avatars/<username>/<filename>")
+
+@bp.route("/user_avatars/<username>/<filename>")
 def uploaded_file(username, filename):
     """根据用户名获取头像"""
     user_folder = os.path.join(UPLOAD_FOLDER, username)
@@ -371,7 +3434,7 @@ def uploaded_file(username, filename):
         return jsonify({"error": "File not found"}), 404
 
 
-@app.route("/register", methods=["POST"])
+@bp.route("/register", methods=["POST"])
 def register():
     """用户注册接口"""
     try:
@@ -414,7 +3477,7 @@ def register():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/login", methods=["POST"])
+@bp.route("/login", methods=["POST"])
 def login():
     try:
         data = request.get_json()
@@ -424,7 +3487,7 @@ def login():
         if not all([username, password]):
             return jsonify({"error": "Missing credentials"}), 400
 
-        user = UserService.get_user_by_username(username)
+        user = UserService.get_user_by_username(username, use_cache=False)
         if not user:
             return jsonify({"error": "User not found"}), 404
 
@@ -464,7 +3527,7 @@ def login():
 
 
 # 管理员登录接口
-@app.route("/admin/login", methods=["POST"])
+@bp.route("/admin/login", methods=["POST"])
 def admin_login():
     try:
         data = request.get_json()
@@ -488,31 +3551,17 @@ def admin_login():
 
 
 # 管理员获取统计数据接口
-@app.route("/admin/stats", methods=["GET"])
+@bp.route("/admin/stats", methods=["GET"])
 def get_admin_stats():
     try:
-        # 用户总数
-        users_query = "SELECT COUNT(*) AS count FROM users"
-        users_result = DatabaseManager.execute_query(users_query, fetch=True)
-
-        # 音乐总数 - 从global_music表获取
-        songs_query = "SELECT COUNT(*) AS count FROM global_music"
-        songs_result = DatabaseManager.execute_query(songs_query, fetch=True)
-
-        # 存储空间使用
-        storage_query = "SELECT SUM(file_size) AS total FROM global_music"
-        storage_result = DatabaseManager.execute_query(storage_query, fetch=True)
-
+        # 计数器在写入数据时增减，不扫描数据表
+        totals = counters.totals()
         return (
             jsonify(
                 {
-                    "totalUsers": users_result[0]["count"] if users_result else 0,
-                    "totalSongs": songs_result[0]["count"] if songs_result else 0,
-                    "storageUsed": (
-                        storage_result[0]["total"]
-                        if storage_result and storage_result[0]["total"]
-                        else 0
-                    ),
+                    "totalUsers": totals[StatsCounters.USERS],
+                    "totalSongs": totals[StatsCounters.SONGS],
+                    "storageUsed": totals[StatsCounters.STORAGE],
                 }
             ),
             200,
@@ -522,8 +3571,41 @@ def get_admin_stats():
         return jsonify({"error": str(e)}), 500
 
 
+# 管理员获取数据库连接池统计
+@bp.route("/admin/db/pool", methods=["GET"])
+def get_admin_pool_stats():
+    # 验证管理员身份
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Admin_"):
+        return jsonify({"error": "未授权访问"}), 401
+
+    return jsonify({"pid": os.getpid(), "pool": DatabaseManager.pool_stats()}), 200
+
+
+@bp.route("/admin/cache", methods=["GET"])
+def get_admin_cache_stats():
+    # 验证管理员身份
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Admin_"):
+        return jsonify({"error": "未授权访问"}), 401
+
+    return (
+        jsonify(
+            {
+                "pid": os.getpid(),
+                "user_cache": user_cache.stats(),
+                "playlist_cache": playlist_cache.stats(),
+                "disabled_music": disabled_music.stats(),
+                "music_search": music_search.stats(),
+                "user_search": user_search.stats(),
+            }
+        ),
+        200,
+    )
+
+
 # 获取用户列表
-@app.route("/admin/users", methods=["GET"])
+@bp.route("/admin/users", methods=["GET"])
 def admin_get_users():
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -531,32 +3613,82 @@ def admin_get_users():
         return jsonify({"error": "未授权访问"}), 401
 
     try:
-        # 获取分页参数
-        page = int(request.args.get("page", 1))
         search = request.args.get("search", "")
+        page_size = parse_page_size()
 
-        # 每页显示数量
-        per_page = 10
-        offset = (page - 1) * per_page
-
+        # 已标记删除、等待清理的用户不显示
+        conditions = ["deleted_at IS NULL"]
+        params = []
         if search:
-            query = "SELECT * FROM users WHERE username LIKE %s ORDER BY id DESC LIMIT %s OFFSET %s"
-            params = (f"%{search}%", per_page, offset)
-        else:
-            query = "SELECT * FROM users ORDER BY id DESC LIMIT %s OFFSET %s"
-            params = (per_page, offset)
-
-        result = DatabaseManager.execute_query(query, params, fetch=True)
-
-        return jsonify({"users": result}), 200
+            conditions.append("username LIKE %s")
+            params.append(f"%{search}%")
+
+        select = "SELECT * FROM users"
+        page = request.args.get("page")
+        ids = None
+        if search and current_app.config["SEARCH_INDEX_ENABLED"]:
+            # 用 n-gram 索引按相关度排序，不扫描全表；索引未就绪时为 None
+            ids = user_search.search(search)
+        if ids is not None:
+            offset = (int(page) - 1) * page_size if page else 0
+            page_ids, next_cursor, prev_cursor = ranked_page(
+                ids, request.args.get("cursor"), page_size, offset
+            )
+            response = {
+                "users": fetch_rows_in_order(
+                    select, "id", page_ids, "deleted_at IS NULL"
+                ),
+                "next_cursor": next_cursor,
+                "prev_cursor": prev_cursor,
+                "page_size": page_size,
+            }
+            if request.args.get("with_total"):
+                response["estimated_total"] = len(ids)
+            return jsonify(response), 200
+
+        if page and not request.args.get("cursor"):
+            # 兼容旧的按页码分页
+            offset = (int(page) - 1) * page_size
+            query = select
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += " ORDER BY id DESC LIMIT %s OFFSET %s"
+            result = DatabaseManager.execute_query(
+                query, (*params, page_size, offset), fetch=True
+            )
+            return jsonify({"users": result}), 200
+
+        result, next_cursor, prev_cursor = keyset_page(
+            select,
+            conditions,
+            params,
+            [("id", "id")],
+            request.args.get("cursor"),
+            page_size,
+        )
+        response = {
+            "users": result,
+            "next_cursor": next_cursor,
+            "prev_cursor": prev_cursor,
+            "page_size": page_size,
+        }
+        if request.args.get("with_total"):
+            response["estimated_total"] = estimate_total(
+                "users", select, conditions, params
+            )
+        return jsonify(response), 200
 
+    except InvalidCursorError as e:
+        return jsonify({"error": str(e)}), 400
+    except ValueError:
+        return jsonify({"error": "分页参数无效"}), 400
     except Exception as e:
         logger.error(f"Admin get users error: {e}")
         return jsonify({"error": "获取用户列表失败"}), 500
 
 
 # 获取单个用户详情
-@app.route("/admin/users/<int:user_id>", methods=["GET"])
+@bp.route("/admin/users/<int:user_id>", methods=["GET"])
 def admin_get_user(user_id):
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -565,7 +3697,7 @@ def admin_get_user(user_id):
 
     try:
         # 获取用户信息
-        query = "SELECT id, username, nickname, avatar_url, intro, created_at, security_question, security_answer FROM users WHERE id = %s"
+        query = "SELECT id, username, nickname, avatar_url, intro, created_at, security_question, security_answer, storage_quota FROM users WHERE id = %s AND deleted_at IS NULL"
         params = (user_id,)
         user_result = DatabaseManager.execute_query(query, params, fetch=True)
 
@@ -575,16 +3707,8 @@ def admin_get_user(user_id):
         user = user_result[0]
 
         # 获取用户统计信息
-        stats_query = """
-            SELECT 
-                COUNT(*) as song_count,
-                COALESCE(SUM(file_size), 0) as storage_used
-            FROM audio_files
-            WHERE user_id = %s
-        """
-        stats_result = DatabaseManager.execute_query(
-            stats_query, (user_id,), fetch=True
-        )
+        statistics = counters.user_stats(user_id)
+        statistics["storage_quota"] = UserService.storage_quota(user)
 
         # 头像处理
         if user.get("avatar_url"):
@@ -592,9 +3716,7 @@ def admin_get_user(user_id):
             user["avatar_url"] = f"{host}{user['avatar_url']}"
 
         return (
-            jsonify(
-                {"user": user, "statistics": stats_result[0] if stats_result else None}
-            ),
+            jsonify({"user": user, "statistics": statistics}),
             200,
         )
 
@@ -604,7 +3726,7 @@ def admin_get_user(user_id):
 
 
 # 删除用户
-@app.route("/admin/users/<int:user_id>", methods=["DELETE"])
+@bp.route("/admin/users/<int:user_id>", methods=["DELETE"])
 def admin_delete_user(user_id):
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -613,66 +3735,75 @@ def admin_delete_user(user_id):
 
     try:
         # 检查用户是否存在
-        query = "SELECT username FROM users WHERE id = %s"
-        params = (user_id,)
-        user_result = DatabaseManager.execute_query(query, params, fetch=True)
-
-        if not user_result:
+        user = UserService.get_user_by_id(user_id)
+        if not user:
             return jsonify({"error": "用户不存在"}), 404
 
-        username = user_result[0]["username"]
+        # 只标记删除，音频记录、文件和目录由后台任务清理
+        user_purges.tombstone(user)
 
-        # 删除用户的音频文件
-        query = "SELECT file_path FROM audio_files WHERE user_id = %s"
-        params = (user_id,)
-        files_result = DatabaseManager.execute_query(query, params, fetch=True)
+        return (
+            jsonify(
+                {
+                    "success": True,
+                    "message": "用户删除成功",
+                    "purge": user_purges.progress(user_id),
+                }
+            ),
+            200,
+        )
 
-        for file in files_result:
-            file_path = file["file_path"]
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except:
-                    logger.warning(f"Failed to delete file: {file_path}")
+    except Exception as e:
+        logger.error(f"Admin delete user error: {e}")
+        return jsonify({"error": "删除用户失败"}), 500
 
-        # 删除用户的头像目录
-        avatar_dir = os.path.join(UPLOAD_FOLDER, username)
-        if os.path.exists(avatar_dir):
-            try:
-                shutil.rmtree(avatar_dir)
-            except:
-                logger.warning(f"Failed to delete avatar directory: {avatar_dir}")
 
-        # 删除用户的音频目录
-        audio_dir = os.path.join(UPLOAD_AUDIO_FOLDER, username)
-        if os.path.exists(audio_dir):
-            try:
-                shutil.rmtree(audio_dir)
-            except:
-                logger.warning(f"Failed to delete audio directory: {audio_dir}")
+# 已删除用户的清理进度
+@bp.route("/admin/users/<int:user_id>/purge", methods=["GET"])
+def admin_get_user_purge(user_id):
+    # 验证管理员身份
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Admin_"):
+        return jsonify({"error": "未授权访问"}), 401
 
-        # 删除用户的音频记录
-        query = "DELETE FROM audio_files WHERE user_id = %s"
-        params = (user_id,)
-        DatabaseManager.execute_query(query, params)
-        query = "DELETE FROM global_music WHERE user_id = %s and is_api_music = FALSE"
-        params = (user_id,)
-        DatabaseManager.execute_query(query, params)
+    try:
+        purge = user_purges.progress(user_id)
+        if not purge:
+            return jsonify({"error": "没有该用户的删除记录"}), 404
+        return jsonify({"purge": purge}), 200
 
-        # 最后删除用户
-        query = "DELETE FROM users WHERE id = %s"
-        params = (user_id,)
-        DatabaseManager.execute_query(query, params)
+    except Exception as e:
+        logger.error(f"Admin get user purge error: {e}")
+        return jsonify({"error": "获取清理进度失败"}), 500
+
+
+# 重新执行失败的清理（自动重试次数用完后）
+@bp.route("/admin/users/<int:user_id>/purge", methods=["POST"])
+def admin_retry_user_purge(user_id):
+    # 验证管理员身份
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Admin_"):
+        return jsonify({"error": "未授权访问"}), 401
 
-        return jsonify({"success": True, "message": "用户删除成功"}), 200
+    try:
+        query = """
+            UPDATE user_purges SET attempts = 0, last_error = NULL
+            WHERE user_id = %s AND status <> 'done'
+        """
+        if not DatabaseManager.execute_query(query, (user_id,)):
+            return jsonify({"error": "没有需要清理的数据"}), 404
+        DatabaseManager.after_commit(
+            lambda: jobs.submit("user_purge", {"user_id": user_id})
+        )
+        return jsonify({"purge": user_purges.progress(user_id)}), 202
 
     except Exception as e:
-        logger.error(f"Admin delete user error: {e}")
-        return jsonify({"error": "删除用户失败"}), 500
+        logger.error(f"Admin retry user purge error: {e}")
+        return jsonify({"error": "重新清理失败"}), 500
 
 
 # 获取所有用户
-@app.route("/admin/users/all", methods=["GET"])
+@bp.route("/admin/users/all", methods=["GET"])
 def admin_get_all_users():
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -680,7 +3811,9 @@ def admin_get_all_users():
         return jsonify({"error": "未授权访问"}), 401
 
     try:
-        query = "SELECT id, username FROM users ORDER BY username"
+        query = (
+            "SELECT id, username FROM users WHERE deleted_at IS NULL ORDER BY username"
+        )
         result = DatabaseManager.execute_query(query, fetch=True)
 
         return jsonify({"users": result}), 200
@@ -691,7 +3824,7 @@ def admin_get_all_users():
 
 
 # 重置用户密码
-@app.route("/admin/users/<int:user_id>/reset-password", methods=["POST"])
+@bp.route("/admin/users/<int:user_id>/reset-password", methods=["POST"])
 def admin_reset_user_password(user_id):
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -706,17 +3839,15 @@ def admin_reset_user_password(user_id):
             return jsonify({"error": "新密码不能为空"}), 400
 
         # 检查用户是否存在
-        query = "SELECT * FROM users WHERE id = %s"
-        params = (user_id,)
-        user_result = DatabaseManager.execute_query(query, params, fetch=True)
-
-        if not user_result:
+        user = UserService.get_user_by_id(user_id)
+        if not user:
             return jsonify({"error": "用户不存在"}), 404
 
         # 更新密码
         query = "UPDATE users SET password = %s WHERE id = %s"
         params = (new_password, user_id)
         DatabaseManager.execute_query(query, params)
+        UserService.invalidate_user(user["username"], user_id)
 
         return jsonify({"success": True, "message": "密码重置成功"}), 200
 
@@ -725,17 +3856,72 @@ def admin_reset_user_password(user_id):
         return jsonify({"error": "密码重置失败"}), 500
 
 
+# 设置用户的存储额度
+@bp.route("/admin/users/<int:user_id>/quota", methods=["PUT"])
+def admin_set_user_quota(user_id):
+    # 验证管理员身份
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Admin_"):
+        return jsonify({"error": "未授权访问"}), 401
+
+    try:
+        data = request.get_json()
+        # null 表示使用默认额度
+        quota = data.get("quota")
+        if quota is not None and (
+            not isinstance(quota, int) or isinstance(quota, bool) or quota < 0
+        ):
+            return jsonify({"error": "额度必须是非负整数（字节）或 null"}), 400
+
+        user = UserService.get_user_by_id(user_id)
+        if not user:
+            return jsonify({"error": "用户不存在"}), 404
+
+        query = "UPDATE users SET storage_quota = %s WHERE id = %s"
+        DatabaseManager.execute_query(query, (quota, user_id))
+        UserService.invalidate_user(user["username"], user_id)
+
+        user["storage_quota"] = quota
+        return (
+            jsonify(
+                {"success": True, "storage_quota": UserService.storage_quota(user)}
+            ),
+            200,
+        )
+
+    except Exception as e:
+        logger.error(f"Admin set user quota error: {e}")
+        return jsonify({"error": "设置额度失败"}), 500
+
+
+# 按磁盘上的文件重新计算用户的已用空间
+@bp.route("/admin/users/<int:user_id>/storage/reconcile", methods=["POST"])
+def admin_reconcile_user_storage(user_id):
+    # 验证管理员身份
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Admin_"):
+        return jsonify({"error": "未授权访问"}), 401
+
+    try:
+        user = UserService.get_user_by_id(user_id)
+        if not user:
+            return jsonify({"error": "用户不存在"}), 404
+
+        return jsonify(counters.reconcile_user_storage(user_id)), 200
+
+    except Exception as e:
+        logger.error(f"Admin reconcile user storage error: {e}")
+        return jsonify({"error": "重新计算已用空间失败"}), 500
+
+
 # 获取音乐列表
-@app.route("/admin/music", methods=["GET"])
+@bp.route("/admin/music", methods=["GET"])
 def get_admin_music():
     try:
         # token = request.headers.get("Authorization")
-        page = int(request.args.get("page", 1))
         search = request.args.get("search", "")
         user_id = request.args.get("user_id", "")
-
-        limit = 10
-        offset = (page - 1) * limit
+        page_size = parse_page_size()
 
         conditions = []
         params = []
@@ -749,28 +3935,81 @@ def get_admin_music():
             params.append(user_id)
 
         # 构建完整查询
-        query = """
+        select = """
             SELECT gm.*, u.username 
             FROM global_music gm
             LEFT JOIN users u ON gm.user_id = u.id
         """
 
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-
-        query += " ORDER BY gm.created_at DESC LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+        page = request.args.get("page")
+        ids = None
+        if search and current_app.config["SEARCH_INDEX_ENABLED"]:
+            # 用 n-gram 索引按相关度排序，不扫描全表；索引未就绪时为 None
+            def uploaded_by_user(attrs):
+                return str(attrs["user_id"]) == user_id and not attrs["is_api_music"]
 
-        result = DatabaseManager.execute_query(query, tuple(params), fetch=True)
-
-        return jsonify({"music": result}), 200
+            if user_id:
+                ids = music_search.search(search, uploaded_by_user, ("user", user_id))
+            else:
+                ids = music_search.search(search)
+        if ids is not None:
+            offset = (int(page) - 1) * page_size if page else 0
+            page_ids, next_cursor, prev_cursor = ranked_page(
+                ids, request.args.get("cursor"), page_size, offset
+            )
+            response = {
+                "music": fetch_rows_in_order(select, "gm.id", page_ids),
+                "next_cursor": next_cursor,
+                "prev_cursor": prev_cursor,
+                "page_size": page_size,
+            }
+            if request.args.get("with_total"):
+                response["estimated_total"] = len(ids)
+            return jsonify(response), 200
+
+        if page and not request.args.get("cursor"):
+            # 兼容旧的按页码分页
+            offset = (int(page) - 1) * page_size
+            query = select
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += " ORDER BY gm.created_at DESC LIMIT %s OFFSET %s"
+            result = DatabaseManager.execute_query(
+                query, (*params, page_size, offset), fetch=True
+            )
+            return jsonify({"music": result}), 200
+
+        # created_at 可能重复，用 id 保证排序唯一
+        result, next_cursor, prev_cursor = keyset_page(
+            select,
+            conditions,
+            params,
+            [("gm.created_at", "created_at"), ("gm.id", "id")],
+            request.args.get("cursor"),
+            page_size,
+        )
+        response = {
+            "music": result,
+            "next_cursor": next_cursor,
+            "prev_cursor": prev_cursor,
+            "page_size": page_size,
+        }
+        if request.args.get("with_total"):
+            response["estimated_total"] = estimate_total(
+                "global_music", "SELECT gm.id FROM global_music gm", conditions, params
+            )
+        return jsonify(response), 200
+    except InvalidCursorError as e:
+        return jsonify({"error": str(e)}), 400
+    except ValueError:
+        return jsonify({"error": "分页参数无效"}), 400
     except Exception as e:
         logger.error(f"Error getting music list: {e}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
 
 # 获取单个音乐详情
-@app.route("/admin/music/<music_id>", methods=["GET"])
+@bp.route("/admin/music/<music_id>", methods=["GET"])
 def get_admin_music_detail(music_id):
     try:
         query = """
@@ -792,7 +4031,7 @@ def get_admin_music_detail(music_id):
 
 
 # 删除音乐
-@app.route("/admin/music/<int:music_id>", methods=["DELETE"])
+@bp.route("/admin/music/<int:music_id>", methods=["DELETE"])
 def admin_delete_music(music_id):
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -802,27 +4041,21 @@ def admin_delete_music(music_id):
     try:
         # 先获取音乐信息
         query = "SELECT * FROM audio_files WHERE music_id = %s"
-        params = (music_id,)
+        params = (audio_music_id(music_id),)
         result = DatabaseManager.execute_query(query, params, fetch=True)
 
         if not result:
             return jsonify({"error": "音乐不存在"}), 404
 
-        music = result[0]
-
-        # 删除文件
-        file_path = music.get("file_path")
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                logger.warning(f"Failed to delete file: {file_path}")
-
-        # 删除数据库记录
+        # 删除数据库记录，歌单成员关系随外键一起删除
+        PlaylistService.touch_tracks((row["id"] for row in result), "remove")
         query = "DELETE FROM audio_files WHERE music_id = %s"
-        params = (music_id,)
         DatabaseManager.execute_query(query, params)
 
+        # 释放文件引用
+        BlobStore.release(result)
+        counters.remove_files(result)
+
         return jsonify({"success": True, "message": "音乐删除成功"}), 200
 
     except Exception as e:
@@ -830,8 +4063,26 @@ def admin_delete_music(music_id):
         return jsonify({"error": "删除音乐失败"}), 500
 
 
+def sync_disabled_tracks(music_id, disabled):
+    """全局音乐禁用状态变化时，同步用户歌单中对应的API音乐，并记录歌单的变化"""
+    track_music_id = audio_music_id(music_id)
+    if track_music_id is None:
+        return
+    query = """
+        SELECT id FROM audio_files
+        WHERE music_id = %s AND is_api_music = TRUE AND is_disabled <> %s
+    """
+    rows = DatabaseManager.execute_query(query, (track_music_id, disabled), fetch=True)
+    if not rows:
+        return
+    track_ids = [row["id"] for row in rows]
+    query = f"UPDATE audio_files SET is_disabled = %s WHERE id IN ({sql_in_placeholders(track_ids)})"
+    DatabaseManager.execute_query(query, (disabled, *track_ids))
+    PlaylistService.touch_tracks(track_ids)
+
+
 # 音乐权限控制
-@app.route("/admin/music/<music_id>/toggle-disable", methods=["POST"])
+@bp.route("/admin/music/<music_id>/toggle-disable", methods=["POST"])
 def toggle_disable_music(music_id):
     try:
         # 获取当前状态
@@ -852,6 +4103,8 @@ def toggle_disable_music(music_id):
         new_state = not current_state
         update_query = "UPDATE global_music SET is_disabled = %s WHERE music_id = %s"
         DatabaseManager.execute_query(update_query, (new_state, music_id))
+        disabled_music.bump()
+        sync_disabled_tracks(music_id, new_state)
 
         action = "禁用" if new_state else "解除禁用"
 
@@ -862,7 +4115,7 @@ def toggle_disable_music(music_id):
 
 
 # 获取全局音乐详情
-@app.route("/admin/global-music/<string:music_id>", methods=["GET"])
+@bp.route("/admin/global-music/<string:music_id>", methods=["GET"])
 def admin_get_global_music(music_id):
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -893,7 +4146,7 @@ def admin_get_global_music(music_id):
 
 
 # 禁用/解除禁用全局音乐
-@app.route("/admin/global-music/<string:music_id>/toggle-disable", methods=["POST"])
+@bp.route("/admin/global-music/<string:music_id>/toggle-disable", methods=["POST"])
 def admin_toggle_global_music(music_id):
     # 验证管理员身份
     auth_header = request.headers.get("Authorization")
@@ -917,6 +4170,8 @@ def admin_toggle_global_music(music_id):
         query = "UPDATE global_music SET is_disabled = %s WHERE music_id = %s"
         params = (new_state, music_id)
         DatabaseManager.execute_query(query, params)
+        disabled_music.bump()
+        sync_disabled_tracks(music_id, new_state)
 
         message = "音乐已禁用" if new_state else "音乐已解除禁用"
         return (
@@ -929,82 +4184,62 @@ def admin_toggle_global_music(music_id):
         return jsonify({"error": "操作失败"}), 500
 
 
-@app.route("/api/music/status", methods=["GET"])
+@bp.route("/api/music/status", methods=["GET"])
 def check_music_status():
-    """检查音乐是否被禁用"""
+    """检查音乐是否被禁用，ETag 随禁用列表的版本号变化"""
     try:
         music_id = request.args.get("id")
         if not music_id:
             return jsonify({"error": "Music ID is required"}), 400
 
-        # # 记录请求的ID
-        # logger.info(f"[STATUS CHECK] Received request for music_id: {music_id}")
-
-        # 先直接在global_music表中查找完全匹配
-        query1 = "SELECT is_disabled FROM global_music WHERE music_id = %s"
-        direct_result = DatabaseManager.execute_query(query1, (music_id,), fetch=True)
-
-        if direct_result:
-            # logger.info(
-            #     f"[STATUS CHECK] Direct match found in global_music: {direct_result}"
-            # )
-            return jsonify({"is_disabled": direct_result[0]["is_disabled"]}), 200
-
-        # 如果直接匹配失败，尝试通过audio_files表查询引用
-        query2 = """
-            SELECT gm.is_disabled 
-            FROM audio_files af
-            JOIN global_music gm ON af.music_id = gm.music_id
-            WHERE af.reference_id = %s OR af.music_id = %s
-        """
-        ref_result = DatabaseManager.execute_query(
-            query2, (music_id, music_id), fetch=True
+        version, is_disabled = disabled_music.is_disabled(music_id)
+        etag = f"disabled-music-{version}-{int(is_disabled)}"
+        return not_modified(etag) or with_etag(
+            jsonify({"is_disabled": is_disabled}), etag
         )
 
-        if ref_result:
-            # logger.info(f"[STATUS CHECK] Reference match found: {ref_result}")
-            return jsonify({"is_disabled": ref_result[0]["is_disabled"]}), 200
-
-        # 如果还找不到，最后一次尝试使用like模式匹配
-        query3 = """
-            SELECT gm.is_disabled
-            FROM global_music gm
-            WHERE gm.music_id LIKE %s
-        """
-        like_result = DatabaseManager.execute_query(
-            query3, (f"%{music_id}%",), fetch=True
-        )
+    except Exception as e:
+        logger.error(f"[STATUS CHECK] Error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        if like_result:
-            # logger.info(f"[STATUS CHECK] Like match found: {like_result}")
-            return jsonify({"is_disabled": like_result[0]["is_disabled"]}), 200
 
-        # 实在找不到，认为未禁用
-        logger.info(
-            # f"[STATUS CHECK] No match found for {music_id}, assuming not disabled"
-        )
-        return jsonify({"is_disabled": False}), 200
+@bp.route("/api/music/status/batch", methods=["POST"])
+def check_music_status_batch():
+    """批量检查音乐是否被禁用，返回 {ID: 是否被禁用}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        music_ids = data.get("ids")
+        if not isinstance(music_ids, list) or not music_ids:
+            return jsonify({"error": "ids must be a non-empty list"}), 400
+        limit = current_app.config["MUSIC_STATUS_BATCH_LIMIT"]
+        if len(music_ids) > limit:
+            return jsonify({"error": f"At most {limit} ids per request"}), 400
+
+        # 客户端可能传数字形式的ID
+        music_ids = [str(music_id) for music_id in music_ids]
+        version, statuses = disabled_music.statuses(music_ids)
+        return jsonify({"statuses": statuses, "version": version}), 200
 
     except Exception as e:
-        logger.error(f"[STATUS CHECK] Error: {str(e)}")
+        logger.error(f"[STATUS CHECK] Batch error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/api/disabled-music", methods=["GET"])
+@bp.route("/api/disabled-music", methods=["GET"])
 def get_disabled_music():
-    """获取所有被禁用的音乐列表"""
+    """获取所有被禁用的音乐列表，ETag 为禁用列表的版本号"""
     try:
-        query = "SELECT music_id FROM global_music WHERE is_disabled = TRUE"
-        result = DatabaseManager.execute_query(query, fetch=True)
-
-        disabled_ids = [item["music_id"] for item in result]
-        return jsonify({"disabled_music_ids": disabled_ids}), 200
+        version, disabled_ids = disabled_music.snapshot()
+        etag = f"disabled-music-{version}"
+        return not_modified(etag) or with_etag(
+            jsonify({"disabled_music_ids": sorted(disabled_ids)}), etag
+        )
     except Exception as e:
         logger.error(f"Error getting disabled music: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/api/user/update", methods=["POST"])
+@bp.route("/api/user/update", methods=["POST"])
 def update_user():
     """更新用户信息和密码接口"""
     try:
@@ -1098,7 +4333,7 @@ def update_user():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/verify-security", methods=["POST"])
+@bp.route("/verify-security", methods=["POST"])
 def verify_security():
     """验证安全问题"""
     try:
@@ -1106,7 +4341,7 @@ def verify_security():
         username = data.get("username")
         security_answer = data.get("security_answer")
 
-        user = UserService.get_user_by_username(username)
+        user = UserService.get_user_by_username(username, use_cache=not security_answer)
         if not user:
             return jsonify({"error": "User not found"}), 404
 
@@ -1123,14 +4358,59 @@ def verify_security():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/upload/audio", methods=["POST"])
+@bp.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """查询后台任务状态"""
+    try:
+        job = jobs.get(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        logger.error(f"Error getting job {job_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/upload/audio", methods=["POST"])
 def upload_audio():
     """
     1、检索文件夹音频：上传多个音频 / 没有音频
     2、上传音频：上传单个音频
+    文件保存后即返回任务ID，时长分析和批量入库在后台任务中完成（UPLOAD_ASYNC_PROCESSING）
     """
     try:
-        username = request.form.get("username")
+        # 用户名放在查询参数中时，可以在解析请求体之前检查额度
+        username = request.args.get("username") or request.form.get("username")
+        if not username:
+            return jsonify({"error": "Missing username"}), 400
+
+        user = UserService.get_user_by_username(username)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+
+        user_id = user["id"]
+
+        # 已用空间由计数器维护，不扫描 audio_files
+        quota = UserService.storage_quota(user)
+        remaining = None
+        if quota is not None:
+            used = counters.user_stats(user_id)["storage_used"]
+            remaining = quota - used
+            content_length = request.content_length or 0
+            if remaining <= 0 or (
+                "username" in request.args and content_length > remaining
+            ):
+                return (
+                    jsonify(
+                        {
+                            "error": "Storage quota exceeded",
+                            "quota": quota,
+                            "used": used,
+                        }
+                    ),
+                    413,
+                )
+
         files = request.files.getlist("audio_files")
         is_self = request.form.get("is_self")
 
@@ -1141,76 +4421,137 @@ def upload_audio():
         playlist_type = request.form.get("playlist_type")
         pic_url = "burger.png"
 
-        if not username:
-            return jsonify({"error": "Missing username"}), 400
-
-        user = UserService.get_user_by_username(username)
-        if not user:
-            return jsonify({"error": "User not found"}), 404
-
-        user_id = user["id"]
-
+        # 每个文件的处理结果，顺序与上传顺序一致
+        results = []
+        candidates = []
         for file in files:
+            result = {"filename": file.filename}
+            results.append(result)
             if not allowed_audio_file(file.filename):
+                result["status"] = "invalid_type"
                 continue
+            # 入库的歌曲名不带目录和后缀：dir/test.mp3 -> test
+            result["name"] = os.path.splitext(file.filename.split("/")[-1])[0]
+            candidates.append((file, result))
+
+        # 整个请求都不超过剩余额度时不用逐个计算大小；否则按上传顺序保留放得下的文件
+        if remaining is not None and (request.content_length or 0) > remaining:
+            within_quota = []
+            for file, result in candidates:
+                size = uploaded_file_size(file)
+                if size > remaining:
+                    result["status"] = "quota_exceeded"
+                    continue
+                remaining -= size
+                within_quota.append((file, result))
+            candidates = within_quota
+
+        # 边保存边计算 SHA-256，相同内容的文件只保存一份
+        stored = []
+        for file, result in candidates:
+            try:
+                content_hash, file_path, file_size = blob_store.save(file)
+            except OSError as e:
+                logger.error(f"Error saving audio file {file.filename}: {e}")
+                result["status"] = "save_failed"
+                continue
+            stored.append((result, content_hash, file_path, file_size))
 
-            # 检查是否存在同名文件
-            print("user_id", user_id)
-            print("file.filename", file.filename)
-            print("playlist_type", playlist_type)
-            query = "SELECT * FROM audio_files WHERE user_id = %s AND filename = %s AND playlist_type = %s"
-            params = (user_id, file.filename, playlist_type)
-            existing_files = DatabaseManager.execute_query(query, params, fetch=True)
-
-            print(existing_files, "test1111")
+        # 一次查询检查用户已有的相同内容（同名但内容不同的歌曲可以共存）：
+        # 已在该歌单中的跳过；在其他歌单中的只加入歌单，不占用额度
+        owned = PlaylistService.tracks_by_hash(
+            user_id, playlist_type, [content_hash for _, content_hash, _, _ in stored]
+        )
+        existing_hashes = {
+            content_hash
+            for content_hash, track in owned.items()
+            if track["in_playlist"]
+        }
 
-            if existing_files:
+        saved_files = []
+        charged = 0
+        for result, content_hash, file_path, file_size in stored:
+            result["sha256"] = content_hash
+            if content_hash in existing_hashes:
                 logger.info(
-                    f"User {username} already has a file named {file.filename}. Skipping save."
+                    f"User {username} already has the content of {result['filename']}. Skipping save."
                 )
+                result["status"] = "exists"
                 continue
+            # 同一次上传中内容相同的文件只保留第一个
+            existing_hashes.add(content_hash)
+            if content_hash not in owned:
+                charged += file_size
 
-            # 获取音频大小
-            file.stream.seek(0, os.SEEK_END)
-            file_size = file.stream.tell()
-            file.stream.seek(0)
-
-            print("--------------------file_size---------------------------", file_size)
-
-            # 保存音频文件
-            file_path, filename = save_audio_file(file, username)
-
-            if not file_path:
-                continue
-
-            # 处理filename,test.mp3 -> test
-            filename = os.path.splitext(filename)[0]
-
-            # 获取音频时长
-            duration = get_audio_duration(file_path)
+            result["status"] = "queued"
+            saved_files.append(
+                {
+                    "filename": result["filename"],
+                    "name": result["name"],
+                    "file_path": file_path,
+                    "file_size": file_size,
+                    "content_hash": content_hash,
+                }
+            )
 
-            # 生成唯一音频id，当前时间戳 + 随机数
-            musics_id = int(time.time()) + random.randint(1000, 9999)
-            # 保存到数据库
-            query = """
-                INSERT INTO audio_files (user_id, filename, duration, file_path,artist, playlist_type,pic_url,is_self,music_id,file_size)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s,%s,%s)
-            """
-            params = (
-                user_id,
-                filename,
-                duration,
-                file_path,
-                artist,
-                playlist_type,
-                pic_url,
-                is_self,
-                musics_id,
-                file_size,
+        # 检查和计入已用空间是一条 UPDATE；同时进行的其他上传先用完了额度时，本次保存的文件都不入库
+        charge_id = None
+        if charged:
+            if counters.charge_storage(user_id, charged, quota):
+                charge_id = counters.record_charge(user_id, charged)
+            else:
+                for result in results:
+                    if result.get("status") == "queued":
+                        result["status"] = "quota_exceeded"
+                saved_files = []
+
+        payload = {
+            "user_id": user_id,
+            "playlist_type": playlist_type,
+            "artist": artist,
+            "pic_url": pic_url,
+            "is_self": is_self,
+            "files": saved_files,
+            "charged": charged,
+            "charge_id": charge_id,
+        }
+
+        # 文件落盘后立即返回，时长分析和入库由后台任务完成。
+        # 任务在请求事务提交后才提交：回滚时登记的扣费和 blob 行都不存在，任务不能执行
+        if saved_files and current_app.config["UPLOAD_ASYNC_PROCESSING"]:
+            job_id = uuid.uuid4().hex
+            DatabaseManager.after_commit(
+                lambda: jobs.submit("upload_analysis", payload, job_id)
+            )
+            return (
+                jsonify(
+                    {
+                        "message": "Audio files received",
+                        "job_id": job_id,
+                        "results": results,
+                    }
+                ),
+                202,
             )
-            DatabaseManager.execute_query(query, params)
 
-        return jsonify({"message": "Audio files processed successfully"}), 200
+        # 同步处理：请求回滚时已保存的文件没有登记引用，由 blob_gc 回收
+        processed = process_uploaded_audio(payload)
+        # 用分析结果替换 queued 状态
+        processed_results = iter(processed["results"])
+        for result in results:
+            if result.get("status") == "queued":
+                result.update(next(processed_results))
+
+        return (
+            jsonify(
+                {
+                    "message": "Audio files processed successfully",
+                    "saved": processed["saved"],
+                    "results": results,
+                }
+            ),
+            200,
+        )
 
     except Exception as e:
         logger.error(f"Error uploading audio files: {e}")
@@ -1222,7 +4563,7 @@ def upload_audio():
 """
 
 
-@app.route("/api/playlist/add", methods=["POST"])
+@bp.route("/api/playlist/add", methods=["POST"])
 def add_to_playlist():
     try:
         # 音频两种
@@ -1249,10 +4590,11 @@ def add_to_playlist():
         if not user_id:
             return jsonify({"error": "User not found"}), 404
 
-        # 查询是否已存在该歌曲
-        query = "SELECT * FROM audio_files WHERE user_id = %s AND filename = %s AND playlist_type = %s"
-        params = (user_id, song_name, playlist_type)
-        existing_files = DatabaseManager.execute_query(query, params, fetch=True)
+        # 查询歌单中是否已存在该歌曲
+        params = (user_id, playlist_type, user_id, song_name)
+        existing_files = DatabaseManager.execute_query(
+            PLAYLIST_TRACK_BY_FILENAME_QUERY, params, fetch=True
+        )
 
         if existing_files:
             return jsonify({"message": "Audio already exists in playlist"}), 400
@@ -1283,62 +4625,50 @@ def add_to_playlist():
                     song_size,
                 )
                 DatabaseManager.execute_query(global_query, global_params)
+                counters.add(songs=1, storage=file_size_of(song_size))
+                music_search.changed()
 
-            # 关联用户
-            query = """
-                INSERT INTO audio_files 
-                (user_id, filename, duration, artist, playlist_type, pic_url, music_id, is_api_music, reference_id) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
+            # 关联用户：同一首API音乐只有一行歌曲，加入其他歌单时只增加歌单成员
+            track_id = PlaylistService.api_track(user_id, music_id)
+            if track_id is None:
+                query = """
+                    INSERT INTO audio_files 
+                    (user_id, filename, duration, artist, pic_url, music_id, is_api_music) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """
+                params = (
+                    user_id,
+                    song_name,
+                    duration,
+                    artist,
+                    pic_url,
+                    music_id,
+                    True,
+                )
+                DatabaseManager.execute_query(query, params)
+                track_id = PlaylistService.api_track(user_id, music_id)
+                counters.add_user_files(user_id, 1, 0)
             gen_music_id = f"user_{user_id}_api_{music_id}_playlist_{playlist_type}"
-            params = (
-                user_id,
-                song_name,
-                duration,
-                artist,
-                playlist_type,
-                pic_url,
-                music_id,
-                True,
-                gen_music_id,
-            )
-            DatabaseManager.execute_query(query, params)
+            PlaylistService.add(user_id, playlist_type, [(track_id, gen_music_id)])
         else:
             # 自定义音频
             print("触发自定义音频处理")
             # 在audio_files表中查找该歌名
-            query = "SELECT * FROM audio_files WHERE user_id = %s AND filename LIKE %s"
             params = (user_id, f"%{song_name}%")
-            existing_files = DatabaseManager.execute_query(query, params, fetch=True)
+            existing_files = DatabaseManager.execute_query(
+                TRACKS_BY_NAME_QUERY, params, fetch=True
+            )
 
             print(existing_files, "test")
             if existing_files:
                 print("歌名存在")
-                query = """
-                    INSERT INTO audio_files (user_id, filename, duration, file_path,artist, playlist_type,pic_url,is_self,music_id,file_size)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s,%s)
-                """
-                params = (
-                    user_id,
-                    existing_files[0]["filename"],
-                    existing_files[0]["duration"],
-                    existing_files[0]["file_path"],
-                    existing_files[0]["artist"],
-                    playlist_type,
-                    existing_files[0]["pic_url"],
-                    is_self,
-                    existing_files[0]["music_id"],
-                    existing_files[0]["file_size"],
-                )
-                DatabaseManager.execute_query(query, params)
+                # 歌曲已属于用户，只加入歌单，文件引用和已用空间不变
+                PlaylistService.add(user_id, playlist_type, [existing_files[0]["id"]])
 
                 # 检查管理端该用户是否已添加过该歌曲
-                check_query = (
-                    "SELECT * FROM global_music WHERE music_id = %s AND user_id = %s"
-                )
                 check_params = (music_id, user_id)
                 global_music = DatabaseManager.execute_query(
-                    check_query, check_params, fetch=True
+                    USER_GLOBAL_MUSIC_QUERY, check_params, fetch=True
                 )
 
                 if not global_music:
@@ -1361,6 +4691,8 @@ def add_to_playlist():
                     )
 
                     DatabaseManager.execute_query(global_query, global_params)
+                    counters.add(songs=1, storage=file_size_of(song_size))
+                    music_search.changed()
 
         return jsonify({"message": "Audio added to playlist successfully"}), 200
 
@@ -1369,7 +4701,261 @@ def add_to_playlist():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/audio", methods=["GET"])
+@bp.route("/api/playlist/add/batch", methods=["POST"])
+def add_to_playlist_batch():
+    """
+    批量加入歌单，每首歌的字段与 /api/playlist/add 相同，返回每首歌的结果：
+    added 已加入，exists 歌单中已有同名歌曲，duplicate 与本次请求中前面的歌曲重复，
+    not_found 自定义歌曲不存在，invalid 缺少音乐ID或格式错误。
+    用户只查询一次，存在性检查和写入都按集合批量执行，全部在请求的事务中
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        username = data.get("username")
+        playlist_type = data.get("playlist_type")
+        songs = data.get("songs")
+        if not username or not playlist_type:
+            return jsonify({"error": "Missing required fields"}), 400
+        if not isinstance(songs, list) or not songs:
+            return jsonify({"error": "songs must be a non-empty list"}), 400
+        limit = current_app.config["PLAYLIST_BATCH_LIMIT"]
+        if len(songs) > limit:
+            return jsonify({"error": f"At most {limit} songs per request"}), 400
+
+        user = UserService.get_user_by_username(username)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        user_id = user["id"]
+
+        results = [
+            {"music_id": song.get("music_id") if isinstance(song, dict) else None}
+            for song in songs
+        ]
+        pending = []  # (下标, 歌曲)
+        seen = set()
+        for i, song in enumerate(songs):
+            if not isinstance(song, dict) or not song.get("song_name"):
+                results[i]["status"] = "invalid"
+                continue
+            is_self = bool(song.get("is_self"))
+            if not is_self and audio_music_id(song.get("music_id")) is None:
+                results[i]["status"] = "invalid"
+                continue
+            key = (
+                is_self,
+                song["song_name"] if is_self else audio_music_id(song["music_id"]),
+            )
+            if key in seen:
+                results[i]["status"] = "duplicate"
+                continue
+            seen.add(key)
+            pending.append((i, song))
+
+        # 歌单中已有同名歌曲的跳过
+        names = {song["song_name"] for _, song in pending}
+        listed = set()
+        for chunk in chunked(names):
+            query = f"""
+                SELECT af.filename FROM playlist_entries pe
+                JOIN audio_files af ON af.id = pe.track_id
+                WHERE pe.user_id = %s AND pe.playlist_type = %s AND af.user_id = %s
+                  AND af.filename IN ({sql_in_placeholders(chunk)})
+            """
+            rows = DatabaseManager.execute_query(
+                query, (user_id, playlist_type, user_id, *chunk), fetch=True
+            )
+            listed.update(row["filename"] for row in rows)
+        api_songs, self_songs = [], []
+        for i, song in pending:
+            if song["song_name"] in listed:
+                results[i]["status"] = "exists"
+            elif song.get("is_self"):
+                self_songs.append((i, song))
+            else:
+                api_songs.append((i, song))
+
+        entries = []
+        if api_songs:
+            entries += add_api_songs(user_id, playlist_type, api_songs, results)
+        if self_songs:
+            entries += add_self_songs(
+                user_id, username, playlist_type, self_songs, results
+            )
+        # 按请求中的顺序加入歌单
+        entries.sort(key=lambda entry: entry[0])
+        PlaylistService.add(user_id, playlist_type, [entry[1] for entry in entries])
+
+        added = sum(1 for result in results if result["status"] == "added")
+        return jsonify({"added": added, "results": results}), 200
+
+    except Exception as e:
+        logger.error(f"Error adding audio to playlist in batch: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def add_api_songs(user_id, playlist_type, songs, results):
+    """
+    批量加入API音乐：补充缺少的 global_music 和用户的歌曲行，返回 [(下标, (歌曲ID, 引用ID))]
+    :param songs: [(下标, 歌曲)]，音乐ID各不相同
+    """
+    by_id = {str(song["music_id"]): (i, song) for i, song in songs}
+
+    # 管理端不存在的API音乐，多行插入
+    existing = set()
+    for chunk in chunked(by_id):
+        query = GLOBAL_MUSIC_IDS_QUERY.format(music_ids=sql_in_placeholders(chunk))
+        rows = DatabaseManager.execute_query(query, chunk, fetch=True)
+        existing.update(row["music_id"] for row in rows)
+    missing = [
+        song for music_id, (_, song) in by_id.items() if music_id not in existing
+    ]
+    if missing:
+        query = """
+            INSERT INTO global_music
+            (music_id, name, artist, duration, pic_url, is_api_music, user_id, file_size)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        DatabaseManager.execute_many(
+            query,
+            [
+                (
+                    str(song["music_id"]),
+                    song["song_name"],
+                    song.get("artist"),
+                    song.get("duration"),
+                    song.get("pic_url"),
+                    True,
+                    user_id,
+                    song.get("song_size"),
+                )
+                for song in missing
+            ],
+        )
+        counters.add(
+            songs=len(missing),
+            storage=sum(file_size_of(song.get("song_size")) for song in missing),
+        )
+        music_search.changed()
+
+    # 用户还没有的API音乐插入歌曲行，已有的只加入歌单；按整数音乐ID对应
+    def api_tracks():
+        tracks = {}
+        track_music_ids = [audio_music_id(music_id) for music_id in by_id]
+        for chunk in chunked(track_music_ids):
+            query = f"""
+                SELECT id, music_id FROM audio_files
+                WHERE user_id = %s AND is_api_music = TRUE
+                  AND music_id IN ({sql_in_placeholders(chunk)})
+            """
+            rows = DatabaseManager.execute_query(query, (user_id, *chunk), fetch=True)
+            for row in rows:
+                tracks.setdefault(row["music_id"], row["id"])
+        return tracks
+
+    tracks = api_tracks()
+    new = [
+        song
+        for music_id, (_, song) in by_id.items()
+        if audio_music_id(music_id) not in tracks
+    ]
+    if new:
+        query = """
+            INSERT INTO audio_files
+            (user_id, filename, duration, artist, pic_url, music_id, is_api_music)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """
+        DatabaseManager.execute_many(
+            query,
+            [
+                (
+                    user_id,
+                    song["song_name"],
+                    song.get("duration"),
+                    song.get("artist"),
+                    song.get("pic_url"),
+                    audio_music_id(song["music_id"]),
+                    True,
+                )
+                for song in new
+            ],
+        )
+        tracks = api_tracks()
+        counters.add_user_files(user_id, len(new), 0)
+
+    entries = []
+    for music_id, (i, _) in by_id.items():
+        results[i]["status"] = "added"
+        reference_id = f"user_{user_id}_api_{music_id}_playlist_{playlist_type}"
+        entries.append((i, (tracks[audio_music_id(music_id)], reference_id)))
+    return entries
+
+
+def add_self_songs(user_id, username, playlist_type, songs, results):
+    """
+    批量加入用户已上传的自定义歌曲（按歌名模糊匹配，与单首加入相同），返回 [(下标, 歌曲ID)]
+    :param songs: [(下标, 歌曲)]，歌名各不相同
+    """
+    found = {}
+    for chunk in chunked(songs, 100):
+        # 每首歌一个 LIMIT 1 的子查询，合并成一条语句
+        query = " UNION ALL ".join([TRACK_BY_NAME_PROBE] * len(chunk))
+        params = []
+        for i, song in chunk:
+            params += [i, user_id, f"%{song['song_name']}%"]
+        rows = DatabaseManager.execute_query(query, params, fetch=True)
+        found.update((row["idx"], row["id"]) for row in rows)
+
+    entries = []
+    registered = []
+    for i, song in songs:
+        if i not in found:
+            results[i]["status"] = "not_found"
+            continue
+        results[i]["status"] = "added"
+        entries.append((i, found[i]))
+        if song.get("music_id"):
+            registered.append(song)
+
+    # 管理端还没有的自定义歌曲，多行插入；歌曲已属于用户，文件引用和已用空间不变
+    music_ids = [str(song["music_id"]) for song in registered]
+    existing = set()
+    for chunk in chunked(music_ids):
+        query = GLOBAL_MUSIC_IDS_QUERY.format(music_ids=sql_in_placeholders(chunk))
+        rows = DatabaseManager.execute_query(query, chunk, fetch=True)
+        existing.update(row["music_id"] for row in rows)
+    missing = [song for song in registered if str(song["music_id"]) not in existing]
+    if missing:
+        query = """
+            INSERT INTO global_music
+            (music_id, name, artist, duration, pic_url, user_id, is_api_music, username, file_size)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        DatabaseManager.execute_many(
+            query,
+            [
+                (
+                    str(song["music_id"]),
+                    song["song_name"],
+                    song.get("artist"),
+                    song.get("duration"),
+                    song.get("pic_url"),
+                    user_id,
+                    False,
+                    username,
+                    song.get("song_size"),
+                )
+                for song in missing
+            ],
+        )
+        counters.add(
+            songs=len(missing),
+            storage=sum(file_size_of(song.get("song_size")) for song in missing),
+        )
+        music_search.changed()
+    return entries
+
+
+@bp.route("/audio", methods=["GET"])
 def get_audio():
     """根据音频ID生成音频链接"""
     try:
@@ -1390,8 +4976,9 @@ def get_audio():
         #         403,
         #     )
 
-        query = "SELECT file_path FROM audio_files WHERE music_id = %s"
-        result = DatabaseManager.execute_query(query, (audio_id,), fetch=True)
+        result = DatabaseManager.execute_query(
+            AUDIO_PATH_QUERY, (audio_music_id(audio_id),), fetch=True
+        )
 
         if not result:
             return jsonify({"error": "Audio not found"}), 404
@@ -1406,14 +4993,114 @@ def get_audio():
         # 构建完整的 HTTP URL
         host = request.host_url.rstrip("/")  # 获取主机地址
         file_url = f"{host}/static/{os.path.relpath(file_path, start='static')}"
+        # 支持 Range 请求的流接口，拖动进度条时不用从头下载
+        stream_url = f"{host}/api/audio/stream/{urllib.parse.quote(str(audio_id))}"
 
-        return jsonify({"musicUrl": file_url}), 200
+        return jsonify({"musicUrl": file_url, "streamUrl": stream_url}), 200
     except Exception as e:
         logger.error(f"Error fetching audio file URL: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/logout", methods=["GET"])
+def read_file_range(file, length, chunk_size):
+    """从文件当前位置读取 length 字节，读完后关闭文件"""
+    try:
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+@bp.route("/api/audio/stream/<music_id>", methods=["GET", "HEAD"])
+def stream_audio(music_id):
+    """
+    按音乐ID返回音频内容，支持 Range（206）、ETag / Last-Modified 条件请求。
+    请求到文件末尾时交给 WSGI 服务器的 wsgi.file_wrapper（gunicorn 用 os.sendfile 零拷贝发送），
+    配置 AUDIO_SENDFILE_MODE 时只返回头部，由前端代理发送文件。
+    """
+    result = DatabaseManager.execute_query(
+        AUDIO_PATH_QUERY, (audio_music_id(music_id),), fetch=True
+    )
+    if not result or not result[0]["file_path"]:
+        return jsonify({"error": "Audio not found"}), 404
+
+    file_path = result[0]["file_path"]
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return jsonify({"error": "File not found on server"}), 404
+
+    size = stat.st_size
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    # 内容寻址的文件用内容哈希作为 ETag，旧数据用修改时间和大小
+    etag = result[0]["content_hash"] or f"{stat.st_mtime_ns:x}-{size:x}"
+    mimetype = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(last_modified),
+        "Accept-Ranges": "bytes",
+    }
+
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        return Response(status=304, headers=headers)
+
+    sendfile_mode = current_app.config["AUDIO_SENDFILE_MODE"]
+    if sendfile_mode == "x-accel-redirect":
+        relative = os.path.relpath(file_path, start="static").replace(os.sep, "/")
+        headers["X-Accel-Redirect"] = current_app.config[
+            "AUDIO_ACCEL_PREFIX"
+        ] + urllib.parse.quote(relative)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if sendfile_mode == "x-sendfile":
+        headers["X-Sendfile"] = urllib.parse.quote(os.path.abspath(file_path))
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    start, end = 0, size
+    status = 200
+    # If-Range 不匹配（文件已变化）时忽略 Range，返回完整内容
+    if_range = request.if_range
+    range_valid = not (
+        (if_range.etag and if_range.etag != etag)
+        or (if_range.date and if_range.date != last_modified)
+    )
+    if request.range and range_valid and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+
+    if request.method == "HEAD":
+        return Response(status=status, headers=headers, mimetype=mimetype)
+
+    file = open(file_path, "rb")
+    file.seek(start)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    chunk_size = current_app.config["AUDIO_STREAM_CHUNK_SIZE"]
+    if file_wrapper is not None and end == size:
+        # 服务器从文件当前位置发送到末尾，gunicorn 会按 Content-Length 用 sendfile 发送
+        body = file_wrapper(file, chunk_size)
+    else:
+        body = read_file_range(file, end - start, chunk_size)
+    return Response(
+        body,
+        status=status,
+        headers=headers,
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+
+
+@bp.route("/logout", methods=["GET"])
 def logout():
     try:
         return jsonify({"code": 200, "message": "Logout successful"})
@@ -1422,8 +5109,115 @@ def logout():
         return jsonify({"error": "Logout failed"}), 500
 
 
+# 歌单中的歌曲，调用方追加 ORDER BY
+USER_SONGS_QUERY = """
+    SELECT pe.position, pe.track_id, af.music_id, af.filename, af.duration, af.artist,
+           pe.playlist_type, af.pic_url, af.is_self, af.file_size, af.is_disabled
+    FROM playlist_entries pe
+    JOIN audio_files af ON af.id = pe.track_id
+    WHERE pe.user_id = %s AND pe.playlist_type = %s
+"""
+# 按加入歌单的顺序；二级索引末尾带有主键 track_id，排序和范围都走 idx_playlist_position
+USER_SONGS_ORDER = " ORDER BY pe.position, pe.track_id"
+# 分页游标：(position, track_id) > (x, y)
+USER_SONGS_AFTER = " AND (pe.position > %s OR (pe.position = %s AND pe.track_id > %s))"
+USER_SONGS_BY_TRACK = " AND pe.track_id IN ({track_ids})"
+
+# 每首歌曲对应的 privileges 项，内容固定
+SONG_PRIVILEGE = {"chargeInfoList": [{"chargeType": 0}], "st": 0}
+
+
+def song_from_row(row, host):
+    """歌单中的一行转换成前端使用的歌曲格式"""
+    pic_url = row["pic_url"]
+    # 自定义歌曲的封面构建完整的 HTTP 链接
+    if pic_url and row["is_self"]:
+        pic_url = f"{host}/static/images/{pic_url}"
+    return {
+        "id": str(row["music_id"]),
+        # 去掉 filename 的后缀
+        "name": os.path.splitext(row["filename"])[0],
+        "ar": [{"name": row["artist"]}],
+        "al": {"picUrl": pic_url},
+        "dt": row["duration"],
+        "mv": 0,
+        "alia": [],
+        "self": row["is_self"],
+        "fee": 8,
+        "st": 0,
+        # 音频大小
+        "file_size": row["file_size"],
+        "is_disabled": row["is_disabled"],
+    }
+
+
+def open_playlist_snapshot(user_id, playlist_type):
+    """
+    为流式输出借出单独的连接并开启一致性快照，返回 (连接, 歌单版本号)。
+    版本号和之后在该连接上流式读取的歌曲来自同一快照，响应头中的版本号与内容一致
+    """
+    conn = DatabaseManager.get_connection()
+    try:
+        conn.start_transaction(consistent_snapshot=True, readonly=True)
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(PLAYLIST_VERSION_QUERY, (user_id, playlist_type))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    except Exception:
+        conn.close()
+        raise
+    return conn, rows[0]["version"] if rows else 0
+
+
+def stream_user_songs(conn, user_id, playlist_type, host, dumps):
+    """
+    逐批输出整个歌单的 JSON，格式与不分页时相同。
+    在 open_playlist_snapshot 借出的连接上使用不缓冲的游标，每次只在内存中保留一批行；
+    privileges 最后按歌曲数输出。结束时归还连接。
+    生成器在请求上下文之外执行，dumps 由调用方传入（current_app.json.dumps）
+    """
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    finished = False
+    try:
+        cursor.execute(USER_SONGS_QUERY + USER_SONGS_ORDER, (user_id, playlist_type))
+        count = 0
+        while True:
+            rows = cursor.fetchmany(USER_SONGS_STREAM_BATCH)
+            if not rows:
+                break
+            chunk = ",".join(dumps(song_from_row(row, host)) for row in rows)
+            yield ('{"songsDetail":{"songs":[' if not count else ",") + chunk
+            count += len(rows)
+        finished = True
+        if not count:
+            yield '{"songsDetail":{}}'
+            return
+        yield '],"privileges":['
+        privilege = dumps(SONG_PRIVILEGE)
+        for start in range(0, count, USER_SONGS_STREAM_BATCH):
+            size = min(USER_SONGS_STREAM_BATCH, count - start)
+            yield ("," if start else "") + ",".join([privilege] * size)
+        yield "]}}"
+    finally:
+        # 客户端中途断开时还有没读完的结果，连接归还时会被连接池关闭
+        try:
+            cursor.close()
+        except Exception:
+            if finished:
+                raise
+        conn.close()
+
+
+def playlist_response(response, etag, version):
+    """设置 ETag 和歌单版本号（增量同步的令牌）"""
+    response.headers["X-Playlist-Version"] = str(version)
+    return with_etag(response, etag)
+
+
 # 根据用户、歌单获取歌曲
-@app.route("/api/user/songs", methods=["GET"])
+@bp.route("/api/user/songs", methods=["GET"])
 def get_user_songs():
     try:
         username = request.args.get("username")
@@ -1433,98 +5227,185 @@ def get_user_songs():
             return jsonify({"error": "Missing username or playlist_type"}), 400
 
         # 获取用户 id
-        with DatabaseManager.get_connection() as conn:
-            with conn.cursor() as cursor:
-                query = "SELECT id FROM users WHERE username = %s"
-                cursor.execute(query, (username,))
-                user = cursor.fetchone()
-
-                if not user:
-                    return jsonify({"error": "User not found"}), 404
-                user_id = user[0]
-
-        # 获取歌单信息
-        """
-        # 添加到已保存文件列表
-            saved_files.append({
-                'id': audio_id,
-                'name': filename,
-                'ar': [{'name': '未知歌手'}],
-                'al': {'picUrl': ''},  # 固定的图片 URL
-                'dt': duration,
-                'mv': 0,
-                'alia': [],
-                'self': True,
-                'fee': 8,
-                'st': 0
-            })
-
-        # 返回结果
-        response = {
-            'songsDetail': {
-                'songs': saved_files,
-                'privileges': [{'chargeInfoList': [{'chargeType': 0}], 'st': 0} for _ in saved_files]
-            }
-        }
-        """
-        query = """
-            SELECT music_id, filename, duration, artist, playlist_type, pic_url, is_self, file_size, is_disabled
-            FROM audio_files
-            WHERE user_id = %s AND playlist_type = %s
-        """
-        result = DatabaseManager.execute_query(
-            query, (user_id, playlist_type), fetch=True
-        )
+        user = UserService.get_user_by_username(username)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        user_id = user["id"]
 
-        # 构建完整的 HTTP 链接
         host = request.host_url.rstrip("/")  # 获取当前主机地址
-        for row in result:
-            # 去掉 filename 的后缀
-            row["filename"] = os.path.splitext(row["filename"])[0]
 
-            # 如果 pic_url 存在，构建 HTTP 链接
-            if row["pic_url"] and row["is_self"]:
-                row["pic_url"] = f"{host}/static/images/{row['pic_url']}"
+        # stream=1 时整个歌单以流的形式输出；否则带 cursor 或 page_size 参数时分页
+        stream = bool(request.args.get("stream"))
+        paginated = not stream and (
+            "cursor" in request.args or "page_size" in request.args
+        )
+        page_size = cursor = values = None
+        if paginated:
+            page_size = parse_page_size(USER_SONGS_PAGE_SIZE, USER_SONGS_PAGE_SIZE_MAX)
+            cursor = request.args.get("cursor")
+            if cursor:
+                values, direction = decode_cursor(cursor)
+                if (
+                    direction != "next"
+                    or len(values) != 2
+                    or not all(isinstance(value, int) for value in values)
+                ):
+                    raise InvalidCursorError("Invalid cursor")
+
+        # 版本号在同一事务中先于歌曲读取，ETag 不会比内容新；
+        # 封面链接包含主机地址，分页时每页不同，都计入 ETag
+        version = PlaylistService.version(user_id, playlist_type)
+        variant = f"{user_id}|{playlist_type}|{host}|{page_size}|{cursor}"
+        etag = f"playlist-{version}-{hashlib.md5(variant.encode()).hexdigest()[:16]}"
+        cached = not_modified(etag)
+        if cached:
+            cached.headers["X-Playlist-Version"] = str(version)
+            return cached
+
+        # 完整歌单的响应体按版本号缓存，流式输出时也可以直接使用
+        cache_key = (user_id, playlist_type, host)
+        if not paginated:
+            body = playlist_cache.get(cache_key, version)
+            if body is not None:
+                return playlist_response(
+                    current_app.response_class(body, mimetype="application/json"),
+                    etag,
+                    version,
+                )
 
-        songs = []
-        for row in result:
-            songs.append(
-                {
-                    "id": row["music_id"],
-                    "name": row["filename"],
-                    "ar": [{"name": row["artist"]}],
-                    "al": {"picUrl": row["pic_url"]},
-                    "dt": row["duration"],
-                    "mv": 0,
-                    "alia": [],
-                    "self": row["is_self"],
-                    "fee": 8,
-                    "st": 0,
-                    # 音频大小
-                    "file_size": row["file_size"],
-                    "is_disabled": row["is_disabled"],
-                }
+        # 从服务端游标分批读取，内存占用与歌单长度无关，不写入缓存。
+        # 请求的事务已在响应之前提交，流式读取使用单独连接上的快照，
+        # 版本号和 ETag 按该快照重新读取，与输出的内容一致
+        if stream:
+            conn, version = open_playlist_snapshot(user_id, playlist_type)
+            etag = (
+                f"playlist-{version}-{hashlib.md5(variant.encode()).hexdigest()[:16]}"
+            )
+            cached = not_modified(etag)
+            if cached:
+                conn.close()
+                cached.headers["X-Playlist-Version"] = str(version)
+                return cached
+            response = Response(
+                stream_user_songs(
+                    conn, user_id, playlist_type, host, current_app.json.dumps
+                ),
+                mimetype="application/json",
+            )
+            # 生成器没有开始执行（如客户端提前断开）时 finally 不会执行，关闭响应时归还连接
+            response.call_on_close(conn.close)
+            return playlist_response(response, etag, version)
+
+        # 按加入歌单的顺序返回
+        query = USER_SONGS_QUERY
+        params = [user_id, playlist_type]
+        if paginated:
+            if values:
+                query += USER_SONGS_AFTER
+                params += [values[0], values[0], values[1]]
+            query += USER_SONGS_ORDER + " LIMIT %s"
+            params.append(page_size + 1)
+        else:
+            query += USER_SONGS_ORDER
+        rows = DatabaseManager.execute_query(query, tuple(params), fetch=True)
+
+        next_cursor = None
+        if paginated and len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_cursor(
+                [rows[-1]["position"], rows[-1]["track_id"]], "next"
             )
 
-        if songs.__len__() == 0:
+        songs = [song_from_row(row, host) for row in rows]
+        if not songs:
             response = {"songsDetail": {}}
         else:
             response = {
                 "songsDetail": {
                     "songs": songs,
-                    "privileges": [
-                        {"chargeInfoList": [{"chargeType": 0}], "st": 0} for _ in songs
-                    ],
+                    "privileges": [SONG_PRIVILEGE] * len(songs),
                 }
             }
-        return jsonify(response), 200
-
+        if paginated:
+            response["next_cursor"] = next_cursor
+        response = jsonify(response)
+        if not paginated:
+            playlist_cache.put(cache_key, version, response.get_data())
+        return playlist_response(response, etag, version), 200
+
+    except InvalidCursorError as e:
+        return jsonify({"error": str(e)}), 400
+    except ValueError:
+        return jsonify({"error": "Invalid page_size"}), 400
     except Exception as e:
         logger.error(f"Error getting user songs: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/reset-password", methods=["POST"])
+# 歌单的增量同步
+@bp.route("/api/user/songs/changes", methods=["GET"])
+def get_user_song_changes():
+    """
+    返回同步令牌 since 之后歌单的变化，令牌为 /api/user/songs 响应头 X-Playlist-Version 或上一次的 version。
+    令牌太旧（变更记录已被压缩）或变化太多时返回 full_resync，客户端重新获取整个歌单
+    """
+    try:
+        username = request.args.get("username")
+        playlist_type = request.args.get("playlist_type")
+        if not username or not playlist_type:
+            return jsonify({"error": "Missing username or playlist_type"}), 400
+        try:
+            since = int(request.args.get("since", ""))
+        except ValueError:
+            return jsonify({"error": "Invalid since"}), 400
+
+        user = UserService.get_user_by_username(username)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        user_id = user["id"]
+
+        version, changes = playlist_changes.since(user_id, playlist_type, since)
+        if changes is None:
+            return jsonify({"version": version, "full_resync": True}), 200
+
+        # 只返回每首歌最后的状态：仍在歌单中的返回歌曲信息和位置，不在的返回删除
+        host = request.host_url.rstrip("/")
+        current = {}
+        track_ids = [track_id for track_id, op, _ in changes if op in ("add", "update")]
+        for chunk in chunked(track_ids):
+            query = USER_SONGS_QUERY + USER_SONGS_BY_TRACK.format(
+                track_ids=sql_in_placeholders(chunk)
+            )
+            rows = DatabaseManager.execute_query(
+                query, (user_id, playlist_type, *chunk), fetch=True
+            )
+            current.update((row["track_id"], row) for row in rows)
+
+        result = []
+        for track_id, op, music_id in changes:
+            row = current.get(track_id)
+            if row is not None:
+                result.append(
+                    {
+                        "op": op,
+                        "id": str(row["music_id"]),
+                        "position": row["position"],
+                        "song": song_from_row(row, host),
+                    }
+                )
+            elif music_id is not None:
+                result.append({"op": "remove", "id": str(music_id)})
+        return (
+            jsonify({"version": version, "full_resync": False, "changes": result}),
+            200,
+        )
+
+    except Exception as e:
+        logger.error(f"Error getting user song changes: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/reset-password", methods=["POST"])
 def reset_password():
     try:
         data = request.get_json()
@@ -1549,23 +5430,20 @@ def reset_password():
         return jsonify({"error": "Internal server error"}), 500
 
 
-def delete_user_music_records(user_id):
-    try:
-        # 删除global_music表中用户上传的自定义音频记录
-        query = "DELETE FROM global_music WHERE user_id = %s AND is_api_music = FALSE"
-        DatabaseManager.execute_query(query, (user_id,))
-
-        # 继续删除audio_files表中的记录
-        query = "DELETE FROM audio_files WHERE user_id = %s"
-        DatabaseManager.execute_query(query, (user_id,))
-
-        return True
-    except Exception as e:
-        logger.error(f"Error deleting user music records: {e}")
-        return False
+def delete_uploaded_global_music(user_id):
+    """删除用户上传的自定义音乐在 global_music 中的记录，同时更新计数和搜索索引"""
+    totals = DatabaseManager.execute_query(
+        UPLOADED_MUSIC_TOTALS_QUERY, (user_id,), fetch=True
+    )[0]
+    query = "DELETE FROM global_music WHERE user_id = %s AND is_api_music = FALSE"
+    DatabaseManager.execute_query(query, (user_id,))
+    counters.add(songs=-int(totals["count"]), storage=-int(totals["total"]))
+    music_search.removed_where(
+        lambda attrs: attrs["user_id"] == user_id and not attrs["is_api_music"]
+    )
 
 
-@app.route("/api/user/delete", methods=["POST"])
+@bp.route("/api/user/delete", methods=["POST"])
 def delete_user():
     username = request.json.get("username")
     if not username:
@@ -1575,23 +5453,16 @@ def delete_user():
     if not user:
         return jsonify({"message": "User not found"}), 404
 
-    # 删除用户相关的音乐记录
-    delete_user_music_records(user["id"])
-
+    # 标记删除，音乐记录和文件由后台任务清理
     user_deleted = UserService.delete_user_from_db(username)
     if user_deleted:
-
-        folder_path = "./static/audio/test_api"
-        if os.path.exists(folder_path):
-            shutil.rmtree(folder_path)
-
         return jsonify({"message": "User deleted successfully"}), 200
     else:
         return jsonify({"message": "User not found"}), 404
 
 
 # 删除用户数据
-@app.route("/api/user/delete-data", methods=["POST"])
+@bp.route("/api/user/delete-data", methods=["POST"])
 def delete_user_data():
     username = request.json.get("username")
     if not username:
@@ -1607,7 +5478,7 @@ def delete_user_data():
 """获取音频文件ID"""
 
 
-@app.route("/api/audio/id", methods=["GET"])
+@bp.route("/api/audio/id", methods=["GET"])
 def get_audio_id():
     result = get_audio_music_url()
     if not result:
@@ -1618,7 +5489,7 @@ def get_audio_id():
 """查询用户名是否存在"""
 
 
-@app.route("/api/user/exist", methods=["POST"])
+@bp.route("/api/user/exist", methods=["POST"])
 def check_username_exist():
     username = request.json.get("username")
     if not username:
@@ -1634,7 +5505,7 @@ def check_username_exist():
 """删除用户歌曲"""
 
 
-@app.route("/api/user/songs/delete", methods=["POST"])
+@bp.route("/api/user/songs/delete", methods=["POST"])
 def delete_user_songs():
     data = request.get_json()
     username = data.get("username")
@@ -1652,44 +5523,31 @@ def delete_user_songs():
     user_id = user["id"]
 
     try:
-        # 查询歌曲
-        query = """
-            SELECT * FROM audio_files 
-            WHERE user_id = %s AND music_id = %s AND playlist_type = %s
-        """
-        params = (user_id, music_id, playlist_type)
-        existing_files = DatabaseManager.execute_query(query, params, fetch=True)
+        # 查询歌单中的歌曲
+        params = (user_id, playlist_type, user_id, audio_music_id(music_id))
+        existing_files = DatabaseManager.execute_query(
+            PLAYLIST_TRACKS_BY_MUSIC_QUERY, params, fetch=True
+        )
 
         if not existing_files:
             return jsonify({"error": "Song not found"}), 404
 
         music_info = existing_files[0]
 
-        # 如果是API音乐，只删除用户关联
-        if music_info.get("is_api_music"):
-            query = """
-                DELETE FROM audio_files 
-                WHERE user_id = %s AND music_id = %s AND playlist_type = %s
-            """
-            params = (user_id, music_id, playlist_type)
-            DatabaseManager.execute_query(query, params)
-        else:
-            # 如果是自定义音乐，删除文件和记录
-            if music_info.get("is_self"):
-                file_path = music_info.get("file_path")
-                if file_path and os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except:
-                        logger.warning(f"Failed to delete file: {file_path}")
+        # 移出歌单；歌曲还在其他歌单中时保留歌曲和文件
+        orphaned = PlaylistService.remove(user_id, playlist_type, existing_files)
+        if orphaned:
+            query = (
+                f"DELETE FROM audio_files WHERE id IN ({sql_in_placeholders(orphaned)})"
+            )
+            DatabaseManager.execute_query(query, [row["id"] for row in orphaned])
 
-            # 删除用户的歌曲记录
-            query = """
-                DELETE FROM audio_files 
-                WHERE user_id = %s AND music_id = %s AND playlist_type = %s
-            """
-            params = (user_id, music_id, playlist_type)
-            DatabaseManager.execute_query(query, params)
+            # API音乐只删除用户关联；自定义音乐释放文件引用，旧数据文件提交后删除
+            if not music_info.get("is_api_music"):
+                BlobStore.release(
+                    orphaned, remove_legacy=bool(music_info.get("is_self"))
+                )
+            counters.remove_files(orphaned)
 
         return jsonify({"message": "Song deleted successfully"}), 200
 
@@ -1698,13 +5556,96 @@ def delete_user_songs():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/api/audio/search", methods=["GET"])
+@bp.route("/api/user/songs/delete/batch", methods=["POST"])
+def delete_user_songs_batch():
+    """
+    批量从歌单删除歌曲，返回每首歌的结果：deleted 已删除，not_found 歌单中没有。
+    只在歌单中的歌曲移出歌单；不再属于任何歌单的歌曲删除歌曲行并释放文件，与单首删除相同
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        username = data.get("username")
+        playlist_type = data.get("playlist_type")
+        music_ids = data.get("music_ids")
+        if not username or not playlist_type:
+            return jsonify({"error": "Missing required fields"}), 400
+        if not isinstance(music_ids, list) or not music_ids:
+            return jsonify({"error": "music_ids must be a non-empty list"}), 400
+        limit = current_app.config["PLAYLIST_BATCH_LIMIT"]
+        if len(music_ids) > limit:
+            return jsonify({"error": f"At most {limit} songs per request"}), 400
+
+        user = UserService.get_user_by_username(username)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        user_id = user["id"]
+
+        # 客户端可能传数字形式的ID
+        music_ids = [str(music_id) for music_id in music_ids]
+        track_music_ids = {
+            audio_music_id(music_id)
+            for music_id in music_ids
+            if audio_music_id(music_id) is not None
+        }
+        tracks = []
+        for chunk in chunked(track_music_ids):
+            query = f"""
+                SELECT af.* FROM playlist_entries pe
+                JOIN audio_files af ON af.id = pe.track_id
+                WHERE pe.user_id = %s AND pe.playlist_type = %s AND af.user_id = %s
+                  AND af.music_id IN ({sql_in_placeholders(chunk)})
+            """
+            tracks += DatabaseManager.execute_query(
+                query, (user_id, playlist_type, user_id, *chunk), fetch=True
+            )
+
+        # 移出歌单；歌曲还在其他歌单中时保留歌曲和文件
+        orphaned = PlaylistService.remove(user_id, playlist_type, tracks)
+        if orphaned:
+            query = (
+                f"DELETE FROM audio_files WHERE id IN ({sql_in_placeholders(orphaned)})"
+            )
+            DatabaseManager.execute_query(query, [row["id"] for row in orphaned])
+
+            # API音乐只删除用户关联；自定义音乐释放文件引用，旧数据文件提交后删除
+            for is_self in (True, False):
+                rows = [
+                    row
+                    for row in orphaned
+                    if not row.get("is_api_music")
+                    and bool(row.get("is_self")) == is_self
+                ]
+                if rows:
+                    BlobStore.release(rows, remove_legacy=is_self)
+            counters.remove_files(orphaned)
+
+        deleted = {str(row["music_id"]) for row in tracks}
+        results = [
+            {
+                "music_id": music_id,
+                "status": (
+                    "deleted"
+                    if str(audio_music_id(music_id)) in deleted
+                    else "not_found"
+                ),
+            }
+            for music_id in music_ids
+        ]
+        return jsonify({"deleted": len(deleted), "results": results}), 200
+
+    except Exception as e:
+        logger.error(f"Error deleting user songs in batch: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/api/audio/search", methods=["GET"])
 def get_music_id():
     query = """
-    SELECT af.music_id
+    SELECT CAST(af.music_id AS CHAR) AS music_id
     FROM users u
-    JOIN audio_files af ON u.id = af.user_id
-    WHERE u.username = 'test_api' AND af.playlist_type = 1
+    JOIN playlist_entries pe ON pe.user_id = u.id
+    JOIN audio_files af ON af.id = pe.track_id
+    WHERE u.username = 'test_api' AND pe.playlist_type = 1
     LIMIT 1
     """
     result = DatabaseManager.execute_query(query, fetch=True)
@@ -1713,5 +5654,674 @@ def get_music_id():
     return jsonify({"message": "Audio ID fetched successfully", "data": result}), 200
 
 
+def create_app(config=None):
+    """
+    创建 Flask 应用。
+    :param config: 覆盖默认配置的字典，如 DB_CONFIG、DB_POOL_CONFIG
+    """
+    app = Flask(__name__)
+    app.config.update(
+        DB_CONFIG=DB_CONFIG,
+        DB_POOL_CONFIG=DB_POOL_CONFIG,
+        JOB_DB_PATH=JOB_DB_PATH,
+        JOB_WORKERS=JOB_WORKERS,
+        UPLOAD_ASYNC_PROCESSING=UPLOAD_ASYNC_PROCESSING,
+        ANALYSIS_PROCESSES=ANALYSIS_PROCESSES,
+        BLOB_FOLDER=BLOB_FOLDER,
+        BLOB_GC_GRACE=BLOB_GC_GRACE,
+        BLOB_GC_INTERVAL=BLOB_GC_INTERVAL,
+        BLOB_ORPHAN_AGE=BLOB_ORPHAN_AGE,
+        AUDIO_SENDFILE_MODE=AUDIO_SENDFILE_MODE,
+        AUDIO_ACCEL_PREFIX=AUDIO_ACCEL_PREFIX,
+        AUDIO_STREAM_CHUNK_SIZE=AUDIO_STREAM_CHUNK_SIZE,
+        USER_CACHE_SIZE=USER_CACHE_SIZE,
+        USER_CACHE_TTL=USER_CACHE_TTL,
+        USER_CACHE_REFRESH=USER_CACHE_REFRESH,
+        PLAYLIST_CACHE_BYTES=PLAYLIST_CACHE_BYTES,
+        PLAYLIST_CHANGES_RETENTION=PLAYLIST_CHANGES_RETENTION,
+        PLAYLIST_CHANGES_COMPACT_INTERVAL=PLAYLIST_CHANGES_COMPACT_INTERVAL,
+        PLAYLIST_CHANGES_BATCH=PLAYLIST_CHANGES_BATCH,
+        PLAYLIST_CHANGES_LIMIT=PLAYLIST_CHANGES_LIMIT,
+        DISABLED_MUSIC_REFRESH=DISABLED_MUSIC_REFRESH,
+        MUSIC_ID_CACHE_SIZE=MUSIC_ID_CACHE_SIZE,
+        MUSIC_ID_CACHE_TTL=MUSIC_ID_CACHE_TTL,
+        MUSIC_ID_NEGATIVE_TTL=MUSIC_ID_NEGATIVE_TTL,
+        MUSIC_STATUS_BATCH_LIMIT=MUSIC_STATUS_BATCH_LIMIT,
+        PLAYLIST_BATCH_LIMIT=PLAYLIST_BATCH_LIMIT,
+        SEARCH_INDEX_ENABLED=SEARCH_INDEX_ENABLED,
+        SEARCH_SYNC_INTERVAL=SEARCH_SYNC_INTERVAL,
+        SEARCH_REBUILD_INTERVAL=SEARCH_REBUILD_INTERVAL,
+        SEARCH_LOAD_BATCH=SEARCH_LOAD_BATCH,
+        SEARCH_RESULT_CACHE=SEARCH_RESULT_CACHE,
+        STATS_COUNTER_SHARDS=STATS_COUNTER_SHARDS,
+        STATS_RECONCILE_INTERVAL=STATS_RECONCILE_INTERVAL,
+        USER_STORAGE_QUOTA=USER_STORAGE_QUOTA,
+        USER_PURGE_BATCH=USER_PURGE_BATCH,
+        USER_PURGE_RETRY_INTERVAL=USER_PURGE_RETRY_INTERVAL,
+        USER_PURGE_MAX_ATTEMPTS=USER_PURGE_MAX_ATTEMPTS,
+        MUSIC_ID_WORKER=MUSIC_ID_WORKER,
+        MUSIC_ID_LEASE=MUSIC_ID_LEASE,
+        JSON_PROVIDER=JSON_PROVIDER,
+        COMPRESSION_ENCODINGS=COMPRESSION_ENCODINGS,
+        COMPRESSION_MIN_SIZE=COMPRESSION_MIN_SIZE,
+        COMPRESSION_LEVELS=COMPRESSION_LEVELS,
+    )
+    if config:
+        app.config.update(config)
+    app.json = json_provider(app.config["JSON_PROVIDER"])(app)
+
+    CORS(app)
+
+    # 检查上传文件夹是否存在
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(UPLOAD_AUDIO_FOLDER, exist_ok=True)
+
+    DatabaseManager.configure(app.config["DB_CONFIG"], app.config["DB_POOL_CONFIG"])
+    user_cache.configure(
+        app.config["USER_CACHE_SIZE"],
+        app.config["USER_CACHE_TTL"],
+        app.config["USER_CACHE_REFRESH"],
+    )
+    playlist_cache.configure(app.config["PLAYLIST_CACHE_BYTES"])
+    disabled_music.configure(
+        app.config["DISABLED_MUSIC_REFRESH"],
+        app.config["MUSIC_ID_CACHE_SIZE"],
+        app.config["MUSIC_ID_CACHE_TTL"],
+        app.config["MUSIC_ID_NEGATIVE_TTL"],
+    )
+    for index in (music_search, user_search):
+        index.configure(
+            app.config["SEARCH_SYNC_INTERVAL"],
+            app.config["SEARCH_REBUILD_INTERVAL"],
+            app.config["SEARCH_LOAD_BATCH"],
+            app.config["SEARCH_RESULT_CACHE"],
+        )
+    jobs.configure(app.config["JOB_DB_PATH"], app.config["JOB_WORKERS"])
+    analysis_pool.configure(app.config["ANALYSIS_PROCESSES"])
+    blob_store.configure(
+        app.config["BLOB_FOLDER"],
+        app.config["BLOB_GC_GRACE"],
+        app.config["BLOB_ORPHAN_AGE"],
+    )
+    jobs.schedule("blob_gc", app.config["BLOB_GC_INTERVAL"])
+    counters.configure(app.config["STATS_COUNTER_SHARDS"])
+    jobs.schedule("stats_reconcile", app.config["STATS_RECONCILE_INTERVAL"])
+    user_purges.configure(
+        app.config["USER_PURGE_BATCH"],
+        app.config["USER_PURGE_RETRY_INTERVAL"],
+        app.config["USER_PURGE_MAX_ATTEMPTS"],
+    )
+    jobs.schedule("user_purge_retry", app.config["USER_PURGE_RETRY_INTERVAL"])
+    music_ids.configure(app.config["MUSIC_ID_WORKER"], app.config["MUSIC_ID_LEASE"])
+    playlist_changes.configure(
+        app.config["PLAYLIST_CHANGES_RETENTION"],
+        app.config["PLAYLIST_CHANGES_BATCH"],
+        app.config["PLAYLIST_CHANGES_LIMIT"],
+    )
+    jobs.schedule(
+        "playlist_changes_compact", app.config["PLAYLIST_CHANGES_COMPACT_INTERVAL"]
+    )
+    # after_request 按注册的相反顺序执行，先于蓝图注册，在提交事务等钩子之后压缩最终的响应
+    compressor = ResponseCompressor(
+        app.config["COMPRESSION_ENCODINGS"],
+        app.config["COMPRESSION_MIN_SIZE"],
+        app.config["COMPRESSION_LEVELS"],
+    )
+    app.after_request(lambda response: compressor(request, response))
+    app.register_blueprint(bp)
+    return app
+
+
+# 数据库结构变更，按版本号顺序执行，执行过的版本记录在 schema_migrations 表中。
+# 只能追加新版本，不能修改已发布的版本；mysql.txt 中同步记录完整的表结构
+MIGRATIONS = [
+    (
+        1,
+        "content-addressed audio blobs",
+        [
+            """
+            CREATE TABLE `audio_blobs` (
+              `sha256` CHAR(64) NOT NULL,
+              `file_path` VARCHAR(255) NOT NULL,
+              `file_size` BIGINT DEFAULT NULL,
+              `ref_count` INT NOT NULL DEFAULT 0,
+              `released_at` TIMESTAMP NULL DEFAULT NULL,
+              `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`sha256`),
+              KEY `idx_released` (`ref_count`, `released_at`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+            "ALTER TABLE audio_files ADD COLUMN content_hash CHAR(64) DEFAULT NULL",
+            "ALTER TABLE audio_files ADD INDEX idx_user_playlist_hash (user_id, playlist_type, content_hash)",
+        ],
+    ),
+    (
+        2,
+        "cache versions",
+        [
+            """
+            CREATE TABLE `cache_versions` (
+              `name` VARCHAR(50) NOT NULL,
+              `version` BIGINT NOT NULL DEFAULT 0,
+              PRIMARY KEY (`name`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+        ],
+    ),
+    (
+        3,
+        "audio_files reference and music id indexes",
+        [
+            "ALTER TABLE audio_files ADD INDEX idx_reference_id (reference_id)",
+            "ALTER TABLE audio_files ADD INDEX idx_music_id (music_id)",
+        ],
+    ),
+    (
+        4,
+        "global_music keyset pagination indexes",
+        [
+            "ALTER TABLE global_music ADD INDEX idx_created_id (created_at, id)",
+            "ALTER TABLE global_music ADD INDEX idx_user_created_id (user_id, created_at, id)",
+        ],
+    ),
+    (
+        5,
+        "stats counters",
+        [
+            """
+            CREATE TABLE `app_counters` (
+              `name` VARCHAR(50) NOT NULL,
+              `slot` SMALLINT NOT NULL DEFAULT 0,
+              `value` BIGINT NOT NULL DEFAULT 0,
+              PRIMARY KEY (`name`, `slot`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+            """
+            CREATE TABLE `user_stats` (
+              `user_id` INT NOT NULL,
+              `song_count` INT NOT NULL DEFAULT 0,
+              `storage_used` BIGINT NOT NULL DEFAULT 0,
+              PRIMARY KEY (`user_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+            """
+            INSERT INTO app_counters (name, slot, value)
+            SELECT 'users', 0, COUNT(*) FROM users
+            UNION ALL SELECT 'songs', 0, COUNT(*) FROM global_music
+            UNION ALL SELECT 'storage', 0, COALESCE(SUM(file_size), 0) FROM global_music
+            """,
+            """
+            INSERT INTO user_stats (user_id, song_count, storage_used)
+            SELECT user_id, COUNT(*), COALESCE(SUM(file_size), 0) FROM audio_files GROUP BY user_id
+            """,
+        ],
+    ),
+    (
+        6,
+        "per-user storage quota",
+        ["ALTER TABLE users ADD COLUMN storage_quota BIGINT DEFAULT NULL"],
+    ),
+    (
+        7,
+        "hot query indexes",
+        [
+            # 歌单列表、同名检查、删除歌曲：user_id + playlist_type (+ filename)
+            "ALTER TABLE audio_files ADD INDEX idx_user_playlist_filename (user_id, playlist_type, filename)",
+            # 删除用户上传的音乐
+            "ALTER TABLE global_music ADD INDEX idx_user_api (user_id, is_api_music)",
+            # 重新加载被禁用的音乐ID
+            "ALTER TABLE global_music ADD INDEX idx_disabled (is_disabled)",
+        ],
+    ),
+    (
+        8,
+        "playlist membership table",
+        [
+            """
+            CREATE TABLE `playlist_entries` (
+              `user_id` INT NOT NULL,
+              `playlist_type` INT NOT NULL,
+              `track_id` INT NOT NULL,
+              `position` INT NOT NULL DEFAULT 0,
+              `reference_id` VARCHAR(50) DEFAULT NULL,
+              `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`user_id`, `playlist_type`, `track_id`),
+              KEY `idx_playlist_position` (`user_id`, `playlist_type`, `position`),
+              KEY `idx_track` (`track_id`),
+              KEY `idx_reference_id` (`reference_id`),
+              FOREIGN KEY (`track_id`) REFERENCES `audio_files`(`id`) ON DELETE CASCADE
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+            # 同一用户 music_id 相同的行（同一首歌加入了多个歌单）合并为 id 最小的一行，
+            # 原来每一行变成一条歌单成员，按原来的 id 排序
+            """
+            INSERT INTO playlist_entries (user_id, playlist_type, track_id, position, reference_id)
+            SELECT user_id, playlist_type, track_id, id, reference_id FROM (
+              SELECT id, user_id, playlist_type, reference_id,
+                     IF(music_id IS NULL, id, MIN(id) OVER (PARTITION BY user_id, music_id)) AS track_id
+              FROM audio_files WHERE playlist_type IS NOT NULL
+            ) AS rows_by_track
+            ON DUPLICATE KEY UPDATE position = LEAST(position, VALUES(position))
+            """,
+            """
+            DELETE af FROM audio_files af
+            JOIN (
+              SELECT id, MIN(id) OVER (PARTITION BY user_id, music_id) AS track_id
+              FROM audio_files WHERE music_id IS NOT NULL
+            ) AS merged ON merged.id = af.id
+            WHERE merged.track_id <> af.id
+            """,
+            # 按合并后的行重新计算文件引用数和用户的歌曲数、已用空间
+            """
+            UPDATE audio_blobs b
+            LEFT JOIN (
+              SELECT content_hash, COUNT(*) AS refs FROM audio_files
+              WHERE content_hash IS NOT NULL GROUP BY content_hash
+            ) AS r ON r.content_hash = b.sha256
+            SET b.ref_count = COALESCE(r.refs, 0),
+                b.released_at = IF(r.refs IS NULL, COALESCE(b.released_at, NOW()), NULL)
+            """,
+            """
+            INSERT INTO user_stats (user_id, song_count, storage_used)
+            SELECT user_id, COUNT(*), COALESCE(SUM(file_size), 0) FROM audio_files GROUP BY user_id
+            ON DUPLICATE KEY UPDATE song_count = VALUES(song_count), storage_used = VALUES(storage_used)
+            """,
+        ],
+    ),
+    (
+        9,
+        "drop per-playlist columns from audio_files",
+        [
+            "ALTER TABLE audio_files DROP INDEX idx_user_playlist_hash",
+            "ALTER TABLE audio_files DROP INDEX idx_user_playlist_filename",
+            "ALTER TABLE audio_files DROP INDEX idx_reference_id",
+            # 上传去重、API音乐去重、同名检查
+            "ALTER TABLE audio_files ADD INDEX idx_user_hash (user_id, content_hash)",
+            "ALTER TABLE audio_files ADD INDEX idx_user_music (user_id, music_id)",
+            "ALTER TABLE audio_files ADD INDEX idx_user_filename (user_id, filename)",
+            "ALTER TABLE audio_files DROP COLUMN playlist_type",
+            "ALTER TABLE audio_files DROP COLUMN reference_id",
+        ],
+    ),
+    (
+        10,
+        "user tombstones and purge progress",
+        [
+            "ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP NULL DEFAULT NULL",
+            """
+            CREATE TABLE `user_purges` (
+              `user_id` INT NOT NULL,
+              `username` VARCHAR(50) NOT NULL,
+              `status` VARCHAR(20) NOT NULL DEFAULT 'pending',
+              `files_total` INT NOT NULL DEFAULT 0,
+              `files_purged` INT NOT NULL DEFAULT 0,
+              `attempts` INT NOT NULL DEFAULT 0,
+              `last_error` TEXT,
+              `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+              PRIMARY KEY (`user_id`),
+              KEY `idx_status_updated` (`status`, `updated_at`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+        ],
+    ),
+    (
+        11,
+        "64-bit music ids",
+        [
+            "ALTER TABLE audio_files MODIFY music_id BIGINT DEFAULT NULL",
+            """
+            CREATE TABLE `id_workers` (
+              `worker_id` SMALLINT NOT NULL,
+              `owner` VARCHAR(100) NOT NULL,
+              `leased_until` TIMESTAMP NOT NULL,
+              PRIMARY KEY (`worker_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+        ],
+    ),
+    (
+        12,
+        "playlist versions",
+        [
+            """
+            CREATE TABLE `playlist_versions` (
+              `user_id` INT NOT NULL,
+              `playlist_type` INT NOT NULL,
+              `version` BIGINT NOT NULL DEFAULT 0,
+              PRIMARY KEY (`user_id`, `playlist_type`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+        ],
+    ),
+    (
+        13,
+        "playlist change log",
+        [
+            "ALTER TABLE playlist_versions ADD COLUMN compacted_version BIGINT NOT NULL DEFAULT 0",
+            """
+            CREATE TABLE `playlist_changes` (
+              `id` BIGINT NOT NULL AUTO_INCREMENT,
+              `user_id` INT NOT NULL,
+              `playlist_type` INT NOT NULL,
+              `version` BIGINT NOT NULL,
+              `op` VARCHAR(10) NOT NULL,
+              `track_id` INT NOT NULL,
+              `music_id` BIGINT DEFAULT NULL,
+              `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`id`),
+              KEY `idx_playlist_version` (`user_id`, `playlist_type`, `version`),
+              KEY `idx_created_at` (`created_at`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+        ],
+    ),
+    (
+        14,
+        "upload storage charges",
+        [
+            """
+            CREATE TABLE `upload_charges` (
+              `id` CHAR(32) NOT NULL,
+              `user_id` INT NOT NULL,
+              `amount` BIGINT NOT NULL,
+              `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`id`),
+              KEY `idx_user` (`user_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+            """,
+        ],
+    ),
+]
+# 按 mysql.txt 手工执行过的语句再次执行时的错误：
+# 表已存在、字段已存在、索引已存在、初始化数据已存在、要删除的字段或索引不存在
+MIGRATION_APPLIED_ERRORS = {1050, 1060, 1061, 1062, 1091}
+
+
+def run_migrations():
+    """执行还没有执行过的迁移，返回执行的版本号列表"""
+    DatabaseManager.execute_query("""
+        CREATE TABLE IF NOT EXISTS `schema_migrations` (
+          `version` INT NOT NULL,
+          `description` VARCHAR(255) NOT NULL,
+          `applied_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+          PRIMARY KEY (`version`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+        """)
+    query = "SELECT version FROM schema_migrations"
+    applied = {
+        row["version"] for row in DatabaseManager.execute_query(query, fetch=True)
+    }
+
+    executed = []
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {description}")
+        # DDL 会隐式提交，不能放在一个事务中；中途失败时修复后重新执行，已完成的语句会被跳过
+        for statement in statements:
+            try:
+                DatabaseManager.execute_query(statement)
+            except mysql.connector.Error as e:
+                if e.errno not in MIGRATION_APPLIED_ERRORS:
+                    raise
+                logger.info(f"Migration {version}: already applied ({e.msg})")
+        query = "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)"
+        DatabaseManager.execute_query(query, (version, description))
+        executed.append(version)
+    return executed
+
+
+# 接口中每次请求都会执行的查询，用 --check-indexes 检查执行计划。
+# (接口, 查询, 示例参数)，查询与处理函数共用同一份 SQL 常量
+HOT_QUERIES = [
+    ("get_user_song_changes", PLAYLIST_CHANGES_QUERY, (1, 1, 0, 10, 5001)),
+    (
+        "get_user_song_changes",
+        USER_SONGS_QUERY + USER_SONGS_BY_TRACK.format(track_ids="%s, %s"),
+        (1, 1, 1, 2),
+    ),
+    ("get_user_songs", PLAYLIST_VERSION_QUERY, (1, 1)),
+    ("get_user_songs", USER_SONGS_QUERY + USER_SONGS_ORDER, (1, 1)),
+    (
+        "get_user_songs_page",
+        USER_SONGS_QUERY + USER_SONGS_AFTER + USER_SONGS_ORDER + " LIMIT %s",
+        (1, 1, 0, 0, 0, 101),
+    ),
+    (
+        "upload_audio",
+        TRACKS_BY_HASH_QUERY.format(hashes="%s, %s"),
+        (1, 1, "0" * 64, "f" * 64),
+    ),
+    ("upload_audio", USER_BY_USERNAME_QUERY, ("user1",)),
+    ("add_to_playlist", PLAYLIST_TRACK_BY_FILENAME_QUERY, (1, 1, 1, "song1")),
+    ("add_to_playlist", API_TRACK_QUERY, (1, 2)),
+    ("add_to_playlist", PLAYLIST_LISTED_QUERY.format(track_ids="%s"), (1, 1, 1)),
+    ("add_to_playlist", PLAYLIST_END_QUERY, (1, 1)),
+    ("add_to_playlist", TRACKS_BY_NAME_QUERY, (1, "%song%")),
+    ("add_to_playlist", USER_GLOBAL_MUSIC_QUERY, ("1", 1)),
+    ("add_to_playlist", GLOBAL_MUSIC_IDS_QUERY.format(music_ids="%s, %s"), ("1", "2")),
+    (
+        "add_to_playlist",
+        " UNION ALL ".join([TRACK_BY_NAME_PROBE] * 2),
+        (0, 1, "%song1%", 1, 1, "%song2%"),
+    ),
+    ("get_audio", AUDIO_PATH_QUERY, (1,)),
+    ("stream_audio", AUDIO_PATH_QUERY, (1,)),
+    ("check_music_status", GLOBAL_MUSIC_IDS_QUERY.format(music_ids="%s"), ("1",)),
+    (
+        "check_music_status",
+        REFERENCE_LOOKUP_QUERY.format(reference_ids="%s")
+        + " UNION "
+        + AUDIO_MUSIC_LOOKUP_QUERY.format(music_ids="%s"),
+        ("user_1_api_2_playlist_1", 1),
+    ),
+    ("check_music_status", MUSIC_ID_SUBSTRING_QUERY, ("%123%",)),
+    ("check_music_status", DISABLED_MUSIC_QUERY, ()),
+    ("delete_user_songs", PLAYLIST_TRACKS_BY_MUSIC_QUERY, (1, 1, 1, 1)),
+    ("delete_user_songs", STILL_LISTED_QUERY.format(track_ids="%s"), (1,)),
+    ("delete_user_songs", UPLOADED_MUSIC_TOTALS_QUERY, (1,)),
+]
+
+# 已知并接受的全表（全索引）扫描：{查询: 原因}，检查时输出 allow，不算失败
+PLAN_CHECK_ALLOWED_SCANS = {
+    MUSIC_ID_SUBSTRING_QUERY: "substring fallback for a single unresolved id, "
+    "only after both indexed lookups miss; the result is cached",
+}
+
+# 检查执行计划时在临时库中生成的数据量：用户数 × 每个用户的歌曲数，
+# 数据太少时即使有可用的索引 MySQL 也会选择全表扫描
+PLAN_CHECK_USERS = 200
+PLAN_CHECK_TRACKS = 50
+
+# (表, 列, 第 n 行的值, 行数)；n 从 1 开始，MOD 代替 % 以免与占位符混淆
+PLAN_CHECK_SEED = [
+    (
+        "users",
+        "id, username, password, security_question, security_answer",
+        "n, CONCAT('user', n), '', '', ''",
+        PLAN_CHECK_USERS,
+    ),
+    (
+        "audio_files",
+        "id, user_id, music_id, filename, duration, file_size, content_hash, is_api_music",
+        f"n, 1 + MOD(n, {PLAN_CHECK_USERS}), n, CONCAT('song', n), 0, 0, SHA2(n, 256), "
+        "MOD(n, 2) = 0",
+        PLAN_CHECK_USERS * PLAN_CHECK_TRACKS,
+    ),
+    (
+        "playlist_entries",
+        "user_id, playlist_type, track_id, position, reference_id",
+        f"1 + MOD(n, {PLAN_CHECK_USERS}), 1 + MOD(n, 3), n, n, "
+        f"IF(MOD(n, 2) = 0, CONCAT('user_', 1 + MOD(n, {PLAN_CHECK_USERS}), "
+        "'_api_', n, '_playlist_', 1 + MOD(n, 3)), NULL)",
+        PLAN_CHECK_USERS * PLAN_CHECK_TRACKS,
+    ),
+    (
+        "global_music",
+        "music_id, user_id, name, file_size, is_disabled, is_api_music",
+        f"CAST(n AS CHAR), 1 + MOD(n, {PLAN_CHECK_USERS}), CONCAT('song', n), 0, "
+        "MOD(n, 100) = 0, MOD(n, 2) = 0",
+        PLAN_CHECK_USERS * PLAN_CHECK_TRACKS,
+    ),
+    (
+        "playlist_versions",
+        "user_id, playlist_type, version",
+        f"1 + MOD(n, {PLAN_CHECK_USERS}), 1 + MOD(n, 3), n",
+        PLAN_CHECK_USERS * 3,
+    ),
+    (
+        "playlist_changes",
+        "user_id, playlist_type, version, op, track_id",
+        f"1 + MOD(n, {PLAN_CHECK_USERS}), 1 + MOD(n, 3), n, 'add', n",
+        PLAN_CHECK_USERS * PLAN_CHECK_TRACKS,
+    ),
+]
+
+
+def check_query_plans():
+    """
+    对 HOT_QUERIES 执行 EXPLAIN，返回做全表（全索引）扫描的执行计划行，
+    PLAN_CHECK_ALLOWED_SCANS 中登记的查询除外。
+    在临时库 <数据库>_plan_check 中按当前表结构建表（CREATE TABLE ... LIKE）并生成数据，
+    ANALYZE 后再 EXPLAIN，执行计划不受线上数据多少的影响；结束时删除临时库。
+    需要 CREATE / DROP DATABASE 权限
+    """
+    database = DatabaseManager._db_config["database"]
+    scratch = f"{database}_plan_check"
+    # 不使用连接池：USE 会改变连接的默认库
+    conn = mysql.connector.connect(**DatabaseManager._db_config)
+    cursor = conn.cursor(dictionary=True)
+    failures = []
+    try:
+        cursor.execute(f"DROP DATABASE IF EXISTS `{scratch}`")
+        cursor.execute(f"CREATE DATABASE `{scratch}`")
+        cursor.execute(
+            "SET SESSION cte_max_recursion_depth = %s",
+            (max(rows for *_, rows in PLAN_CHECK_SEED),),
+        )
+        for table, columns, values, rows in PLAN_CHECK_SEED:
+            cursor.execute(
+                f"CREATE TABLE `{scratch}`.`{table}` LIKE `{database}`.`{table}`"
+            )
+            cursor.execute(
+                f"INSERT IGNORE INTO `{scratch}`.`{table}` ({columns}) "
+                "WITH RECURSIVE seq (n) AS "
+                "(SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < %s) "
+                f"SELECT {values} FROM seq",
+                (rows,),
+            )
+        conn.commit()
+        tables = ", ".join(f"`{scratch}`.`{table}`" for table, *_ in PLAN_CHECK_SEED)
+        cursor.execute(f"ANALYZE TABLE {tables}")
+        cursor.fetchall()
+
+        cursor.execute(f"USE `{scratch}`")
+        for endpoint, query, params in HOT_QUERIES:
+            cursor.execute(f"EXPLAIN {query}", params)
+            for row in cursor.fetchall():
+                table = row.get("table") or ""
+                # <union1,2>、<derived2> 等是临时结果，不是数据表
+                if row.get("type") not in ("ALL", "index") or table.startswith("<"):
+                    print(
+                        f"ok    {endpoint:<22} {table:<14} {row.get('type')} {row.get('key')}"
+                    )
+                    continue
+                if query in PLAN_CHECK_ALLOWED_SCANS:
+                    print(
+                        f"allow {endpoint:<22} {table:<14} {row['type']} "
+                        f"({PLAN_CHECK_ALLOWED_SCANS[query]})"
+                    )
+                    continue
+                print(
+                    f"FAIL  {endpoint:<22} {table:<14} {row['type']} "
+                    f"(possible keys: {row.get('possible_keys')})  {' '.join(query.split())}"
+                )
+                failures.append((endpoint, table, row["type"], query))
+    finally:
+        try:
+            cursor.execute(f"DROP DATABASE IF EXISTS `{scratch}`")
+        finally:
+            cursor.close()
+            conn.close()
+    return failures
+
+
+def profile_startup(top=15):
+    """
+    在新的解释器中用 -X importtime 冷启动一次，打印各顶层模块的导入耗时和创建应用的耗时
+    """
+    code = (
+        "import time; start = time.perf_counter(); import main; "
+        "imported = time.perf_counter(); main.create_app(); "
+        "print(imported - start, time.perf_counter() - imported)"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        print(proc.stderr)
+        return
+
+    # 输出格式：import time: self [us] | cumulative | imported package
+    # 模块名前每两个空格表示一层嵌套，子模块先于父模块输出
+    children = []
+    main_imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entry = (int(fields[1]), int(fields[0]), name.strip())
+        if depth == 1:
+            children.append(entry)
+        elif depth == 0:
+            if entry[2] == "main":
+                main_imports = children + [(entry[1], entry[1], "main (own code)")]
+            children = []
+
+    import_seconds, create_seconds = map(float, proc.stdout.split()[-2:])
+    print(f"import main: {import_seconds * 1000:.1f} ms")
+    print(f"create_app(): {create_seconds * 1000:.1f} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, self_time, name in sorted(main_imports, reverse=True)[:top]:
+        print(f"{cumulative / 1000:>14.1f} {self_time / 1000:>9.1f}  {name}")
+
+
 if __name__ == "__main__":
-    app.run(debug=True, port=5001)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print an import-time breakdown of a cold start and exit",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="apply pending schema migrations and exit",
+    )
+    parser.add_argument(
+        "--check-indexes",
+        action="store_true",
+        help="EXPLAIN the hot queries against seeded scratch tables "
+        "and exit non-zero if any needs a full scan",
+    )
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        profile_startup()
+    elif args.migrate or args.check_indexes:
+        create_app()
+        if args.migrate:
+            executed = run_migrations()
+            print(f"Applied migrations: {executed or 'none'}")
+        if args.check_indexes and check_query_plans():
+            sys.exit(1)
+    else:
+        create_app().run(debug=True, port=5001)
@@ -117,6 +117,22 @@ def get_audio_files(directory):
     return audio_files
 
 
+def wait_for_job(job_id, timeout=60):
+    """等待上传的后台任务完成"""
+    if not job_id:
+        return None
+    url = f"http://localhost:5001/api/jobs/{job_id}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = requests.get(url).json()
+        if job.get("status") in ("done", "failed"):
+            print("Job result:", job)
+            assert job["status"] == "done", f"Job {job_id} failed: {job.get('error')}"
+            return job
+        time.sleep(0.5)
+    raise AssertionError(f"Job {job_id} did not finish in {timeout}s")
+
+
 def test_upload_audio():
     url = "http://localhost:5001/upload/audio"
     # 检索本地文件夹中的音频文件
@@ -155,6 +171,7 @@ def test_upload_audio():
     print(f"Total file size to upload: {total_size / (1024*1024):.2f} MB")
     response = requests.post(url, data=data, files=files_data)
     print("Upload Audio response:", response.json())
+    wait_for_job(response.json().get("job_id"))
     print(
         "----------------------------------------------------------------------------------------------------------------------------------------"
     )
@@ -181,6 +198,7 @@ def test_upload_audio():
             }
             response = requests.post(url, data=data, files=files_data)
             print("Upload one Audio response:", response.json())
+            wait_for_job(response.json().get("job_id"))
             print(
                 "----------------------------------------------------------------------------------------------------------------------------------------"
             )
@@ -274,6 +292,16 @@ def test_music_status():
     )
 
 
+def test_music_status_batch():
+    url = "http://localhost:5001/api/music/status/batch"
+    data = {"ids": ["1394111226", "not_exist_id"]}
+    response = requests.post(url, json=data)
+    print("Music Status Batch response:", response.json())
+    print(
+        "----------------------------------------------------------------------------------------------------------------------------------------"
+    )
+
+
 def test_disabled_music():
     url = "http://localhost:5001/api/disabled-music"
     response = requests.get(url)
@@ -283,6 +311,292 @@ def test_disabled_music():
     )
 
 
+def admin_headers():
+    url = "http://localhost:5001/admin/login"
+    response = requests.post(url, json={"username": "admin", "password": "admin"})
+    return {"Authorization": response.json()["token"]}
+
+
+def get_test_user_id(headers):
+    url = "http://localhost:5001/admin/users"
+    response = requests.get(url, params={"search": "test_api"}, headers=headers)
+    users = [u for u in response.json()["users"] if u["username"] == "test_api"]
+    return users[0]["id"]
+
+
+def test_storage_quota():
+    headers = admin_headers()
+    user_id = get_test_user_id(headers)
+    url_user = f"http://localhost:5001/admin/users/{user_id}"
+    url_quota = f"http://localhost:5001/admin/users/{user_id}/quota"
+    url_upload = "http://localhost:5001/upload/audio"
+
+    statistics = requests.get(url_user, headers=headers).json()["statistics"]
+    print("Storage before quota test:", statistics)
+    used = statistics["storage_used"]
+
+    files = get_audio_files("./static/music")
+    if not files:
+        print("Warning: No audio files for quota test")
+        return
+    file_path = os.path.join("./static/music", files[0])
+    data = {"username": "test_api", "is_self": True, "playlist_type": 2}
+
+    # 剩余额度只有 1 字节：文件不保存
+    response = requests.put(url_quota, json={"quota": used + 1}, headers=headers)
+    assert response.status_code == 200, response.json()
+    with open(file_path, "rb") as f:
+        response = requests.post(
+            url_upload, data=data, files=[("audio_files", (files[0], f))]
+        )
+    print("Upload over quota response:", response.json())
+    assert response.status_code == 200, response.status_code
+    assert response.json()["results"][0]["status"] == "quota_exceeded"
+
+    # 用户名放在查询参数中时，请求体大于剩余额度直接返回 413
+    with open(file_path, "rb") as f:
+        response = requests.post(
+            url_upload,
+            params={"username": "test_api"},
+            data={"is_self": True, "playlist_type": 2},
+            files=[("audio_files", (files[0], f))],
+        )
+    print("Upload over quota (query username) response:", response.json())
+    assert response.status_code == 413, response.status_code
+
+    # 已用空间没有变化
+    statistics = requests.get(url_user, headers=headers).json()["statistics"]
+    assert statistics["storage_used"] == used, statistics
+
+    # 恢复默认额度
+    response = requests.put(url_quota, json={"quota": None}, headers=headers)
+    print("Reset quota response:", response.json())
+    print(
+        "----------------------------------------------------------------------------------------------------------------------------------------"
+    )
+
+
+def test_storage_reconcile():
+    headers = admin_headers()
+    user_id = get_test_user_id(headers)
+    url = f"http://localhost:5001/admin/users/{user_id}/storage/reconcile"
+    response = requests.post(url, headers=headers)
+    result = response.json()
+    print("Storage reconcile response:", result)
+    assert response.status_code == 200, result
+    assert not result["missing"], result
+
+    # 再次对账时计数与磁盘上的文件一致，不需要修正
+    result = requests.post(url, headers=headers).json()
+    assert result["before"] == result["after"] and result["corrected"] == 0, result
+
+    statistics = requests.get(
+        f"http://localhost:5001/admin/users/{user_id}", headers=headers
+    ).json()["statistics"]
+    assert statistics["storage_used"] == result["after"], statistics
+    print(
+        "----------------------------------------------------------------------------------------------------------------------------------------"
+    )
+
+
+def test_playlist_membership():
+    headers = admin_headers()
+    user_id = get_test_user_id(headers)
+    songs_url = "http://localhost:5001/api/user/songs"
+    song = {
+        "username": "test_api",
+        "song_name": "極私的極彩色アンサー",
+        "artist": "トゲナシトゲアリ",
+        "duration": 155006,
+        "music_id": "1394111226",
+        "pic_url": "https://p2.music.126.net/FaNFmGKiQEB5mMmWeDqLhQ==/109951170209243099.jpg",
+        "song_size": 2 * 1024 * 1024,
+    }
+    user_url = f"http://localhost:5001/admin/users/{user_id}"
+    song_count = requests.get(user_url, headers=headers).json()["statistics"][
+        "song_count"
+    ]
+
+    # 同一首歌加入喜欢的歌单只增加歌单成员，不增加歌曲
+    response = requests.post(
+        "http://localhost:5001/api/playlist/add", json={**song, "playlist_type": 3}
+    )
+    print("Add to favourite Playlist response:", response.json())
+    assert response.status_code == 200, response.json()
+    statistics = requests.get(user_url, headers=headers).json()["statistics"]
+    assert statistics["song_count"] == song_count, statistics
+
+    # 从喜欢的歌单删除后，本地歌单中仍然有这首歌
+    response = requests.post(
+        "http://localhost:5001/api/user/songs/delete",
+        json={"username": "test_api", "playlist_type": 3, "music_id": "1394111226"},
+    )
+    assert response.status_code == 200, response.json()
+    for playlist_type, expected in ((2, True), (3, False)):
+        songs = requests.get(
+            songs_url, params={"username": "test_api", "playlist_type": playlist_type}
+        ).json()["songsDetail"]["songs"]
+        listed = any(str(s["id"]) == "1394111226" for s in songs)
+        assert listed == expected, (playlist_type, songs)
+    print(
+        "----------------------------------------------------------------------------------------------------------------------------------------"
+    )
+
+
+def test_user_songs_pages():
+    url = "http://localhost:5001/api/user/songs"
+    params = {"username": "test_api", "playlist_type": 2}
+    full = requests.get(url, params=params).json()
+    songs = full["songsDetail"].get("songs", [])
+
+    # 每页一首，逐页取完后与整个歌单相同
+    paged, cursor = [], None
+    while True:
+        page_params = {**params, "page_size": 1}
+        if cursor:
+            page_params["cursor"] = cursor
+        page = requests.get(url, params=page_params).json()
+        paged += page["songsDetail"].get("songs", [])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert [s["id"] for s in paged] == [s["id"] for s in songs], paged
+
+    # 流式输出与不分页时的响应相同；流式响应总是压缩（requests 自动解压）
+    response = requests.get(url, params={**params, "stream": 1})
+    print(
+        "Stream user songs:",
+        len(response.content),
+        "bytes",
+        response.headers.get("Content-Encoding"),
+    )
+    assert response.json() == full, response.text
+    assert response.headers.get("Content-Encoding") in ("gzip", "br", "zstd")
+
+    response = requests.get(url, params={**params, "cursor": "invalid"})
+    assert response.status_code == 400, response.json()
+
+    # 歌单没有变化时返回 304，加入歌曲后 ETag 改变
+    response = requests.get(url, params=params)
+    etag = response.headers["ETag"]
+    full_version = response.headers["X-Playlist-Version"]
+    response = requests.get(url, params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304, response.status_code
+    response = requests.post(
+        "http://localhost:5001/api/playlist/add",
+        json={
+            "username": "test_api",
+            "playlist_type": 2,
+            "song_name": "ETag test",
+            "artist": "test",
+            "duration": 1000,
+            "music_id": "1394111227",
+            "pic_url": "",
+            "song_size": 1024,
+        },
+    )
+    assert response.status_code == 200, response.json()
+    response = requests.get(url, params=params, headers={"If-None-Match": etag})
+    print("Playlist ETag:", etag, "->", response.headers.get("ETag"))
+    assert response.status_code == 200, response.status_code
+    assert response.headers["ETag"] != etag
+
+    # 增量同步：从加歌之前的版本号同步，只返回新加入的歌曲
+    since = int(full_version)
+    changes = requests.get(f"{url}/changes", params={**params, "since": since}).json()
+    print("Playlist changes:", changes)
+    assert not changes["full_resync"], changes
+    assert [c["id"] for c in changes["changes"]] == ["1394111227"], changes
+    assert changes["changes"][0]["op"] == "add", changes
+    response = requests.get(
+        f"{url}/changes", params={**params, "since": changes["version"]}
+    )
+    assert response.json()["changes"] == [], response.json()
+    response = requests.get(f"{url}/changes", params={**params, "since": -1})
+    assert response.json()["full_resync"], response.json()
+    print(
+        "----------------------------------------------------------------------------------------------------------------------------------------"
+    )
+
+
+def test_playlist_batch():
+    add_url = "http://localhost:5001/api/playlist/add/batch"
+    delete_url = "http://localhost:5001/api/user/songs/delete/batch"
+    songs_url = "http://localhost:5001/api/user/songs"
+    params = {"username": "test_api", "playlist_type": 3}
+    songs = [
+        {
+            "song_name": f"Batch song {i}",
+            "artist": "test",
+            "duration": 1000 + i,
+            "music_id": str(1394112000 + i),
+            "pic_url": "",
+            "song_size": 1024,
+        }
+        for i in range(3)
+    ]
+
+    # 第二次加入同一首歌标记为 duplicate，缺少音乐ID的为 invalid
+    response = requests.post(
+        add_url,
+        json={
+            **params,
+            "songs": songs + [songs[0], {"song_name": "Batch invalid"}],
+        },
+    )
+    print("Batch add response:", response.json())
+    assert response.status_code == 200, response.json()
+    statuses = [item["status"] for item in response.json()["results"]]
+    assert statuses == ["added"] * 3 + ["duplicate", "invalid"], statuses
+
+    listed = requests.get(songs_url, params=params).json()["songsDetail"]["songs"]
+    ids = [song["id"] for song in listed]
+    assert ids[-3:] == [song["music_id"] for song in songs], ids
+
+    # 再次加入时已存在
+    response = requests.post(add_url, json={**params, "songs": songs})
+    statuses = [item["status"] for item in response.json()["results"]]
+    assert statuses == ["exists"] * 3, statuses
+
+    music_ids = [song["music_id"] for song in songs] + ["1"]
+    response = requests.post(delete_url, json={**params, "music_ids": music_ids})
+    print("Batch delete response:", response.json())
+    assert response.status_code == 200, response.json()
+    statuses = [item["status"] for item in response.json()["results"]]
+    assert statuses == ["deleted"] * 3 + ["not_found"], statuses
+    listed = requests.get(songs_url, params=params).json()["songsDetail"]
+    assert not set(music_ids) & {song["id"] for song in listed.get("songs", [])}
+    print(
+        "----------------------------------------------------------------------------------------------------------------------------------------"
+    )
+
+
+def test_user_purge():
+    headers = admin_headers()
+    user_id = get_test_user_id(headers)
+    delete_user("test_api")
+
+    # 删除后用户名立即可用，音频记录和文件由后台任务清理
+    response = requests.post(
+        "http://localhost:5001/api/user/exist", json={"username": "test_api"}
+    )
+    assert response.status_code == 200, response.json()
+
+    url = f"http://localhost:5001/admin/users/{user_id}/purge"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        purge = requests.get(url, headers=headers).json()["purge"]
+        if purge["status"] in ("done", "failed"):
+            break
+        time.sleep(0.5)
+    print("User purge progress:", purge)
+    assert purge["status"] == "done", purge
+    assert purge["files_purged"] == purge["files_total"], purge
+    print(
+        "----------------------------------------------------------------------------------------------------------------------------------------"
+    )
+
+
 def util_get_music_id():
     url = "http://localhost:5001/api/audio/search"
     response = requests.get(url)
@@ -312,7 +626,13 @@ def test():
     test_get_audio()
     test_add_to_playlist()
     test_music_status()
+    test_music_status_batch()
     test_disabled_music()
+    test_storage_quota()
+    test_storage_reconcile()
+    test_playlist_membership()
+    test_user_songs_pages()
+    test_playlist_batch()
 
     try:
         music_id = util_get_music_id()
@@ -322,7 +642,7 @@ def test():
 
     test_logout()
     test_delete_user_data()
-    delete_user("test_api")
+    test_user_purge()
 
 
 test()
@@ -0,0 +1,147 @@
+"""
+内存中的 n-gram 倒排索引，用于歌曲名、歌手名、用户名的子串搜索。
+
+中文标题没有空格分词，MySQL 默认的 FULLTEXT 解析器按空格和标点切词，
+整段中文会被当成一个词，搜不到其中的子串。这里按字符切分：
+每个字符（1-gram）和相邻两个字符（2-gram）各是一个词项，中英文同样处理。
+查询时取查询串所有词项倒排表的交集作为候选，再确认查询串确实是字段的子串，
+结果与 LIKE '%关键字%' 相同（不区分大小写和全角半角），但不需要扫描全表。
+"""
+
+import threading
+import unicodedata
+
+
+def normalize(text):
+    """统一全角半角、大小写"""
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+def ngrams(text):
+    """文本的所有 1-gram 和 2-gram"""
+    grams = set(text)
+    grams.update(text[i : i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+def query_grams(query):
+    """查询使用的词项：单个字符时用 1-gram，否则用 2-gram（2-gram 的交集已经足够小）"""
+    if len(query) == 1:
+        return {query}
+    return {query[i : i + 2] for i in range(len(query) - 1)}
+
+
+class NgramIndex:
+    """
+    倒排索引：词项 -> 文档ID集合。
+    每个文档有若干个文本字段（参与搜索和排序）和若干个属性（用于过滤，如所属用户）。
+    """
+
+    def __init__(self, fields, weights=None):
+        """
+        :param fields: 文本字段名，如 ("name", "artist")
+        :param weights: 字段权重，默认按顺序递减（第一个字段最重要）
+        """
+        self.fields = tuple(fields)
+        self.weights = weights or {
+            field: len(self.fields) - i for i, field in enumerate(self.fields)
+        }
+        self._postings = {}
+        self._docs = {}  # 文档ID -> (规范化后的字段值元组, 属性)
+        self._lock = threading.RLock()
+        self.max_id = 0
+        # 每次增删文档加一，用于判断缓存的搜索结果是否过期
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc_id, values, attrs=None):
+        """添加或替换文档，values 为 {字段名: 文本}"""
+        texts = tuple(normalize(values.get(field)) for field in self.fields)
+        with self._lock:
+            if doc_id in self._docs:
+                self._remove(doc_id)
+            self._docs[doc_id] = (texts, attrs or {})
+            for gram in set().union(*(ngrams(text) for text in texts)):
+                self._postings.setdefault(gram, set()).add(doc_id)
+            if isinstance(doc_id, int) and doc_id > self.max_id:
+                self.max_id = doc_id
+            self.generation += 1
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def remove_where(self, predicate):
+        """删除属性满足 predicate 的文档，返回删除的数量"""
+        with self._lock:
+            doc_ids = [
+                doc_id for doc_id, (_, attrs) in self._docs.items() if predicate(attrs)
+            ]
+            for doc_id in doc_ids:
+                self._remove(doc_id)
+        return len(doc_ids)
+
+    def gram_count(self):
+        return len(self._postings)
+
+    def search(self, query, predicate=None):
+        """
+        返回按相关度排序的文档ID列表。
+        :param predicate: 按属性过滤的函数，接收属性字典，返回 False 的文档被排除
+        """
+        query = normalize(query).strip()
+        if not query:
+            return []
+        with self._lock:
+            postings = [self._postings.get(gram) for gram in query_grams(query)]
+            if not all(postings):
+                return []
+            # 从最短的倒排表开始求交集
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates &= posting
+                if not candidates:
+                    return []
+            docs = [(doc_id, self._docs[doc_id]) for doc_id in candidates]
+
+        scored = []
+        for doc_id, (texts, attrs) in docs:
+            if predicate is not None and not predicate(attrs):
+                continue
+            score = self._score(query, texts)
+            if score:
+                scored.append((score, doc_id))
+        # 相关度相同时新的在前
+        scored.sort(reverse=True)
+        return [doc_id for _, doc_id in scored]
+
+    def _score(self, query, texts):
+        """完全相同 > 前缀 > 子串；同类匹配中字段越短（查询占比越大）越靠前"""
+        score = 0.0
+        for field, text in zip(self.fields, texts):
+            position = text.find(query)
+            if position < 0:
+                continue
+            if text == query:
+                kind = 4
+            elif position == 0:
+                kind = 2
+            else:
+                kind = 1
+            score += self.weights[field] * (kind + len(query) / len(text))
+        return score
+
+    def _remove(self, doc_id):
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            return
+        self.generation += 1
+        for gram in set().union(*(ngrams(text) for text in doc[0])):
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.discard(doc_id)
+                if not posting:
+                    del self._postings[gram]
@@ -0,0 +1,104 @@
+"""
+Flask 的 JSON 序列化（app.json）。
+
+默认的 DefaultJSONProvider 使用标准库 json，几万首歌的歌单、管理端列表序列化要几十到上百毫秒。
+OrjsonProvider 使用 orjson（C 实现），输出与 DefaultJSONProvider 相同的 JSON 值：
+日期时间仍然是 HTTP 日期格式（"Mon, 01 Jan 2024 00:00:00 GMT"），Decimal 转成字符串，
+只是中文不再转义成 \\uXXXX（直接输出 UTF-8，更短）。
+
+orjson 没有安装时 json_provider("orjson") 退回默认实现。
+"""
+
+import dataclasses
+import decimal
+import logging
+import uuid
+from datetime import date, datetime, timezone
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+DAYS = "Mon Tue Wed Thu Fri Sat Sun".split()
+MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+
+
+def http_date(value):
+    """
+    与 werkzeug.http.http_date 结果相同（不带时区的按 UTC），
+    查表拼接，比 werkzeug 的实现快几倍，管理端列表每行都有 created_at
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        hour, minute, second = value.hour, value.minute, value.second
+    else:
+        hour = minute = second = 0
+    return (
+        f"{DAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} "
+        f"{value.year:04d} {hour:02d}:{minute:02d}:{second:02d} GMT"
+    )
+
+
+def _default(value):
+    """orjson 不能直接处理的类型，转换方式与 DefaultJSONProvider 相同"""
+    if isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if hasattr(value, "__html__"):
+        return str(value.__html__())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    orjson 实现的 JSON Provider，sort_keys、compact 等属性的含义与 DefaultJSONProvider 相同。
+    response() 直接使用 orjson 生成的 bytes，不经过 str。
+    """
+
+    def _options(self, **kwargs):
+        # 日期时间交给 _default 处理，保持 HTTP 日期格式；字典的整数键转成字符串
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        indent = kwargs.get("indent")
+        if indent or (
+            indent is None
+            and (self.compact is False or (self.compact is None and self._app.debug))
+        ):
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj, default=_default, option=self._options(**kwargs)
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=_default, option=self._options())
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+
+PROVIDERS = {"default": DefaultJSONProvider, "orjson": OrjsonProvider}
+
+
+def json_provider(name):
+    """按名称返回 JSON Provider 类，orjson 没有安装时返回默认实现"""
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown JSON provider: {name}")
+    if name == "orjson" and orjson is None:
+        logger.warning("orjson is not installed, using the default JSON provider")
+        return DefaultJSONProvider
+    return PROVIDERS[name]